@@ -0,0 +1,371 @@
+# File: benchmarks/bench.py
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+from benchmarks import fixtures
+
+# Layer set sizes, config_size and package_size are in bytes
+SCENARIOS = {
+    'small': {'layers': 4, 'config_files': 50, 'config_size': 1024, 'scripts': 2, 'requirements': 20,
+              'packages': 10, 'package_size': 256 * 1024},
+    'medium': {'layers': 16, 'config_files': 500, 'config_size': 4096, 'scripts': 5, 'requirements': 100,
+               'packages': 50, 'package_size': 1024 * 1024},
+    'large': {'layers': 64, 'config_files': 2000, 'config_size': 16384, 'scripts': 10, 'requirements': 400,
+              'packages': 200, 'package_size': 4 * 1024 * 1024},
+}
+
+STAGES = ['import', 'tar_configs', 'squash', 'export']
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Differences below these are noise, whatever the tolerance
+NOISE_FLOORS = {'wall_seconds': 0.1, 'peak_rss_mib': 5, 'peak_temp_bytes': 1024 ** 2}
+
+# Metrics that depend on the CPU, disks and Python of the host, only compared on the host of the baseline
+HOST_METRICS = ['wall_seconds', 'peak_rss_mib']
+
+
+class DiskSampler:
+    """
+    Samples the disk space a stage uses below a directory in a background thread and keeps the peak.
+
+    Every file is counted once, however many hard links it has. Files that were there before
+    the stage started, e.g. the output of the untimed setup, are not counted, and neither are
+    files linked in from a cache unless the stage wrote them, e.g. packages it downloaded.
+    """
+
+    def __init__(self, path, interval=0.02):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.existing = set()
+        self.start_ns = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def files(self):
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    yield os.lstat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+
+    def disk_use(self):
+        sizes = {}
+        for file_stat in self.files():
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            if inode in self.existing or (file_stat.st_nlink > 1 and file_stat.st_mtime_ns < self.start_ns):
+                continue
+            sizes[inode] = file_stat.st_blocks * 512
+        return sum(sizes.values())
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, self.disk_use())
+            if self.stopped.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.existing = {(file_stat.st_dev, file_stat.st_ino) for file_stat in self.files()}
+        # File timestamps come from a coarse clock and may lag behind time.time_ns()
+        self.start_ns = time.time_ns() - 10 ** 9
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process, so the untimed setup is not measured.
+
+    Raises:
+        click.ClickException: If the kernel can not reset it, it needs Linux 4.0 or later.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError as e:
+        raise click.ClickException(f"Can not reset the peak RSS, the benchmarks need Linux 4.0 or later: {e}")
+
+
+def peak_rss_mib():
+    """
+    Get the peak resident set size of this process since reset_peak_rss().
+
+    Child processes, e.g. git and the compressors, are not included.
+
+    Returns:
+        float: Peak RSS in MiB
+    """
+    with open('/proc/self/status', 'r') as file:
+        for line in file:
+            if line.startswith('VmHWM:'):
+                # VmHWM is in kB
+                return int(line.split()[1]) / 1024
+    raise click.ClickException("Can not read the peak RSS from /proc/self/status")
+
+
+def run_stage(stage, fixture_dir, output_dir):
+    """
+    Run one stage against an imported fixture and measure it.
+
+    Runs in a fresh process per stage, started by run_scenario(), with HOME and TMPDIR
+    pointing to the scenario. Peak RSS and temporary disk use only cover the timed call,
+    not the setup before it, see peak_rss_mib() and DiskSampler.
+
+    Args:
+        stage (str): One of STAGES
+        fixture_dir (str): Directory of the generated fixture
+        output_dir (str): Directory for the exported tarball, outside of TMPDIR
+
+    Returns:
+        dict: wall_seconds, input_bytes, output_bytes, peak_temp_bytes and peak_rss_mib of the stage
+    """
+    from osconfiglib import layer_index, layers, package_cache
+
+    with open(os.path.join(fixture_dir, 'params.json'), 'r') as file:
+        params = json.load(file)
+    data = fixtures.recipe(fixture_dir, params)
+    tmp_dir = tempfile.mkdtemp()
+    input_bytes = fixtures.input_bytes(params)
+
+    # Untimed setup, the layers are already in the cache unless this is the import stage
+    if stage != 'import' and not layers.import_layers(data):
+        raise click.ClickException("Importing the fixture failed, run the import stage first")
+
+    if stage == 'import':
+        def call():
+            layers.import_layers(data)
+
+        def output():
+            return sum(entry['size'] for entry in layer_index.list_indexed_layers())
+    elif stage == 'tar_configs':
+        output_file = os.path.join(tmp_dir, 'configs.tar')
+
+        def call():
+            layers.tar_configs(layers.merge_configs(data['layer']), output_file)
+
+        def output():
+            return os.path.getsize(output_file)
+    elif stage == 'squash':
+        squashed = {}
+
+        def call():
+            squashed.update(layers.squash_layers(data['layer'], tmp_dir, use_cache=False))
+
+        def output():
+            return os.path.getsize(squashed['configs'])
+    elif stage == 'export':
+        squashed = layers.squash_layers(data['layer'], tmp_dir)
+        # rpm and deb bundles need dnf, apt and createrepo, synthetic wheels go through the same
+        # download, cache and streaming path from file:// URLs instead
+        wheel_dir = os.path.abspath(os.path.join(fixture_dir, 'wheels'))
+        packages = [{'filename': filename, 'url': f"file://{wheel_dir}/{filename}",
+                     'sha256': package_cache.file_sha256(os.path.join(wheel_dir, filename))}
+                    for filename in sorted(os.listdir(wheel_dir))]
+        names = [package['filename'].split('-')[0] for package in packages]
+        squashed = dict(squashed, rpm_requirements=[], deb_requirements=[], pip_requirements=names)
+        # The wheels are pure Python, any target will do
+        pip_target = {'python_version': '3.11', 'platforms': ['manylinux2014_x86_64']}
+        manifest = {'pip': {'requirements': names, 'target': pip_target, 'packages': packages}}
+        shutil.rmtree(package_cache.cache_dir('whl'), ignore_errors=True)
+
+        output_file = os.path.join(output_dir, 'export.tar.gz')
+        input_bytes += params['packages'] * params['package_size']
+
+        def call():
+            layers.export_squashed_layer(squashed, output_file, tmp_dir, manifest=manifest, pip_target=pip_target)
+
+        def output():
+            return os.path.getsize(output_file)
+    else:
+        raise click.BadParameter(f"Unknown stage '{stage}', expected one of {', '.join(STAGES)}")
+
+    with DiskSampler(tempfile.gettempdir()) as sampler:
+        reset_peak_rss()
+        start = time.perf_counter()
+        call()
+        wall_seconds = time.perf_counter() - start
+
+    return {
+        'wall_seconds': wall_seconds,
+        'input_bytes': input_bytes,
+        'output_bytes': output(),
+        'peak_temp_bytes': sampler.peak,
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+
+def run_scenario(name, params, work_dir, stages=STAGES, repeat=3, verbose=False):
+    """
+    Generate a fixture and benchmark the stages against it.
+
+    Every stage runs repeat times, each in a new process. The import stage starts
+    from an empty cache, later stages use the layers it imported.
+
+    Args:
+        name (str): Name of the scenario
+        params (dict): Scenario parameters, see SCENARIOS
+        work_dir (str): Directory for fixtures, the cache and temporary files
+        stages (list): Stages to run, in order
+        repeat (int): Number of runs per stage
+        verbose (bool): Show the output of the stages
+
+    Returns:
+        dict: Results with the median of every metric per stage
+    """
+    scenario_dir = os.path.join(work_dir, name)
+    fixture_dir = os.path.join(scenario_dir, 'fixture')
+    home = os.path.join(scenario_dir, 'home')
+    click.echo(f"Generating fixture for scenario {name}")
+    fixtures.generate(fixture_dir, params)
+
+    results = {'scenario': name, 'params': params, 'host': host_info(), 'stages': {}}
+    for stage in stages:
+        runs = []
+        for _ in range(repeat):
+            if stage == 'import':
+                shutil.rmtree(os.path.join(home, '.cache'), ignore_errors=True)
+            tmp = os.path.join(scenario_dir, 'tmp')
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            os.makedirs(home, exist_ok=True)
+
+            result_file = os.path.join(scenario_dir, 'result.json')
+            env = dict(os.environ, HOME=home, TMPDIR=tmp)
+            command = [sys.executable, '-m', 'benchmarks.bench', 'stage', stage, fixture_dir, result_file]
+            output = None if verbose else subprocess.DEVNULL
+            process = subprocess.run(command, env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     stdout=output, stderr=None if verbose else subprocess.PIPE, universal_newlines=True)
+            if process.returncode != 0:
+                raise click.ClickException(f"Stage {stage} of scenario {name} failed:\n{process.stderr or ''}")
+            with open(result_file, 'r') as file:
+                runs.append(json.load(file))
+
+        summary = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+        summary['throughput_mib_s'] = summary['input_bytes'] / 1024 ** 2 / summary['wall_seconds']
+        summary['runs'] = [run['wall_seconds'] for run in runs]
+        results['stages'][stage] = summary
+    return results
+
+
+def host_info():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def print_results(results):
+    click.echo(f"\nScenario {results['scenario']}: {json.dumps(results['params'], sort_keys=True)}")
+    click.echo(f"{'stage':<12} {'wall s':>9} {'MiB/s':>9} {'RSS MiB':>9} {'temp MiB':>9} {'out MiB':>9}")
+    for stage, summary in results['stages'].items():
+        click.echo(f"{stage:<12} {summary['wall_seconds']:>9.3f} {summary['throughput_mib_s']:>9.1f} "
+                   f"{summary['peak_rss_mib']:>9.1f} {summary['peak_temp_bytes'] / 1024 ** 2:>9.1f} "
+                   f"{summary['output_bytes'] / 1024 ** 2:>9.1f}")
+
+
+def compare(results, baseline, tolerance, across_hosts=False):
+    """
+    Compare results with a baseline.
+
+    Args:
+        results (dict): Results of run_scenario()
+        baseline (dict): Earlier results of the same scenario
+        tolerance (float): Allowed relative increase of wall time, peak RSS and temp disk use
+        across_hosts (bool): Also compare HOST_METRICS if the baseline was recorded on another host
+
+    Returns:
+        list: Descriptions of the regressions
+    """
+    if baseline['params'] != results['params']:
+        return [f"The baseline of {results['scenario']} was recorded with other parameters, record it again"]
+    metrics = list(NOISE_FLOORS)
+    if baseline['host'] != results['host']:
+        click.echo(f"Note: the baseline of {results['scenario']} was recorded on another host ({json.dumps(baseline['host'], sort_keys=True)})")
+        if not across_hosts:
+            click.echo(f"Skipping {', '.join(HOST_METRICS)}, they are not comparable between hosts")
+            metrics = [metric for metric in metrics if metric not in HOST_METRICS]
+
+    regressions = []
+    for stage, summary in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        for metric in metrics:
+            floor = NOISE_FLOORS[metric]
+            before, after = baseline['stages'][stage][metric], summary[metric]
+            if after - before > max(floor, before * tolerance):
+                regressions.append(f"{stage} {metric}: {before:.3f} -> {after:.3f} (+{(after / before - 1) * 100 if before else 100:.0f}%)")
+    return regressions
+
+
+@click.group()
+def cli():
+    pass
+
+
+@click.command()
+@click.option('--scenario', '-s', 'scenarios', type=click.Choice(list(SCENARIOS)), multiple=True, default=['small'],
+              help='Scenario to run, may be given several times.')
+@click.option('--stage', 'stages', type=click.Choice(STAGES), multiple=True, default=STAGES, help='Stage to run, may be given several times.')
+@click.option('--repeat', '-r', type=click.IntRange(min=1), default=3, help='Runs per stage, the median is reported.')
+@click.option('--work-dir', default=os.path.join(tempfile.gettempdir(), 'osconfiglib-bench'), help='Directory for fixtures and caches.')
+@click.option('--save-baseline', is_flag=True, help='Store the results as the new baselines.')
+@click.option('--tolerance', type=float, default=0.25, help='Allowed relative regression against the baseline.')
+@click.option('--across-hosts', is_flag=True, help='Compare wall time and peak RSS with baselines recorded on another host too.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Also write all results to this JSON file.')
+@click.option('--verbose', '-v', is_flag=True, help='Show the output of the stages.')
+def run(scenarios,stages,repeat,work_dir,save_baseline,tolerance,across_hosts,output,verbose):
+    all_results = []
+    regressions = []
+    for name in scenarios:
+        results = run_scenario(name, SCENARIOS[name], work_dir, [stage for stage in STAGES if stage in stages], repeat, verbose)
+        all_results.append(results)
+        print_results(results)
+
+        baseline_file = os.path.join(BASELINE_DIR, f"{name}.json")
+        if save_baseline:
+            os.makedirs(BASELINE_DIR, exist_ok=True)
+            with open(baseline_file, 'w') as file:
+                json.dump(results, file, indent=1, sort_keys=True)
+                file.write("\n")
+            click.echo(f"Saved baseline {baseline_file}")
+        elif os.path.exists(baseline_file):
+            with open(baseline_file, 'r') as file:
+                regressions += compare(results, json.load(file), tolerance, across_hosts)
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(all_results, file, indent=1, sort_keys=True)
+    if regressions:
+        click.echo("\nRegressions against the baseline:")
+        for regression in regressions:
+            click.echo(f"  {regression}")
+        sys.exit(1)
+cli.add_command(run, name='run')
+
+
+@click.command()
+@click.argument('stage', type=click.Choice(STAGES))
+@click.argument('fixture_dir')
+@click.argument('result_file')
+def stage(stage,fixture_dir,result_file):
+    result = run_stage(stage, fixture_dir, os.path.dirname(os.path.abspath(result_file)))
+    with open(result_file, 'w') as file:
+        json.dump(result, file)
+cli.add_command(stage, name='stage')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,175 @@
+# File: benchmarks/fixtures.py
+import base64
+import json
+import os
+import random
+import shutil
+import subprocess
+
+# Share of the config paths that every layer provides, so later layers override earlier ones
+SHARED_CONFIG_RATIO = 0.1
+
+# Share of the requirements that are the same in every layer, the rest is unique per layer
+SHARED_REQUIREMENT_RATIO = 0.5
+
+GIT = ['git', '-c', 'user.name=osconfiglib-bench', '-c', 'user.email=bench@example.com', '-c', 'init.defaultBranch=main']
+
+
+def random_bytes(rng, size):
+    # random.Random.randbytes() needs Python 3.9
+    return rng.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+
+
+def config_content(rng, size):
+    """
+    Generate the content of a synthetic config file.
+
+    Half of the content is random and half is repeated text, so the files compress
+    roughly like real configuration files.
+
+    Args:
+        rng (random.Random): Random generator of the fixture
+        size (int): Size of the file in bytes
+
+    Returns:
+        bytes: The content
+    """
+    random_part = base64.b64encode(random_bytes(rng, size // 2))[:size // 2]
+    text = b"option = value\n" * (size // 15 + 1)
+    return (random_part + text)[:size]
+
+
+def write_layer(path, index, params, rng):
+    """
+    Write the files of a synthetic layer.
+
+    Args:
+        path (str): Directory of the layer
+        index (int): Number of the layer
+        params (dict): Scenario parameters, see bench.SCENARIOS
+        rng (random.Random): Random generator of the fixture
+    """
+    shared = int(params['config_files'] * SHARED_CONFIG_RATIO)
+    for number in range(params['config_files']):
+        directory = 'shared' if number < shared else f"layer-{index:03d}"
+        config = os.path.join(path, 'configs', 'etc', directory, f"file-{number:05d}.conf")
+        os.makedirs(os.path.dirname(config), exist_ok=True)
+        with open(config, 'wb') as file:
+            file.write(config_content(rng, params['config_size']))
+
+    os.makedirs(os.path.join(path, 'scripts'), exist_ok=True)
+    for number in range(params['scripts']):
+        with open(os.path.join(path, 'scripts', f"{number:02d}-step.sh"), 'w') as file:
+            file.write(f"#!/bin/bash\n# Step {number} of layer {index}\necho 'layer {index} step {number}'\n")
+
+    os.makedirs(os.path.join(path, 'package-lists'), exist_ok=True)
+    shared = int(params['requirements'] * SHARED_REQUIREMENT_RATIO)
+    names = [f"package-{number:05d}" if number < shared else f"package-{index:03d}-{number:05d}"
+             for number in range(params['requirements'])]
+    for kind in ['rpm', 'deb', 'pip']:
+        with open(os.path.join(path, 'package-lists', f"{kind}-requirements.txt"), 'w') as file:
+            file.write("\n".join(names) + "\n")
+
+
+def create_remote(source, remote):
+    """
+    Commit a layer directory and publish it as a local bare repository.
+
+    Args:
+        source (str): Directory of the layer
+        remote (str): Path of the bare repository to create
+    """
+    subprocess.run(GIT + ['init', '--quiet', source], check=True)
+    subprocess.run(GIT + ['-C', source, 'add', '.'], check=True)
+    subprocess.run(GIT + ['-C', source, 'commit', '--quiet', '-m', 'Synthetic layer'], check=True)
+    subprocess.run(GIT + ['clone', '--quiet', '--bare', source, remote], check=True)
+
+
+def write_wheels(directory, params, rng):
+    """
+    Write synthetic wheels that stand in for downloaded packages.
+
+    Args:
+        directory (str): Directory the wheels are written to
+        params (dict): Scenario parameters, see bench.SCENARIOS
+        rng (random.Random): Random generator of the fixture
+
+    Returns:
+        list: File names of the wheels
+    """
+    os.makedirs(directory, exist_ok=True)
+    filenames = []
+    for number in range(params['packages']):
+        filename = f"package_{number:05d}-1.0-py3-none-any.whl"
+        # Packages are already compressed, so their content is random
+        with open(os.path.join(directory, filename), 'wb') as file:
+            file.write(random_bytes(rng, params['package_size']))
+        filenames.append(filename)
+    return filenames
+
+
+def generate(fixture_dir, params):
+    """
+    Generate the layer repositories and packages of a scenario.
+
+    The fixture is reused if it was generated with the same parameters before.
+
+    Args:
+        fixture_dir (str): Directory of the fixture
+        params (dict): Scenario parameters, see bench.SCENARIOS
+
+    Returns:
+        dict: The recipe importing every layer from its bare repository
+    """
+    params_file = os.path.join(fixture_dir, 'params.json')
+    if os.path.exists(params_file):
+        with open(params_file, 'r') as file:
+            if json.load(file) == params:
+                return recipe(fixture_dir, params)
+    shutil.rmtree(fixture_dir, ignore_errors=True)
+
+    rng = random.Random(params.get('seed', 0))
+    for index in range(params['layers']):
+        source = os.path.join(fixture_dir, 'sources', f"layer-{index:03d}")
+        write_layer(source, index, params, rng)
+        create_remote(source, os.path.join(fixture_dir, 'remotes', f"layer-{index:03d}.git"))
+    write_wheels(os.path.join(fixture_dir, 'wheels'), params, rng)
+
+    with open(params_file, 'w') as file:
+        json.dump(params, file, indent=1, sort_keys=True)
+    return recipe(fixture_dir, params)
+
+
+def recipe(fixture_dir, params):
+    """
+    Build the recipe of a generated fixture.
+
+    Args:
+        fixture_dir (str): Directory of the fixture
+        params (dict): Scenario parameters, see bench.SCENARIOS
+
+    Returns:
+        dict: The parsed recipe
+    """
+    remotes = os.path.abspath(os.path.join(fixture_dir, 'remotes'))
+    return {
+        'name': 'bench',
+        'version': '1.0.0',
+        'layer': [
+            {'name': f"layer-{index:03d}", 'type': 'git', 'url': f"file://{remotes}/layer-{index:03d}.git", 'branch_or_tag': 'main'}
+            for index in range(params['layers'])
+        ],
+    }
+
+
+def input_bytes(params):
+    """
+    Get the size of the config files of a scenario.
+
+    Args:
+        params (dict): Scenario parameters, see bench.SCENARIOS
+
+    Returns:
+        int: Total size of the config files of all layers in bytes
+    """
+    return params['layers'] * params['config_files'] * params['config_size']
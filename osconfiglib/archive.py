@@ -0,0 +1,278 @@
+# File: osconfiglib/archive.py
+import contextlib
+import gzip
+import io
+import lzma
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+
+# Compression backends for exported archives
+COMPRESSIONS = ['none', 'gz', 'xz', 'zst']
+
+EXTENSIONS = {
+    'none': '.tar',
+    'gz': '.tar.gz',
+    'xz': '.tar.xz',
+    'zst': '.tar.zst',
+}
+
+# Compression levels every backend of a compression accepts, zstd needs --ultra above 19
+COMPRESSION_LEVELS = {
+    'gz': (0, 9),
+    'xz': (0, 9),
+    'zst': (1, 22),
+}
+
+# Multi-threaded compressors, used when they are installed
+THREADED_COMPRESSORS = {
+    'gz': ['pigz', '-c'],
+    'xz': ['xz', '-c', '-T0'],
+    'zst': ['zstd', '-c', '-q', '-T0'],
+}
+
+
+def archive_extension(compression):
+    """
+    Get the file extension of an archive.
+
+    Args:
+        compression (str): One of COMPRESSIONS
+
+    Returns:
+        str: The extension, including the leading dot
+    """
+    return EXTENSIONS[compression]
+
+
+def check_compression_level(compression, level):
+    """
+    Check that a compression level is valid for a compression.
+
+    Args:
+        compression (str): One of COMPRESSIONS
+        level (int): Compression level, None selects the backend default and is always valid.
+            Uncompressed archives ignore the level.
+
+    Raises:
+        ValueError: If the compression does not support the level.
+    """
+    if level is None or compression not in COMPRESSION_LEVELS:
+        return
+    low, high = COMPRESSION_LEVELS[compression]
+    if not low <= level <= high:
+        raise ValueError(f"Compression level {level} is out of range for {compression}, expected {low} to {high}")
+
+
+def compressor_command(compression, level=None, reproducible=False):
+    """
+    Get the command of the multi-threaded compressor for a compression.
+
+    Args:
+        compression (str): One of COMPRESSIONS
+        level (int): Compression level, the compressor default is used if None
+        reproducible (bool): Leave the file name and timestamp out of the gzip header
+
+    Returns:
+        list: The command, or None if no multi-threaded compressor is installed
+    """
+    command = THREADED_COMPRESSORS.get(compression)
+    if command is None or shutil.which(command[0]) is None:
+        return None
+    if level is not None:
+        command = command + (['--ultra'] if compression == 'zst' and level > 19 else []) + [f"-{level}"]
+    if reproducible and compression == 'gz':
+        command = command + ['-n']
+    return command
+
+
+def source_date_epoch():
+    """
+    Get the timestamp used for the entries of reproducible archives.
+
+    Returns:
+        int: The value of the SOURCE_DATE_EPOCH environment variable, or 0 if it is not set
+    """
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+
+def normalize_tarinfo(info):
+    """
+    Strip the metadata that differs between builds from an archive entry.
+
+    Owners are reset to root, the modification time is set to source_date_epoch()
+    and permissions are reduced to 0644 or 0755 depending on the executable bit.
+
+    Args:
+        info (tarfile.TarInfo): The entry to normalize
+
+    Returns:
+        tarfile.TarInfo: The normalized entry
+    """
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.mtime = source_date_epoch()
+    if info.isdir() or info.mode & 0o111:
+        info.mode = 0o755
+    else:
+        info.mode = 0o644
+    return info
+
+
+def add_path(tar, path, arcname, reproducible=False):
+    """
+    Add a file or directory to an archive.
+
+    Args:
+        tar (tarfile.TarFile): The archive
+        path (str): Path to the file or directory
+        arcname (str): Name of the entry in the archive
+        reproducible (bool): Add directory entries in sorted order and normalize their metadata
+    """
+    if not reproducible:
+        tar.add(path, arcname=arcname)
+        return
+
+    tar.add(path, arcname=arcname, recursive=False, filter=normalize_tarinfo)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            add_path(tar, os.path.join(path, name), f"{arcname}/{name}", reproducible)
+
+
+def add_bytes(tar, arcname, data, mode=0o644, reproducible=False):
+    """
+    Add a file to an archive from memory.
+
+    Args:
+        tar (tarfile.TarFile): The archive
+        arcname (str): Name of the entry in the archive
+        data (bytes): Content of the file
+        mode (int): Permissions of the file
+        reproducible (bool): Normalize the metadata of the entry
+    """
+    info = tarfile.TarInfo(arcname)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = int(time.time())
+    if reproducible:
+        info = normalize_tarinfo(info)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def add_directory(tar, arcname, reproducible=False):
+    """
+    Add an empty directory entry to an archive.
+
+    Args:
+        tar (tarfile.TarFile): The archive
+        arcname (str): Name of the entry in the archive
+        reproducible (bool): Normalize the metadata of the entry
+    """
+    info = tarfile.TarInfo(arcname)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    info.mtime = int(time.time())
+    if reproducible:
+        info = normalize_tarinfo(info)
+    tar.addfile(info)
+
+
+class HashingWriter:
+    """
+    File object wrapper that feeds everything written through it into a hash.
+    """
+
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def compressed_stream(file, compression, level=None, reproducible=False):
+    """
+    Wrap an output file with a compressor.
+
+    Args:
+        file: Binary file object the compressed data is written to
+        compression (str): One of COMPRESSIONS
+        level (int): Compression level, the backend default is used if None
+        reproducible (bool): Leave the file name and timestamp out of the gzip header
+
+    Yields:
+        A writable binary file object
+    """
+    if compression == 'none':
+        yield file
+        return
+
+    command = compressor_command(compression, level, reproducible)
+    if command is not None:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=file)
+        try:
+            yield process.stdin
+        finally:
+            process.stdin.close()
+            process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return
+
+    if compression == 'gz':
+        with gzip.GzipFile(filename='', mode='wb', fileobj=file, compresslevel=9 if level is None else level,
+                           mtime=0 if reproducible else None) as stream:
+            yield stream
+    elif compression == 'xz':
+        with lzma.LZMAFile(file, 'w', preset=level) as stream:
+            yield stream
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zst compression requires the zstd command or the zstandard module")
+
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=-1)
+        with compressor.stream_writer(file, closefd=False) as stream:
+            yield stream
+
+
+@contextlib.contextmanager
+def open_archive(output_file, compression='gz', level=None, reproducible=False, digest=None):
+    """
+    Open a tar archive for writing with the selected compression.
+
+    A multi-threaded compressor (pigz, xz -T0 or zstd -T0) is used when it is
+    installed, otherwise compression falls back to the Python standard library,
+    or the zstandard module for zst.
+
+    Args:
+        output_file (str): Path to the archive to create
+        compression (str): One of COMPRESSIONS. Default is 'gz'.
+        level (int): Compression level, the backend default is used if None
+        reproducible (bool): Write a compression header that does not depend on the time of the export
+        digest: Optional hashlib object that is updated with the uncompressed archive
+
+    Yields:
+        tarfile.TarFile: The archive, opened in stream mode
+
+    Raises:
+        ValueError: If the compression is unknown or does not support the level.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression '{compression}', expected one of {', '.join(COMPRESSIONS)}")
+    check_compression_level(compression, level)
+
+    with open(output_file, 'wb') as file:
+        with compressed_stream(file, compression, level, reproducible) as stream:
+            if digest is not None:
+                stream = HashingWriter(stream, digest)
+            with tarfile.open(fileobj=stream, mode='w|') as tar:
+                yield tar
@@ -0,0 +1,238 @@
+# File: osconfiglib/cache_gc.py
+import os
+import re
+import shutil
+import time
+
+import toml
+
+from osconfiglib import layer_index, layers, package_cache, squash_cache
+
+# Temporary artifacts younger than this may still be in use by a running export
+TEMP_GRACE_SECONDS = 3600
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size):
+    """
+    Parse a human readable size.
+
+    Args:
+        size (str): A number of bytes with an optional K, M, G or T suffix, e.g. '20G'
+
+    Returns:
+        int: The size in bytes
+
+    Raises:
+        ValueError: If the size can not be parsed.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size '{size}'")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size):
+    """
+    Format a number of bytes for humans.
+
+    Args:
+        size (int): Size in bytes
+
+    Returns:
+        str: The size with a binary unit, e.g. '1.5 GiB'
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def recipe_layer_dirs(recipe_path):
+    """
+    Get the cache directories of the layers a recipe references.
+
+    Args:
+        recipe_path (str): Path to the TOML recipe
+
+    Returns:
+        set: Directory names in the cache that must not be collected
+    """
+    with open(recipe_path, 'r') as file:
+        data = toml.load(file)
+
+    dir_names = set()
+    for layer in data.get('layer', []):
+        if layer.get('type') == 'git':
+            # Imports fall back to master when the branch does not exist
+            for branch in {layer.get('branch_or_tag', 'main'), 'main', 'master'}:
+                dir_names.add(layers.git_to_dir_name(layer['url'], branch))
+        else:
+            dir_names.add(layer['name'])
+    return dir_names
+
+
+def collect_layers(max_bytes=None, max_age_days=None, keep=(), include_local=False):
+    """
+    Remove cached layers that were not used recently.
+
+    Layers not used for max_age_days are removed first, then the least recently used
+    layers until the layers fit in max_bytes. The last use is recorded in the layer
+    index whenever a recipe imports a layer.
+
+    Only git layers are removed by default, they can be cloned again. Local layers
+    created with create_layer() exist nowhere else.
+
+    Args:
+        max_bytes (int): Size budget of the layers that may be removed, not enforced if None
+        max_age_days (float): Maximum number of days since a layer was last used, not enforced if None
+        keep (set): Directory names of layers that are never removed
+        include_local (bool): Also remove local layers
+
+    Returns:
+        int: Number of bytes reclaimed
+    """
+    entries = [entry for entry in layer_index.list_indexed_layers() if include_local or entry.get('type') == 'git']
+    entries.sort(key=lambda entry: entry['last_used'])
+    total = sum(entry['size'] for entry in entries)
+    cutoff = None if max_age_days is None else time.time() - max_age_days * 86400
+
+    reclaimed = 0
+    for entry in entries:
+        too_old = cutoff is not None and entry['last_used'] < cutoff
+        too_big = max_bytes is not None and total > max_bytes
+        if entry['name'] in keep or not (too_old or too_big):
+            continue
+        print(f"Removing layer {entry['name']}")
+        shutil.rmtree(os.path.join(layer_index.cache_root(), entry['name']), ignore_errors=True)
+        layer_index.remove_layer(entry['name'])
+        total -= entry['size']
+        reclaimed += entry['size']
+    return reclaimed
+
+
+def collect_object_stores():
+    """
+    Remove shared object stores of reference clones that no cached layer uses anymore.
+
+    Returns:
+        int: Number of bytes reclaimed
+    """
+    stores_dir = os.path.join(layer_index.cache_root(), '.objects')
+    if not os.path.isdir(stores_dir):
+        return 0
+
+    used = set()
+    for entry in os.scandir(layer_index.cache_root()):
+        alternates = os.path.join(entry.path, '.git', 'objects', 'info', 'alternates')
+        if entry.is_dir() and not entry.name.startswith('.') and os.path.exists(alternates):
+            with open(alternates, 'r') as file:
+                used.update(os.path.realpath(os.path.dirname(line.strip())) for line in file if line.strip())
+
+    reclaimed = 0
+    for entry in os.scandir(stores_dir):
+        if entry.is_dir() and os.path.realpath(entry.path) not in used:
+            print(f"Removing unused object store {entry.name}")
+            reclaimed += layer_index.directory_size(entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+    return reclaimed
+
+
+def collect_temp_artifacts():
+    """
+    Remove staging directories and partial files left behind by interrupted runs.
+
+    Returns:
+        int: Number of bytes reclaimed
+    """
+    root = layer_index.cache_root()
+    candidates = []
+    for directory in [root, squash_cache.cache_dir(), os.path.join(root, '.inventory')]:
+        if os.path.isdir(directory):
+            candidates += [entry.path for entry in os.scandir(directory) if entry.name.endswith('.tmp')]
+    # Squash entries are staged in hidden directories
+    if os.path.isdir(squash_cache.cache_dir()):
+        candidates += [entry.path for entry in os.scandir(squash_cache.cache_dir()) if entry.is_dir() and entry.name.startswith('.')]
+    # Packages are downloaded and wheels built in temporary directories next to the cache
+    packages_dir = os.path.join(root, '.packages')
+    if os.path.isdir(packages_dir):
+        for type_dir in os.scandir(packages_dir):
+            if type_dir.is_dir():
+                candidates += [entry.path for entry in os.scandir(type_dir.path)
+                               if entry.name.startswith('tmp') or entry.name.endswith('.tmp')]
+
+    reclaimed = 0
+    cutoff = time.time() - TEMP_GRACE_SECONDS
+    for path in candidates:
+        if os.lstat(path).st_mtime > cutoff:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            reclaimed += layer_index.directory_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            reclaimed += os.lstat(path).st_size
+            os.remove(path)
+    return reclaimed
+
+
+def collect_inventories(max_age_days=None):
+    """
+    Remove cached image inventories.
+
+    Args:
+        max_age_days (float): Maximum age of an inventory in days, all are removed if None
+
+    Returns:
+        int: Number of bytes reclaimed
+    """
+    inventory_dir = os.path.join(layer_index.cache_root(), '.inventory')
+    if not os.path.isdir(inventory_dir):
+        return 0
+    cutoff = None if max_age_days is None else time.time() - max_age_days * 86400
+    reclaimed = 0
+    for entry in os.scandir(inventory_dir):
+        if entry.name.endswith('.json') and (cutoff is None or entry.stat().st_mtime < cutoff):
+            reclaimed += entry.stat().st_size
+            os.remove(entry.path)
+    return reclaimed
+
+
+def collect(max_bytes=None, max_age_days=None, recipe_path=None, include_local=False,
+            max_squash_bytes=squash_cache.DEFAULT_MAX_BYTES, max_package_bytes=package_cache.DEFAULT_MAX_BYTES):
+    """
+    Garbage collect ~/.cache/osconfiglib.
+
+    Cached git layers are kept within max_bytes and max_age_days, least recently used first,
+    except the layers referenced by recipe_path. Local layers are only removed with include_local.
+    Every cache has a size budget of its own: the squash cache is trimmed to max_squash_bytes and
+    the package cache of every package type to max_package_bytes, both also to max_age_days.
+    Unused shared object stores and leftover temporary artifacts are removed.
+
+    Args:
+        max_bytes (int): Size budget of the cached layers only, not enforced if None
+        max_age_days (float): Maximum number of days since a layer, squash, package or image inventory was last used
+        recipe_path (str): Recipe whose layers must be kept
+        include_local (bool): Also remove local layers, they can not be restored
+        max_squash_bytes (int): Size budget of the squash cache, not enforced if None
+        max_package_bytes (int): Size budget of the package cache of each package type, not enforced if None
+
+    Returns:
+        dict: Number of bytes reclaimed per category
+    """
+    keep = recipe_layer_dirs(recipe_path) if recipe_path else set()
+    reclaimed = {
+        'layers': collect_layers(max_bytes, max_age_days, keep, include_local),
+        'object stores': collect_object_stores(),
+        'squash cache': squash_cache.evict(max_squash_bytes, max_age_days),
+        'package cache': sum(package_cache.evict(package_type, max_package_bytes, max_age_days)
+                             for package_type in ['rpm', 'deb', 'whl']),
+        'image inventories': collect_inventories(max_age_days) if max_age_days is not None else 0,
+        'temporary files': collect_temp_artifacts(),
+    }
+
+    for category, size in reclaimed.items():
+        print(f"{category:<20} {format_size(size):>12}")
+    print(f"{'total':<20} {format_size(sum(reclaimed.values())):>12}")
+    return reclaimed
@@ -1,11 +1,26 @@
 # osconfiglib/cli/main.py
+import os
 import click
-from osconfiglib import layers, utils, virt_customize, package_handler
+from osconfiglib import archive, cache_gc, layers, utils, virt_customize, package_cache, package_handler, squash_cache
 
 @click.group()
 def cli():
     pass
 
+def validate_compression_level(ctx, param, value):
+    # --compression is eager, so it is parsed before the level even if it is given after it
+    try:
+        archive.check_compression_level(ctx.params.get('compression', 'gz'), value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
+
+def pip_target_option(pip_python_version, pip_platform):
+    # Wheels are only resolved for a fully known target, never for the host
+    if bool(pip_python_version) != bool(pip_platform):
+        raise click.BadParameter('--pip-python-version and --pip-platform must be given together.')
+    return {'python_version': pip_python_version, 'platforms': list(pip_platform)} if pip_python_version else None
+
 @click.command()
 @click.option('--version', is_flag=True, help='Show the version and exit.')
 def version():
@@ -49,15 +64,14 @@ cli.add_command(create_layer, name='create-layer')
 @click.command()
 @click.argument('url')
 @click.argument('branch', required=False, default="main")
-def import_layer(url, branch):
+@click.option('--clone-mode', type=click.Choice(layers.CLONE_MODES), default='full', help='How much of the repository to fetch.')
+@click.option('--reference', is_flag=True, help='Share git objects between branches of the same repository.')
+@click.option('--refresh', is_flag=True, help='Fetch and fast-forward the layer if it is already imported.')
+def import_layer(url, branch, clone_mode, reference, refresh):
     # Here you would call the functionality that creates a new layer
     click.echo(f'Importing layer from url: {url}.')
-    if branch == 'main':
-        if not layers.import_layer(repo_url=url):
-            exit(1)
-    else:
-        if not layers.import_layer(repo_url=url,branch=branch):
-            exit(1)
+    if not layers.import_layer(repo_url=url, branch=branch, clone_mode=clone_mode, reference=reference, refresh=refresh):
+        exit(1)
 cli.add_command(import_layer, name='import-layer')
 
 @click.command()
@@ -71,10 +85,30 @@ cli.add_command(delete_layer, name='delete')
 @click.command()
 @click.argument('recipe')
 @click.argument('output_dir')
-def export_squashed_configs(recipe,output_dir):
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=None, help='Number of layers to import in parallel.')
+@click.option('--clone-mode', type=click.Choice(layers.CLONE_MODES), default=None, help='How much of each layer repository to fetch.')
+@click.option('--reference/--no-reference', default=None, help='Share git objects between branches of the same repository.')
+@click.option('--refresh', is_flag=True, help='Fetch and fast-forward layers that are already imported.')
+@click.option('--no-cache', is_flag=True, help='Squash the layers again even if a cached result exists.')
+@click.option('--compression', type=click.Choice(archive.COMPRESSIONS), default='gz', is_eager=True, help='Compression of the exported tarball.')
+@click.option('--compression-level', type=int, default=None, callback=validate_compression_level,
+              help='Compression level (gz and xz 0-9, zst 1-22), the compressor default is used if not set.')
+@click.option('--reproducible', is_flag=True, help='Write a reproducible tarball named after the hash of its content.')
+@click.option('--download-jobs', type=click.IntRange(min=1), default=4, help='Number of packages to download in parallel.')
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Package manifest, or an earlier export, used to skip dependency resolution.')
+@click.option('--pip-python-version', default=None, help='Python version the wheels are resolved for, e.g. 3.11.')
+@click.option('--pip-platform', multiple=True,
+              help='Platform tag the wheels are resolved for, e.g. manylinux_2_34_x86_64. Can be given several times.')
+def export_squashed_configs(recipe,output_dir,jobs,clone_mode,reference,refresh,no_cache,compression,compression_level,reproducible,
+                            download_jobs,manifest,pip_python_version,pip_platform):
     # Here you would call the functionality that deletes a layer
     click.echo(f'Squashing configs for {recipe} and saving them to {output_dir}.')
-    layers.toml_export(recipe,output_dir)
+    if not layers.toml_export(recipe,output_dir,import_jobs=jobs,clone_mode=clone_mode,reference=reference,refresh=refresh,
+                              use_cache=not no_cache,compression=compression,compression_level=compression_level,
+                              reproducible=reproducible,download_jobs=download_jobs,manifest_path=manifest,
+                              pip_target=pip_target_option(pip_python_version,pip_platform)):
+        exit(1)
 cli.add_command(export_squashed_configs, name='export-squashed-configs')
 
 
@@ -82,11 +116,90 @@ cli.add_command(export_squashed_configs, name='export-squashed-configs')
 @click.argument('recipe')
 @click.argument('output_dir')
 @click.argument('qcow2_path')
-def export_upgrade(recipe,output_dir,qcow2_path):
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=None, help='Number of layers to import in parallel.')
+@click.option('--clone-mode', type=click.Choice(layers.CLONE_MODES), default=None, help='How much of each layer repository to fetch.')
+@click.option('--reference/--no-reference', default=None, help='Share git objects between branches of the same repository.')
+@click.option('--refresh', is_flag=True, help='Fetch and fast-forward layers that are already imported.')
+@click.option('--no-cache', is_flag=True, help='Squash the layers again even if a cached result exists.')
+@click.option('--compression', type=click.Choice(archive.COMPRESSIONS), default='gz', is_eager=True, help='Compression of the exported tarball.')
+@click.option('--compression-level', type=int, default=None, callback=validate_compression_level,
+              help='Compression level (gz and xz 0-9, zst 1-22), the compressor default is used if not set.')
+@click.option('--reproducible', is_flag=True, help='Write a reproducible tarball named after the hash of its content.')
+@click.option('--download-jobs', type=click.IntRange(min=1), default=4, help='Number of packages to download in parallel.')
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Package manifest, or an earlier export, used to skip dependency resolution.')
+@click.option('--delta', is_flag=True, help='Only bundle packages that are missing or outdated in the image.')
+@click.option('--pip-python-version', default=None, help='Python version the wheels are resolved for, taken from the image if not set.')
+@click.option('--pip-platform', multiple=True,
+              help='Platform tag the wheels are resolved for, e.g. manylinux_2_34_x86_64, taken from the image if not set.')
+def export_upgrade(recipe,output_dir,qcow2_path,jobs,clone_mode,reference,refresh,no_cache,compression,compression_level,reproducible,
+                   download_jobs,manifest,delta,pip_python_version,pip_platform):
     # Here you would call the functionality that deletes a layer
     click.echo(f'Squashing configs for {recipe} and saving them to {output_dir}.')
-    layers.toml_upgrade(recipe,output_dir, qcow2_path)
+    if not layers.toml_upgrade(recipe,output_dir, qcow2_path, import_jobs=jobs, clone_mode=clone_mode, reference=reference, refresh=refresh,
+                               use_cache=not no_cache, compression=compression, compression_level=compression_level,
+                               reproducible=reproducible, download_jobs=download_jobs, manifest_path=manifest, delta=delta,
+                               pip_target=pip_target_option(pip_python_version, pip_platform)):
+        exit(1)
 cli.add_command(export_upgrade, name='export-upgrade')
 
+
+@click.command()
+@click.argument('recipe')
+@click.argument('output_dir')
+@click.argument('base_images', nargs=-1, required=True)
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=None,
+              help='Number of images to customize in parallel, limited by the memory available for libguestfs.')
+@click.option('--python-version', default='python3', help='Python used for the virtual environment of pip requirements.')
+@click.option('--output-mode', type=click.Choice(virt_customize.OUTPUT_MODES), default='overlay', help='How the output images are created.')
+@click.option('--flatten', is_flag=True, help='Turn overlays into standalone images.')
+@click.option('--offline/--online', default=True, help='Install packages from a bundled repository or from the repositories of the guests.')
+@click.option('--download-jobs', type=click.IntRange(min=1), default=4, help='Number of packages to download in parallel.')
+@click.option('--timings', is_flag=True, help='Record how long every layer script and package install takes.')
+@click.option('--pip-python-version', default=None, help='Python version the wheels are resolved for, taken from the image if not set.')
+@click.option('--pip-platform', multiple=True,
+              help='Platform tag the wheels are resolved for, e.g. manylinux_2_34_x86_64, taken from the image if not set.')
+def apply_batch(recipe,output_dir,base_images,jobs,python_version,output_mode,flatten,offline,download_jobs,timings,
+                pip_python_version,pip_platform):
+    click.echo(f'Applying {recipe} to {len(base_images)} images in {output_dir}.')
+    recipe_name = os.path.splitext(os.path.basename(recipe))[0]
+    images = [(base_image, os.path.join(output_dir, f"{os.path.splitext(os.path.basename(base_image))[0]}-{recipe_name}.qcow2"))
+              for base_image in base_images]
+    # Output images are named after the base image, so base images from different directories may collide
+    outputs = [output_image for _, output_image in images]
+    clashing = [base_image for base_image, output_image in images if outputs.count(output_image) > 1]
+    if clashing:
+        raise click.BadParameter(f"{', '.join(clashing)} would be written to the same output image, rename them.",
+                                 param_hint='BASE_IMAGES')
+    results = virt_customize.toml_apply_batch(recipe, images, python_version, max_workers=jobs, output_mode=output_mode, flatten=flatten,
+                                               offline=offline, download_jobs=download_jobs, timings=timings,
+                                               pip_target=pip_target_option(pip_python_version, pip_platform))
+    if results is None or not all(result['success'] for result in results):
+        exit(1)
+cli.add_command(apply_batch, name='apply-batch')
+
+@click.command()
+@click.option('--max-size', default=None,
+              help='Size budget of the cached layers only, e.g. 20G. Least recently used layers are removed first.')
+@click.option('--max-squash-size', default=None,
+              help=f'Size budget of the squash cache, {cache_gc.format_size(squash_cache.DEFAULT_MAX_BYTES)} if not set.')
+@click.option('--max-package-size', default=None,
+              help=f'Size budget of the package cache of each package type, {cache_gc.format_size(package_cache.DEFAULT_MAX_BYTES)} if not set.')
+@click.option('--max-age', type=float, default=None, help='Remove layers, squashes, packages and image inventories not used for this many days.')
+@click.option('--recipe', type=click.Path(exists=True, dir_okay=False), default=None, help='Never remove the layers this recipe references.')
+@click.option('--include-local', is_flag=True, help='Also remove local layers. They exist nowhere else and can not be restored.')
+def gc(max_size,max_squash_size,max_package_size,max_age,recipe,include_local):
+    budgets = {}
+    for option, size, default in [('--max-size', max_size, None),
+                                  ('--max-squash-size', max_squash_size, squash_cache.DEFAULT_MAX_BYTES),
+                                  ('--max-package-size', max_package_size, package_cache.DEFAULT_MAX_BYTES)]:
+        try:
+            budgets[option] = cache_gc.parse_size(size) if size is not None else default
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint=option)
+    cache_gc.collect(budgets['--max-size'], max_age, recipe, include_local,
+                     max_squash_bytes=budgets['--max-squash-size'], max_package_bytes=budgets['--max-package-size'])
+cli.add_command(gc, name='gc')
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
@@ -0,0 +1,148 @@
+# File: osconfiglib/fingerprint.py
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+
+from osconfiglib import utils
+
+# Serializes stat cache updates between threads of the same process, other processes are kept out by a lock file
+stat_cache_lock = threading.Lock()
+
+# Files modified this recently may still change within the same timestamp, their digests are not cached
+RACY_SECONDS = 2
+
+
+def stat_cache_path():
+    """
+    Get the path of the stat cache.
+
+    Returns:
+        str: Path to the file mapping file paths and stat results to digests
+    """
+    return os.path.expanduser('~/.cache/osconfiglib/.fingerprints.json')
+
+
+def load_stat_cache():
+    """
+    Load the stat cache.
+
+    Returns:
+        dict: Mapping of absolute file path to [size, mtime_ns, inode, digest]
+    """
+    try:
+        with open(stat_cache_path(), 'r') as file:
+            return json.load(file)
+    except OSError:
+        return {}
+    except ValueError:
+        print(f"Ignoring corrupt stat cache {stat_cache_path()}")
+        return {}
+
+
+def save_stat_cache(stat_cache):
+    """
+    Save the stat cache.
+
+    Args:
+        stat_cache (dict): The cache returned by load_stat_cache()
+    """
+    utils.write_json_atomic(stat_cache_path(), stat_cache, sort_keys=True)
+
+
+def file_digest(path, file_stat, stat_cache):
+    """
+    Get the SHA-256 digest of a regular file, reading it only if it changed.
+
+    Args:
+        path (str): Absolute path to the file
+        file_stat (os.stat_result): Result of os.lstat() on the file
+        stat_cache (dict): The stat cache, updated in place
+
+    Returns:
+        str: Hex digest of the file content
+    """
+    key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+    cached = stat_cache.get(path)
+    if cached is not None and cached[:3] == key:
+        return cached[3]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    if file_stat.st_mtime < time.time() - RACY_SECONDS:
+        stat_cache[path] = key + [digest.hexdigest()]
+    else:
+        stat_cache.pop(path, None)
+    return digest.hexdigest()
+
+
+def tree_digest(path, stat_cache, seen):
+    """
+    Get the Merkle hash of a directory.
+
+    A directory is hashed over the sorted names, types and digests of its entries, so
+    the hash changes whenever a file below it is added, removed, renamed or modified,
+    or its executable bit changes. Symbolic links are hashed by their target.
+
+    Args:
+        path (str): Absolute path to the directory
+        stat_cache (dict): The stat cache, updated in place
+        seen (set): Paths of the files hashed, updated in place
+
+    Returns:
+        str: Hex digest of the directory
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        entry_path = os.path.join(path, name)
+        entry_stat = os.lstat(entry_path)
+        if stat.S_ISLNK(entry_stat.st_mode):
+            kind, entry_digest = 'link', hashlib.sha256(os.readlink(entry_path).encode()).hexdigest()
+        elif stat.S_ISDIR(entry_stat.st_mode):
+            kind, entry_digest = 'tree', tree_digest(entry_path, stat_cache, seen)
+        else:
+            kind = 'exec' if entry_stat.st_mode & 0o111 else 'file'
+            entry_digest = file_digest(entry_path, entry_stat, stat_cache)
+            seen.add(entry_path)
+        digest.update(f"{kind} {name}\0{entry_digest}\n".encode())
+    return digest.hexdigest()
+
+
+def fingerprint(root, dir_names):
+    """
+    Get the fingerprint of selected directories of a tree.
+
+    Files whose size, modification time and inode did not change since the last
+    fingerprint are not read again, their digests come from a stat cache kept in
+    ~/.cache/osconfiglib/.fingerprints.json.
+
+    Args:
+        root (str): Path to the tree, e.g. a layer
+        dir_names (list): Directories below root to include, missing ones are skipped
+
+    Returns:
+        str: Hex digest that changes whenever a file in one of the directories changes
+    """
+    root = os.path.abspath(root)
+    with utils.file_lock(stat_cache_path() + '.lock', stat_cache_lock):
+        stat_cache = load_stat_cache()
+        before = dict(stat_cache)
+        seen = set()
+
+        digest = hashlib.sha256()
+        for dir_name in dir_names:
+            path = os.path.join(root, dir_name)
+            if os.path.isdir(path):
+                digest.update(f"tree {dir_name}\0{tree_digest(path, stat_cache, seen)}\n".encode())
+
+        # Forget files that were removed from the fingerprinted directories
+        for path in list(stat_cache):
+            if path not in seen and any(path.startswith(os.path.join(root, dir_name) + os.sep) for dir_name in dir_names):
+                del stat_cache[path]
+        if stat_cache != before:
+            save_stat_cache(stat_cache)
+    return digest.hexdigest()
@@ -0,0 +1,239 @@
+# File: osconfiglib/layer_index.py
+import configparser
+import json
+import os
+import threading
+import time
+
+from osconfiglib import utils
+
+# Serializes index updates between threads of the same process, layers are imported in parallel
+index_lock = threading.Lock()
+
+
+def cache_root():
+    """
+    Get the directory holding the cached layers.
+
+    Returns:
+        str: Path to the cache directory
+    """
+    return os.path.expanduser('~/.cache/osconfiglib')
+
+
+def index_path():
+    """
+    Get the path of the layer index.
+
+    Returns:
+        str: Path to the index file
+    """
+    return os.path.join(cache_root(), '.layer-index.json')
+
+
+def locked_index():
+    """
+    Lock the layer index for a read, modify and save cycle.
+
+    Threads hold index_lock, other processes (e.g. a parallel export and gc) are kept
+    out by a flock() on a lock file next to the index.
+
+    Returns:
+        contextlib.AbstractContextManager: Holds the lock while the with block runs
+    """
+    return utils.file_lock(index_path() + '.lock', index_lock)
+
+
+def load_index():
+    """
+    Load the layer index.
+
+    The index maps the directory name of every cached layer to its name, source URL,
+    branch, commit, size in bytes and the time it was last used.
+
+    Returns:
+        dict: The index
+    """
+    if not os.path.exists(index_path()):
+        return {}
+    try:
+        with open(index_path(), 'r') as file:
+            return json.load(file)
+    except ValueError:
+        print(f"Ignoring corrupt layer index {index_path()}")
+        return {}
+
+
+def save_index(index):
+    """
+    Save the layer index.
+
+    Args:
+        index (dict): The index returned by load_index()
+    """
+    utils.write_json_atomic(index_path(), index, indent=1, sort_keys=True)
+
+
+def directory_size(path):
+    """
+    Get the total size of the files below a directory.
+
+    Args:
+        path (str): Path to the directory
+
+    Returns:
+        int: Size in bytes, symbolic links are not followed
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def read_git_metadata(layer_path):
+    """
+    Read the origin URL, branch and commit of a cached git layer from its .git directory.
+
+    Args:
+        layer_path (str): Path to the layer
+
+    Returns:
+        dict: The url, branch and commit, or None if the layer is not a git repository
+    """
+    git_dir = os.path.join(layer_path, '.git')
+    if not os.path.isdir(git_dir):
+        return None
+
+    config = configparser.ConfigParser(strict=False, interpolation=None)
+    try:
+        config.read(os.path.join(git_dir, 'config'))
+    except configparser.Error:
+        pass
+    url = config.get('remote "origin"', 'url', fallback=None)
+
+    branch = commit = None
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as file:
+            head = file.read().strip()
+    except OSError:
+        head = ''
+    if head.startswith('ref: '):
+        ref = head[len('ref: '):]
+        branch = ref.rsplit('refs/heads/', 1)[-1]
+        try:
+            with open(os.path.join(git_dir, ref), 'r') as file:
+                commit = file.read().strip()
+        except OSError:
+            # The ref may only be in packed-refs
+            try:
+                with open(os.path.join(git_dir, 'packed-refs'), 'r') as file:
+                    for line in file:
+                        if line.rstrip().endswith(f' {ref}'):
+                            commit = line.split()[0]
+            except OSError:
+                pass
+    elif head:
+        commit = head
+    return {'url': url, 'branch': branch, 'commit': commit}
+
+
+def update_layer(dir_name, **fields):
+    """
+    Add or update the index entry of a cached layer.
+
+    The size is measured again and the last use is set to now unless given.
+
+    Args:
+        dir_name (str): Name of the layer directory in the cache
+        **fields: Fields of the entry to set, e.g. url, branch and commit
+    """
+    entry = {'name': dir_name, 'size': directory_size(os.path.join(cache_root(), dir_name)), 'last_used': time.time()}
+    entry.update(fields)
+    with locked_index():
+        index = load_index()
+        index[dir_name] = dict(index.get(dir_name, {}), **entry)
+        save_index(index)
+
+
+def touch_layer(dir_name):
+    """
+    Record that a cached layer was used.
+
+    Args:
+        dir_name (str): Name of the layer directory in the cache
+    """
+    with locked_index():
+        index = load_index()
+        if dir_name in index:
+            index[dir_name]['last_used'] = time.time()
+            save_index(index)
+            return
+    update_layer(dir_name, **index_fields(os.path.join(cache_root(), dir_name)))
+
+
+def remove_layer(dir_name):
+    """
+    Remove a layer from the index.
+
+    Args:
+        dir_name (str): Name of the layer directory in the cache
+    """
+    with locked_index():
+        index = load_index()
+        if index.pop(dir_name, None) is not None:
+            save_index(index)
+
+
+def index_fields(layer_path):
+    """
+    Get the source of a layer that is not in the index yet.
+
+    Args:
+        layer_path (str): Path to the layer
+
+    Returns:
+        dict: The url, branch and commit of a git layer, or a local source
+    """
+    metadata = read_git_metadata(layer_path)
+    if metadata is None:
+        return {'url': None, 'branch': None, 'commit': None, 'type': 'local'}
+    return dict(metadata, type='git')
+
+
+def list_indexed_layers():
+    """
+    Get the index entries of all cached layers.
+
+    Layers that are missing from the index, e.g. because they were cached by an older
+    version, are added from their .git metadata and entries of removed layers are
+    dropped. No processes are spawned.
+
+    Returns:
+        list: Index entries sorted by directory name
+    """
+    root = cache_root()
+    with locked_index():
+        index = load_index()
+        changed = False
+        if os.path.isdir(root):
+            # Hidden directories hold shared stores and caches, not layers
+            dir_names = {entry.name for entry in os.scandir(root) if entry.is_dir() and not entry.name.startswith('.')}
+        else:
+            dir_names = set()
+
+        for dir_name in dir_names - set(index):
+            layer_path = os.path.join(root, dir_name)
+            index[dir_name] = dict(index_fields(layer_path), name=dir_name, size=directory_size(layer_path),
+                                   last_used=os.stat(layer_path).st_mtime)
+            changed = True
+        for dir_name in set(index) - dir_names:
+            del index[dir_name]
+            changed = True
+
+        if changed:
+            save_index(index)
+    return [index[dir_name] for dir_name in sorted(index)]
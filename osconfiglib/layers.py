@@ -1,16 +1,21 @@
 # File: osconfiglib/layers.py
+import concurrent.futures
 import datetime
+import hashlib
+import json
 import os
+import queue
 import re
 import shutil
 import subprocess
 import tarfile
 import tempfile
+import threading
 import urllib.parse
 from pathlib import Path
 from shutil import copy2
 from urllib.parse import urlparse
-from osconfiglib import package_handler
+from osconfiglib import archive, fingerprint, layer_index, package_handler, requirements, squash_cache
 
 import toml
 
@@ -51,6 +56,7 @@ def add_file_to_layer(layer_name, source_file_path, destination_path):
 
     # Copy the source file to the destination directory in the layer's config directory
     copy2(source_file_path, layer_dir / destination_path / source_file_path.name)
+    layer_index.update_layer(layer_name)
 
     print(f"File {source_file_path.name} added to layer {layer_name} successfully.")
 
@@ -75,6 +81,7 @@ def add_package_to_layer(layer_name, package_type, package_name):
     package_list_file = layer_dir / "package-lists" / f"{package_type}-requirements.txt"
     with open(package_list_file, 'a') as file:
         file.write(package_name + '\n')
+    layer_index.update_layer(layer_name)
 
     print(f"Package {package_name} added to layer {layer_name} successfully.")
 
@@ -104,6 +111,7 @@ def create_layer(layer_name):
         with open(layer_dir / "package-lists" / f"{package_type}-requirements.txt", 'w') as file:
             pass
 
+    layer_index.update_layer(layer_name, url=None, branch=None, commit=None, type='local')
     print(f"Layer {layer_name} created successfully.")
     return True
 
@@ -129,11 +137,10 @@ def get_requirements_files(layer, file_name):
 def list_layers():
     """
     List all layers stored locally in the 'layers' directory and in the cache directory.
-    """
-    # Define the path of directories
-    home_dir = Path.home()  # User's home directory
-    cache_dir = home_dir / ".cache" / "osconfiglib"  # Cache directory
 
+    Cached layers are read from the layer index (see layer_index), so listing does not
+    run git for every layer.
+    """
     # Header for the output
     print(f"{'Layer Name':<20} {'Source':<20}")
 
@@ -145,12 +152,8 @@ def list_layers():
                 print(f'{item.name:<20} {"Configurator":<20}')
 
     # List layers in the cache directory
-    if cache_dir.exists():
-        for item in cache_dir.iterdir():
-            if item.is_dir():
-                # Get the origin URL of the git repository
-                git_url = subprocess.getoutput(f'git -C {item} config --get remote.origin.url')
-                print(f'{item.name:<20} {git_url:<20}')
+    for entry in layer_index.list_indexed_layers():
+        print(f"{entry['name']:<20} {entry['url'] or 'Local':<20}")
 
 
 def validate_git_url(url):
@@ -162,6 +165,9 @@ def validate_git_url(url):
         result = urlparse(url)
         if all([result.scheme in ['http', 'https'], result.netloc, result.path]):
             return True
+        # Local mirrors and bare repositories
+        if result.scheme == 'file' and result.path:
+            return True
     except ValueError:
         pass
 
@@ -245,30 +251,96 @@ def toml_check(toml_file_path):
         return False
 
 
-def import_layers(data):
+def import_layers(data, max_workers=None, clone_mode=None, reference=None, refresh=False):
     """
     Imports layers specified in a TOML file.
 
+    Git layers are cloned concurrently through a bounded thread pool. As soon as
+    one import fails, imports that have not started yet are cancelled and the
+    function returns False once the running ones have finished.
+
     Args:
         data: A dictionary containing the layers to import.
+        max_workers (int): Maximum number of layers to import at the same time.
+            Defaults to the recipe's `import_jobs` value, or 4 if not set.
+        clone_mode (str): How much of each repository to fetch, one of CLONE_MODES.
+            Defaults to the recipe's `clone_mode` value, or 'full' if not set.
+        reference (bool): Share git objects between branches of the same repository.
+            Defaults to the recipe's `reference_clones` value, or False if not set.
+        refresh (bool): Fetch and fast-forward git layers that are already in the cache.
 
     Returns:
         bool: False if any of the layer imports fail, True otherwise.
     """
+    if max_workers is None:
+        max_workers = data.get('import_jobs', 4)
+    max_workers = max(1, int(max_workers))
+    if clone_mode is None:
+        clone_mode = data.get('clone_mode', 'full')
+    if reference is None:
+        reference = data.get('reference_clones', False)
+
+    git_layers = []
     for layer in data['layer']:
         # Local layers are already in cache, so no need to import them
         if layer['type'] == 'local':
             layer['path'] = os.path.expanduser('~/.cache/osconfiglib') + '/' + layer['name']
-            # TODO: check to see if local layer is in cache
+            if not os.path.isdir(layer['path']):
+                print(f"Local layer {layer['name']} not found in the cache, create it with create_layer() first, aborting import_layers.")
+                return False
+
+            # Only files whose size, modification time or inode changed are read again
+            entry = layer_index.load_index().get(layer['name'])
+            fields = {'fingerprint': layer_fingerprint(layer['path'])}
+            if entry is None:
+                fields.update(layer_index.index_fields(layer['path']))
+            elif entry.get('fingerprint') not in (None, fields['fingerprint']):
+                print(f"Layer {layer['name']} (local): changed since it was last used")
+            layer_index.update_layer(layer['name'], **fields)
             continue
 
         # Import git layers
         elif layer['type'] == 'git':
-            success = import_layer(repo_url=layer['url'], branch=layer.get('branch_or_tag', 'main'))
             layer['path'] = os.path.expanduser('~/.cache/osconfiglib') + '/' + git_to_dir_name(layer['url'])
-            if not success:
-                print(f"Failed to import layer from {layer['url']}, aborting import_layers.")
-                return False
+            git_layers.append(layer)
+
+    # Several recipe entries may point at the same repository and branch, clone every cache directory only once
+    imports = {}
+    for layer in git_layers:
+        branch = layer.get('branch_or_tag', 'main')
+        imports.setdefault(git_to_dir_name(layer['url'], branch), (layer['url'], branch))
+
+    failed = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(import_layer, repo_url=url, branch=branch, clone_mode=clone_mode, reference=reference, refresh=refresh): (url, branch)
+            for url, branch in imports.values()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            url, branch = futures[future]
+            if future.cancelled():
+                print(f"Layer {url} ({branch}): cancelled")
+                continue
+
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"Error importing layer from {url}: {e}")
+                success = False
+
+            if success:
+                print(f"Layer {url} ({branch}): imported")
+            else:
+                print(f"Layer {url} ({branch}): failed")
+                if failed is None:
+                    failed = url
+                    # Stop on the first failure, pending imports are never started
+                    for pending in futures:
+                        pending.cancel()
+
+    if failed is not None:
+        print(f"Failed to import layer from {failed}, aborting import_layers.")
+        return False
     print("All layers imported successfully.")
     return True
 
@@ -297,7 +369,258 @@ def git_to_dir_name(repo_url, branch='main'):
     return f"{host}-{owner}-{repo_name}-{branch}"
 
 
-def import_layer(repo_url, branch='main'):
+# Directories of a layer that are read when squashing, sparse clones only check these out
+LAYER_DIRS = ['configs', 'package-lists', 'scripts']
+
+# Shell function timing the steps of squash scripts, also copied into bundles for the steps virt-customize runs
+STEP_FUNCTION = """# Runs a step, and appends its start and end time as a JSON line to $OSCONFIGLIB_TIMING_LOG if it is set
+function osconfiglib_step() {
+    if [ -z "$OSCONFIGLIB_TIMING_LOG" ]; then
+        "$@"
+        return
+    fi
+    local start end status=0
+    start=$(date +%s.%N)
+    "$@" || status=$?
+    end=$(date +%s.%N)
+    echo "{\\"step\\": \\"$1\\", \\"start\\": $start, \\"end\\": $end, \\"status\\": $status}" >> "$OSCONFIGLIB_TIMING_LOG"
+    return $status
+}
+"""
+
+# Start of every squashed script. Packages bundled next to the script in an export are
+# installed from local repositories in one transaction before the layer scripts run.
+SQUASH_SCRIPT_HEADER = """#!/bin/bash
+
+trap 'echo "Error occurred in ${FUNCNAME[1]}"; exit 1' ERR
+
+BUNDLE_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+""" + STEP_FUNCTION + """
+# Install the requirements from the bundled repositories, or from the configured ones if nothing was bundled.
+# Every line of a requirement list is one argument, so versioned requirements like "tmux >= 3.0" stay intact.
+function osconfiglib_install_rpms() {
+    if [ -s "$BUNDLE_DIR/rpm_requirements.txt" ] && command -v dnf > /dev/null; then
+        local requirements
+        mapfile -t requirements < "$BUNDLE_DIR/rpm_requirements.txt"
+        if [ -d "$BUNDLE_DIR/rpms/repodata" ]; then
+            dnf install -y --nogpgcheck --allowerasing --repofrompath=osconfiglib,"$BUNDLE_DIR/rpms" --repo=osconfiglib "${requirements[@]}"
+        else
+            dnf install -y --nogpgcheck --allowerasing "${requirements[@]}"
+        fi
+    fi
+}
+function osconfiglib_install_debs() {
+    if [ -s "$BUNDLE_DIR/deb_requirements.txt" ] && command -v apt-get > /dev/null; then
+        local requirements
+        mapfile -t requirements < "$BUNDLE_DIR/deb_requirements.txt"
+        if [ -f "$BUNDLE_DIR/debs/Packages" ]; then
+            echo "deb [trusted=yes] file:$BUNDLE_DIR/debs ./" > "$BUNDLE_DIR/osconfiglib.list"
+            local apt_local=(-o "Dir::Etc::SourceList=$BUNDLE_DIR/osconfiglib.list" -o Dir::Etc::SourceParts=- -o APT::Get::List-Cleanup=0)
+            apt-get update "${apt_local[@]}"
+            apt-get install -y "${apt_local[@]}" "${requirements[@]}"
+        else
+            apt-get install -y "${requirements[@]}"
+        fi
+    fi
+}
+osconfiglib_step osconfiglib_install_rpms
+osconfiglib_step osconfiglib_install_debs
+"""
+
+# Runs layer functions in the background, at most $1 at a time, and fails if any of them fails.
+# Waiting for the oldest job keeps this working with bash versions without wait -n.
+SCRIPT_PARALLEL_HELPER = """
+function osconfiglib_run_parallel() {
+    local jobs=$1
+    shift
+    local pids=() names=() status=0
+    for name in "$@"; do
+        if [ ${#pids[@]} -ge "$jobs" ]; then
+            wait "${pids[0]}" || { echo "Error occurred in ${names[0]}"; status=1; }
+            pids=("${pids[@]:1}")
+            names=("${names[@]:1}")
+        fi
+        osconfiglib_step "$name" &
+        pids+=($!)
+        names+=("$name")
+    done
+    for i in "${!pids[@]}"; do
+        wait "${pids[$i]}" || { echo "Error occurred in ${names[$i]}"; status=1; }
+    done
+    return $status
+}
+"""
+
+# Directories of an export holding the packages of each package type
+PACKAGE_DIRS = {'rpm': 'rpms', 'deb': 'debs'}
+
+# Directory of an export holding the wheels of the pip requirements
+WHEEL_DIR = 'wheels'
+
+# full: complete history, shallow: only the tip commit, sparse: tip commit limited to LAYER_DIRS
+CLONE_MODES = ['full', 'shallow', 'sparse']
+
+
+# One lock per path, layers of the same repository are imported in parallel
+path_locks = {}
+path_locks_lock = threading.Lock()
+
+
+def path_lock(path):
+    """
+    Get the lock serializing the threads of this process that write to a path.
+
+    Args:
+        path (str): Path to a directory in the cache
+
+    Returns:
+        threading.Lock: The same lock for every call with the same path
+    """
+    with path_locks_lock:
+        return path_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def reference_store_path(repo_url):
+    """
+    Get the path of the shared object store used for reference clones of a repository.
+
+    Args:
+        repo_url: The URL of the git repository.
+
+    Returns:
+        str: Path to the bare repository holding the objects of every branch imported from repo_url.
+    """
+    # Strip the branch suffix so that all branches of a repository share one store
+    repo_dir_name = git_to_dir_name(repo_url).rsplit('-', 1)[0]
+    return os.path.expanduser(f"~/.cache/osconfiglib/.objects/{repo_dir_name}.git")
+
+
+def clone_layer(repo_url, branch, cache_dir, clone_mode='full', reference=False):
+    """
+    Clone a layer repository into the cache directory.
+
+    Args:
+        repo_url: The URL of the git repository.
+        branch: The branch or tag to check out.
+        cache_dir: The directory to clone into.
+        clone_mode: One of CLONE_MODES. Default is 'full'.
+        reference: If True, objects are fetched into a bare store shared by all
+            branches of the repository and the layer is cloned from it.
+
+    Returns:
+        bool: True if the clone succeeded, False otherwise.
+    """
+    if clone_mode not in CLONE_MODES:
+        print(f"Unknown clone mode '{clone_mode}', expected one of {', '.join(CLONE_MODES)}")
+        return False
+
+    depth = ['--depth', '1'] if clone_mode in ['shallow', 'sparse'] else []
+
+    if reference:
+        store = reference_store_path(repo_url)
+        # Branches of the same repository share the store, concurrent fetches would race on its refs and packs
+        with path_lock(store):
+            if not os.path.exists(store):
+                subprocess.run(['git', 'init', '--quiet', '--bare', store], check=True)
+
+            # The branch or tag is stored under refs/heads so it can be cloned with --branch
+            fetch = ['git', '--git-dir', store, 'fetch', '--quiet', '--force', '--no-tags'] + depth + [repo_url, f"{branch}:refs/heads/{branch}"]
+            if subprocess.run(fetch, check=False).returncode != 0:
+                return False
+
+            # --shared borrows the objects of the store instead of copying them
+            clone = ['git', 'clone', '--quiet', '--shared', '--no-checkout', '--branch', branch, store, cache_dir]
+            if subprocess.run(clone, check=False).returncode != 0:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                return False
+        subprocess.run(['git', '-C', cache_dir, 'remote', 'set-url', 'origin', repo_url], check=True)
+    else:
+        clone = ['git', 'clone', '--no-checkout', '--branch', branch] + depth
+        if clone_mode == 'sparse':
+            # Only download the blobs that the sparse checkout below needs
+            clone += ['--filter=blob:none']
+        if subprocess.run(clone + [repo_url, cache_dir], check=False).returncode != 0:
+            return False
+
+    if clone_mode == 'sparse':
+        subprocess.run(['git', '-C', cache_dir, 'sparse-checkout', 'set', '--cone'] + LAYER_DIRS, check=True)
+
+    result = subprocess.run(['git', '-C', cache_dir, 'checkout', '--quiet', branch], check=False)
+    if result.returncode != 0:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return False
+    return True
+
+
+def git_output(repo_dir, *args):
+    """
+    Run a git command in a repository and return its stripped output.
+
+    Args:
+        repo_dir: Path to the git repository.
+        *args: Arguments passed to git.
+
+    Returns:
+        str: The output of the command, or None if the command failed.
+    """
+    result = subprocess.run(['git', '-C', repo_dir] + list(args), check=False, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+
+def refresh_layer(repo_url, branch, cache_dir, clone_mode='full', reference=False):
+    """
+    Bring a cached layer clone up to date with its remote.
+
+    The branch or tag is fetched and resolved to a commit again. Full clones are
+    fast-forwarded, shallow clones are moved to the fetched commit since they have
+    no history to diverge from. The layer is only cloned again when the remote has
+    diverged from the cached commit, e.g. after a force push or a moved tag.
+
+    Args:
+        repo_url: The URL of the git repository.
+        branch: The branch or tag checked out in the cache directory.
+        cache_dir: Path to the cached clone.
+        clone_mode: Clone mode used if the layer has to be cloned again.
+        reference: Reference mode used if the layer has to be cloned again.
+
+    Returns:
+        bool: True if the layer is up to date, False otherwise.
+    """
+    shallow = git_output(cache_dir, 'rev-parse', '--is-shallow-repository') == 'true'
+    depth = ['--depth', '1'] if shallow else []
+    fetch = ['git', '-C', cache_dir, 'fetch', '--quiet', '--no-tags'] + depth + ['origin', branch]
+    if subprocess.run(fetch, check=False).returncode != 0:
+        print(f"Failed to fetch branch '{branch}' of '{repo_url}'.")
+        return False
+
+    head = git_output(cache_dir, 'rev-parse', 'HEAD')
+    commit = git_output(cache_dir, 'rev-parse', 'FETCH_HEAD^{commit}')
+    if head == commit:
+        print(f"Layer from repository '{repo_url}' on branch '{branch}' is up to date at {commit}.")
+        return True
+
+    if shallow:
+        update = ['reset', '--quiet', '--hard', commit]
+    elif subprocess.run(['git', '-C', cache_dir, 'merge-base', '--is-ancestor', head, commit], check=False).returncode == 0:
+        update = ['merge', '--quiet', '--ff-only', commit]
+    else:
+        update = None
+
+    if update is None or subprocess.run(['git', '-C', cache_dir] + update, check=False).returncode != 0:
+        print(f"Layer from repository '{repo_url}' on branch '{branch}' has diverged, cloning it again...")
+        shutil.rmtree(cache_dir)
+        if not clone_layer(repo_url, branch, cache_dir, clone_mode, reference):
+            print(f"Failed to clone repository '{repo_url}'.")
+            return False
+
+    print(f"Layer from repository '{repo_url}' on branch '{branch}' updated to {commit}.")
+    return not delete_layer_if_invalid(cache_dir)
+
+
+def import_layer(repo_url, branch='main', clone_mode='full', reference=False, refresh=False):
     """
     Import a layer from a git repository. The layer will be stored in a local
     cache directory (~/.cache/osconfiglib/). Each repository and branch combination
@@ -306,9 +629,12 @@ def import_layer(repo_url, branch='main'):
     Args:
         repo_url: The URL of the git repository.
         branch: The branch of the repository to import. Default is 'main'.
+        clone_mode: How much of the repository to fetch, one of CLONE_MODES. Default is 'full'.
+        reference: Share git objects between branches of the same repository. Default is False.
+        refresh: Update the layer if it is already in the cache. Default is False.
 
     Returns:
-        None
+        bool: True if the layer is available in the cache, False otherwise.
     """
     # Checking to see if the URL is valid
     if not validate_git_url(repo_url):
@@ -317,86 +643,361 @@ def import_layer(repo_url, branch='main'):
 
     cache_dir = os.path.expanduser(f"~/.cache/osconfiglib/{git_to_dir_name(repo_url, branch)}")
     print(cache_dir)
-    if os.path.exists(cache_dir):
-        print(f"Layer from repository '{repo_url}' on branch '{branch}' is already imported.")
-        return True
+    # Imports of other branches may fall back to the same master directory, only one thread clones into it
+    with path_lock(cache_dir):
+        if os.path.exists(cache_dir):
+            if refresh:
+                return refresh_layer(repo_url, branch, cache_dir, clone_mode, reference) and index_git_layer(cache_dir, repo_url, branch)
+            print(f"Layer from repository '{repo_url}' on branch '{branch}' is already imported.")
+            layer_index.touch_layer(os.path.basename(cache_dir))
+            return True
 
-    print(f"Cloning repository '{repo_url}' branch '{branch}' into '{cache_dir}'...")
-    result = subprocess.run(['git', 'clone', '--branch', branch, repo_url, cache_dir], check=False)
-    if result.returncode != 0:
-        print(f"Branch '{branch}' not found, trying with 'master' branch...")
-        branch = 'master'
-        cache_dir = os.path.expanduser(f"~/.cache/osconfiglib/{git_to_dir_name(repo_url, branch)}")
+        print(f"Cloning repository '{repo_url}' branch '{branch}' into '{cache_dir}'...")
+        if clone_layer(repo_url, branch, cache_dir, clone_mode, reference):
+            return finish_import(cache_dir, repo_url, branch)
+
+    print(f"Branch '{branch}' not found, trying with 'master' branch...")
+    branch = 'master'
+    cache_dir = os.path.expanduser(f"~/.cache/osconfiglib/{git_to_dir_name(repo_url, branch)}")
+    with path_lock(cache_dir):
         if os.path.exists(cache_dir):
+            if refresh:
+                return refresh_layer(repo_url, branch, cache_dir, clone_mode, reference) and index_git_layer(cache_dir, repo_url, branch)
             print(f"Layer from repository '{repo_url}' on branch '{branch}' is already imported.")
+            layer_index.touch_layer(os.path.basename(cache_dir))
             return True
-        subprocess.run(['git', 'clone', '--branch', branch, repo_url, cache_dir], check=True)
+        if not clone_layer(repo_url, branch, cache_dir, clone_mode, reference):
+            print(f"Failed to clone repository '{repo_url}'.")
+            return False
+        return finish_import(cache_dir, repo_url, branch)
+
+
+def finish_import(cache_dir, repo_url, branch):
+    """
+    Validate a freshly cloned layer and record it in the layer index.
+
+    Args:
+        cache_dir: Path to the clone.
+        repo_url: The URL of the git repository.
+        branch: The cloned branch.
+
+    Returns:
+        bool: True if the layer is valid, False if it was deleted.
+    """
     if delete_layer_if_invalid(cache_dir):
         print(f"Deleting the folder '{cache_dir}' because it was not valid Need to follow the layer file structure")
         print("I need to find that URL and put it here...")
         return False
+    index_git_layer(cache_dir, repo_url, branch)
     print(f"Layer from repository '{repo_url}' on branch '{branch}' imported successfully.")
     return True
 
 
-def tar_configs(configs_path):
-    # Determine the output tarball file path
-    output_tarball_file = os.path.join(os.path.dirname(configs_path), 'configs.tar.gz')
+def index_git_layer(layer_path, repo_url, branch):
+    """
+    Record a cloned or refreshed git layer in the layer index.
+
+    Args:
+        layer_path (str): Path to the layer in the cache
+        repo_url (str): The URL of the git repository
+        branch (str): The imported branch
+
+    Returns:
+        bool: Always True, so it can be chained after a successful import
+    """
+    layer_index.update_layer(os.path.basename(layer_path), url=repo_url, branch=branch,
+                             commit=git_output(layer_path, 'rev-parse', 'HEAD'), type='git')
+    return True
+
+
+def merge_configs(layers):
+    """
+    Merge the configs of multiple layers without copying any files.
+
+    Later layers win when several layers contain the same file.
+
+    Args:
+        layers (list): List of layers
 
-    with tarfile.open(output_tarball_file, 'w:gz') as tar:
-        for dirpath, dirnames, filenames in os.walk(configs_path):
-            print(dirpath)
+    Returns:
+        dict: Mapping of the path relative to the configs directory to the source file of the winning layer
+    """
+    merged_configs = {}
+    for layer in layers:
+        layer_configs_dir = os.path.join(layer['path'], 'configs')
+        if not os.path.exists(layer_configs_dir):
+            continue
+        for dirpath, dirnames, filenames in os.walk(layer_configs_dir):
             for filename in filenames:
-                print(filename)
-                filepath = os.path.join(dirpath, filename)
-                arcname = os.path.relpath(filepath, configs_path)  # get the relative path
-                tar.add(filepath, arcname=arcname)
+                src_file = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(src_file, layer_configs_dir)
+
+                if rel_path in merged_configs:
+                    print(f"Warning: Overwriting file {rel_path} with the one from layer {layer['name']}")
+
+                merged_configs[rel_path] = src_file
+    return merged_configs
+
+
+def tar_configs(merged_configs, output_tarball_file, reproducible=False):
+    """
+    Write merged configs into an uncompressed tarball.
+
+    Every file is read once, straight from the layer it comes from. Symbolic
+    links are stored as links, not followed. The tarball is not compressed
+    because it is compressed as part of the exported archive.
+
+    Args:
+        merged_configs (dict): Mapping returned by merge_configs()
+        output_tarball_file (str): Path to the tarball to create
+        reproducible (bool): Normalize owners, permissions and timestamps of the entries
 
-    shutil.rmtree(configs_path)  # delete the configs directory
+    Returns:
+        str: Path to the tarball
+    """
+    normalize = archive.normalize_tarinfo if reproducible else None
+    with tarfile.open(output_tarball_file, 'w') as tar:
+        for arcname in sorted(merged_configs):
+            tar.add(merged_configs[arcname], arcname=arcname, recursive=False, filter=normalize)
     return output_tarball_file
 
-def squash_layers(layers, tmp_dir, image_path=None):
+
+def layer_fingerprint(layer_path):
+    """
+    Get the content fingerprint of a layer directory.
+
+    Args:
+        layer_path (str): Path to the layer directory
+
+    Returns:
+        str: Merkle hash over the files in LAYER_DIRS, see fingerprint.fingerprint()
+    """
+    return fingerprint.fingerprint(layer_path, LAYER_DIRS)
+
+
+def layer_identity(layer):
+    """
+    Get a string that changes whenever the content of a layer changes.
+
+    Args:
+        layer (dict): Layer with a 'path' key
+
+    Returns:
+        str: The commit SHA of a clean git layer, or a content hash otherwise
+    """
+    layer_path = layer['path']
+    if layer.get('type') == 'git':
+        commit = git_output(layer_path, 'rev-parse', 'HEAD')
+        # Files added to a cached git layer are not part of the commit
+        if commit and git_output(layer_path, 'status', '--porcelain') == '':
+            return f"git:{commit}"
+    return f"sha256:{layer_fingerprint(layer_path)}"
+
+
+def changed_layers():
+    """
+    Find the cached layers whose content changed since they were last fingerprinted.
+
+    The fingerprint of every cached layer is compared with the one recorded in the
+    layer index, which is updated. Unchanged files are not read, so this is cheap to
+    run over the whole cache.
+
+    Returns:
+        list: Directory names of the changed layers, including layers that were never fingerprinted
+    """
+    changed = []
+    for entry in layer_index.list_indexed_layers():
+        current = layer_fingerprint(os.path.join(layer_index.cache_root(), entry['name']))
+        if entry.get('fingerprint') != current:
+            changed.append(entry['name'])
+            layer_index.update_layer(entry['name'], fingerprint=current, last_used=entry['last_used'])
+    return changed
+
+
+def layer_dependencies(layers):
+    """
+    Get the layers each layer depends on.
+
+    Dependencies are declared with a `depends_on` list of layer names, either on the
+    layer entry of the recipe or in a `layer.toml` file at the top of the layer.
+
+    Args:
+        layers (list): List of layers
+
+    Returns:
+        dict: Mapping of layer name to the sorted names of the layers it depends on
+    """
+    dependencies = {}
+    for layer in layers:
+        depends_on = set(layer.get('depends_on', []))
+        manifest = os.path.join(layer['path'], 'layer.toml')
+        if os.path.isfile(manifest):
+            depends_on.update(toml.load(manifest).get('depends_on', []))
+        dependencies[layer['name']] = sorted(depends_on)
+    return dependencies
+
+
+def script_levels(layers, dependencies):
+    """
+    Group layers into levels whose scripts can run at the same time.
+
+    Every layer is placed in the level after the last of its dependencies. Within a
+    level, layers keep their recipe order.
+
+    Args:
+        layers (list): List of layers
+        dependencies (dict): Mapping returned by layer_dependencies()
+
+    Returns:
+        list: List of levels, each a list of layer names
+
+    Raises:
+        ValueError: If a layer depends on a layer that is not in the recipe or the dependencies form a cycle.
+    """
+    names = [layer['name'] for layer in layers]
+    for name in names:
+        unknown = [dependency for dependency in dependencies.get(name, []) if dependency not in names]
+        if unknown:
+            raise ValueError(f"Layer {name} depends on {', '.join(unknown)}, which is not in the recipe")
+
+    levels = {}
+    while len(levels) < len(names):
+        ready = [name for name in names if name not in levels
+                 and all(dependency in levels for dependency in dependencies.get(name, []))]
+        if not ready:
+            raise ValueError(f"Circular dependency between layers {', '.join(name for name in names if name not in levels)}")
+        for name in ready:
+            levels[name] = 1 + max((levels[dependency] for dependency in dependencies.get(name, [])), default=-1)
+
+    grouped = [[] for _ in range(max(levels.values(), default=-1) + 1)]
+    for name in names:
+        grouped[levels[name]].append(name)
+    return grouped
+
+
+def script_order(layers, dependencies):
+    """
+    Order layers so that every layer comes after its dependencies.
+
+    Layers keep their recipe order unless a dependency requires moving them, so the
+    order of a recipe that already satisfies its dependencies does not change.
+
+    Args:
+        layers (list): List of layers
+        dependencies (dict): Mapping returned by layer_dependencies()
+
+    Returns:
+        list: The ordered layer names
+
+    Raises:
+        ValueError: If the dependencies are invalid, see script_levels().
+    """
+    script_levels(layers, dependencies)
+    pending = [layer['name'] for layer in layers]
+    order = []
+    while pending:
+        name = next(name for name in pending if all(dependency in order for dependency in dependencies.get(name, [])))
+        order.append(name)
+        pending.remove(name)
+    return order
+
+
+def squash_layers(layers, tmp_dir, image_path=None, use_cache=True, options=None, reproducible=False, strict_requirements=False,
+                  script_jobs=1):
     """
     Combine multiple layers into a single layer (squashed layer).
 
+    Results are cached in ~/.cache/osconfiglib/.squash, keyed on the identity of
+    every layer and the options, so squashing unchanged layers again is nearly free.
+
+    Args:
+        layers (list): List of layers
+        tmp_dir (str): Path to the temporary directory
+        image_path (str): Path to a qcow2 image whose installed packages are added to the requirements
+        use_cache (bool): Reuse and store results in the squash cache. Default is True.
+        options (dict): Recipe options that change the squash result, they are part of the cache key.
+        reproducible (bool): Build a configs tarball that only depends on the content of the layers.
+        strict_requirements (bool): Fail if layers constrain the same package differently.
+        script_jobs (int): Maximum number of layers whose scripts run at the same time, see merge_layers().
+
+    Raises:
+        ValueError: If strict_requirements is set and the requirements of the layers conflict, or the
+            layer dependencies are invalid.
+    """
+    key = None
+    squashed_layer = None
+    dependencies = layer_dependencies(layers)
+    if use_cache:
+        options = dict(options or {}, reproducible=reproducible, strict_requirements=strict_requirements,
+                       script_jobs=script_jobs, dependencies=dependencies)
+        key = squash_cache.cache_key([(layer['name'], layer_identity(layer)) for layer in layers], options)
+        squashed_layer = squash_cache.load(key, tmp_dir)
+
+    if squashed_layer is None:
+        squashed_layer = merge_layers(layers, tmp_dir, reproducible, strict_requirements, script_jobs, dependencies)
+        if key:
+            squash_cache.store(key, squashed_layer)
+
+    if image_path:
+        # The packages of the image have the lowest precedence, the layers may upgrade them
+        package_type = package_handler.get_image_inventory(image_path)['package_type']
+        requirement_list = f'{package_type}_requirements'
+        squashed_layer[requirement_list], _ = requirements.merge_requirements(
+            [('image', package_handler.extract_packages_qcow2(image_path)), ('layers', squashed_layer[requirement_list])],
+            package_type)
+
+    return squashed_layer
+
+
+def merge_layers(layers, tmp_dir, reproducible=False, strict_requirements=False, script_jobs=1, dependencies=None):
+    """
+    Merge the requirements, configs and scripts of multiple layers.
+
+    Requirements are deduplicated and sorted by requirements.merge_requirements(),
+    a later layer wins when layers constrain the same package differently.
+
+    Scripts of a layer always run one after another. With script_jobs above 1, the
+    scripts of layers that do not depend on each other run concurrently, a layer only
+    starts once all of its dependencies have finished.
+
     Args:
         layers (list): List of layers
         tmp_dir (str): Path to the temporary directory
+        reproducible (bool): Normalize the metadata of the configs tarball
+        strict_requirements (bool): Fail on conflicting requirements instead of warning about them
+        script_jobs (int): Maximum number of layers whose scripts run at the same time
+        dependencies (dict): Mapping returned by layer_dependencies(), read from the layers if None
+
+    Returns:
+        dict: The squashed layer
+
+    Raises:
+        ValueError: If strict_requirements is set and the requirements of the layers conflict, or the
+            layer dependencies are invalid.
     """
+    if dependencies is None:
+        dependencies = layer_dependencies(layers)
+    levels = script_levels(layers, dependencies)
+    layers_by_name = {layer['name']: layer for layer in layers}
+    layer_functions = {}
+
     squashed_layer = {
         'rpm_requirements': [],
         'deb_requirements': [],
         'pip_requirements': [],
         'configs': [],
-        'squash_script': "#!/bin/bash\n\n"
-                         "trap 'echo \"Error occurred in ${FUNCNAME[1]}\"; exit 1' ERR\n"
+        'squash_script': SQUASH_SCRIPT_HEADER
     }
+    requirement_lists = {kind: [] for kind in requirements.KINDS}
 
-    merged_configs_dir = os.path.join(tmp_dir, 'configs')
-    os.makedirs(merged_configs_dir, exist_ok=True)
-
-    # Iterate over layers and squash configurations
-    for layer in layers:
+    # Iterate over layers and squash configurations, dependencies come first
+    for layer in [layers_by_name[name] for name in script_order(layers, dependencies)]:
+        layer_functions[layer['name']] = []
         layer_path = layer['path']  # Assumes 'layer' is a dictionary with a 'path' key
 
-        # Append requirements to the lists
-        squashed_layer['rpm_requirements'] += get_requirements_files(layer_path, 'rpm-requirements.txt')
-        squashed_layer['deb_requirements'] += get_requirements_files(layer_path, 'deb-requirements.txt')
-        squashed_layer['pip_requirements'] += get_requirements_files(layer_path, 'pip-requirements.txt')
-
-        # Merge configs into the squashed layer
-        layer_configs_dir = os.path.join(layer_path, 'configs')
-        if os.path.exists(layer_configs_dir):
-            for dirpath, dirnames, filenames in os.walk(layer_configs_dir):
-                for filename in filenames:
-                    src_file = os.path.join(dirpath, filename)
-                    dest_file = os.path.join(merged_configs_dir, os.path.relpath(src_file, layer_configs_dir))
-
-                    if os.path.exists(dest_file):
-                        print(f"Warning: Overwriting file {dest_file}")
-
-                    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
-                    shutil.copy2(src_file, dest_file, follow_symlinks=False)
+        # Collect the requirements of every layer, they are merged once all layers are read
+        for kind in requirements.KINDS:
+            requirement_lists[kind].append((layer['name'], get_requirements_files(layer_path, f'{kind}-requirements.txt')))
 
         # Add a list of filenames to ignore (in lowercase)
         ignored_files = ['readme.md', '.gitkeep']
@@ -404,7 +1005,8 @@ def squash_layers(layers, tmp_dir, image_path=None):
         # Combine scripts into the squashed layer
         script_dir = os.path.join(layer_path, 'scripts')
         if os.path.exists(script_dir):
-            for script in os.listdir(script_dir):
+            # Scripts run in alphabetical order
+            for script in sorted(os.listdir(script_dir)):
                 # Skip files in the ignored_files list
                 if script.lower() in ignored_files:
                     continue
@@ -414,70 +1016,249 @@ def squash_layers(layers, tmp_dir, image_path=None):
                     squashed_layer['squash_script'] += f"\n# {layer['name']} {script}\n"
                     squashed_layer['squash_script'] += f"function {layer['name']}_{script.replace('.', '_')}() {{\n"
                     squashed_layer['squash_script'] += stripped_script + "\n}\n"
-                    squashed_layer['squash_script'] += f"{layer['name']}_{script.replace('.', '_')}\n"
+                    if script_jobs > 1:
+                        layer_functions[layer['name']].append(f"{layer['name']}_{script.replace('.', '_')}")
+                    else:
+                        squashed_layer['squash_script'] += f"osconfiglib_step {layer['name']}_{script.replace('.', '_')}\n"
+
+    if script_jobs > 1:
+        squashed_layer['squash_script'] += SCRIPT_PARALLEL_HELPER
+        for name, functions in layer_functions.items():
+            squashed_layer['squash_script'] += f"\nfunction osconfiglib_layer_{name}() {{\n"
+            for function in functions:
+                squashed_layer['squash_script'] += f'    osconfiglib_step {function} || {{ echo "Error occurred in {function}"; return 1; }}\n'
+            squashed_layer['squash_script'] += "    return 0\n}\n"
+        for level in levels:
+            squashed_layer['squash_script'] += f"osconfiglib_run_parallel {script_jobs} {' '.join(f'osconfiglib_layer_{name}' for name in level)}\n"
+
+    # Conflicts are detected here, before anything is downloaded
+    for kind in requirements.KINDS:
+        merged, conflicts = requirements.merge_requirements(requirement_lists[kind], kind)
+        for name, (losing_layer, losing), (winning_layer, winning) in conflicts:
+            print(f"Conflicting {kind} requirements for {name}: '{winning}' from layer {winning_layer} overrides '{losing}' from layer {losing_layer}")
+        if conflicts and strict_requirements:
+            raise ValueError(f"Conflicting {kind} requirements: {', '.join(conflict[0] for conflict in conflicts)}")
+        squashed_layer[f'{kind}_requirements'] = merged
+
+    # Stream the winning config files straight into the tarball
+    tar_location = tar_configs(merge_configs(layers), os.path.join(tmp_dir, 'configs.tar'), reproducible)
+    squashed_layer['configs'] = tar_location  # Now 'configs' contains the path to the configs tarball
 
-    if image_path:
-        squashed_layer['rpm_requirements']  += package_handler.extract_packages_qcow2(image_path)
+    return squashed_layer
 
-    tar_location = tar_configs(merged_configs_dir)
-    squashed_layer['configs'] = tar_location  # Now 'configs' contains the path to the merged configs directory
 
-    return squashed_layer
+def stage_packages(squashed_layer, bundle_dir, download_jobs=4, manifest=None, inventory=None, on_package=None,
+                   pip_target=None):
+    """
+    Download the packages of a squashed layer into local repositories.
+
+    Packages go to the PACKAGE_DIRS subdirectories of bundle_dir together with the
+    repository metadata, so the target installs everything in one offline solver pass.
+    Wheels of the pip requirements go to WHEEL_DIR.
+
+    Args:
+        squashed_layer (dict): Squashed layer of configurations
+        bundle_dir (str): Directory the package directories are created in
+        download_jobs (int): Number of packages downloaded in parallel
+        manifest (dict): Package manifest of an earlier export, see package_handler.load_manifest()
+        inventory (dict): Packages of the image being upgraded, only missing or outdated packages are downloaded
+        on_package (callable): Called with the path of every package and wheel as soon as it is in bundle_dir.
+            Repository metadata is only complete once this function returns.
+        pip_target (dict): Python version and platforms of the target, see package_handler.image_pip_target().
+            Required if there are pip requirements, the wheels are resolved for it.
+
+    Returns:
+        dict: The package manifest, one section with the requirements and packages per package type
 
-def export_squashed_layer(squashed_layer, output_file, tmp_dir):
+    Raises:
+        package_handler.PackageError: If packages can not be resolved or downloaded.
+    """
+    package_manifest = {}
+    for package_type, directory in PACKAGE_DIRS.items():
+        reqs = squashed_layer[f'{package_type}_requirements']
+        packages = package_handler.download_packages(
+            reqs, os.path.join(bundle_dir, directory), package_type, download_jobs,
+            package_handler.manifest_packages(manifest, reqs, package_type), inventory, on_package)
+        package_manifest[package_type] = {'requirements': reqs, 'packages': packages}
+
+        if packages:
+            package_handler.create_repo(os.path.join(bundle_dir, directory), package_type)
+
+    reqs = squashed_layer['pip_requirements']
+    packages = package_handler.download_pip_packages(reqs, os.path.join(bundle_dir, WHEEL_DIR), download_jobs,
+                                                     package_handler.manifest_packages(manifest, reqs, 'pip', pip_target),
+                                                     pip_target=pip_target, on_package=on_package)
+    package_manifest['pip'] = {'requirements': reqs, 'target': pip_target, 'packages': packages}
+    return package_manifest
+
+
+def export_squashed_layer(squashed_layer, output_file, tmp_dir, compression='gz', compression_level=None, reproducible=False,
+                          download_jobs=4, manifest=None, inventory=None, pip_target=None):
     """
     Export the squashed layer into a tarball.
 
+    Packages are downloaded in the background and appended to the tarball as soon as
+    each one is available, so compression overlaps with the downloads. The repository
+    metadata is added once all packages are there. Reproducible exports add all
+    packages at the end in sorted order instead.
+
     Args:
         squashed_layer (dict): Squashed layer of configurations
         output_file (str): Path to the output tarball file
         tmp_dir (str): Path to the temporary directory
-    """
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Download RPMs to the temporary directory
-        package_handler.download_packages(squashed_layer['rpm_requirements'],temp_dir)
+        compression (str): Compression of the tarball, one of archive.COMPRESSIONS. Default is 'gz'.
+        compression_level (int): Compression level, the backend default is used if None
+        reproducible (bool): Write entries in sorted order with normalized owners, permissions and
+            timestamps so that identical inputs produce identical bytes
+        download_jobs (int): Number of packages downloaded in parallel
+        manifest (dict): Package manifest of an earlier export, see package_handler.load_manifest().
+            Dependency resolution is skipped for requirements that did not change.
+        inventory (dict): Packages of the image being upgraded, see package_handler.get_image_inventory().
+            Only packages that are missing or outdated in the image are bundled.
+        pip_target (dict): Python version and platforms the wheels are resolved for, see stage_packages()
 
-        with tarfile.open(output_file, "w:gz") as tar:
-            # Add configs to the tarball
-            tar.add(squashed_layer['configs'], arcname="configs.tar.gz")
+    Returns:
+        str: SHA-256 digest of the uncompressed tarball
+    """
+    digest = hashlib.sha256()
+    directories = list(PACKAGE_DIRS.values()) + [WHEEL_DIR]
+    completed = queue.Queue()
+    with tempfile.TemporaryDirectory() as temp_dir, concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        # Download RPMs, DEBs and wheels to the temporary directory, a None marks the end of the downloads
+        staging = executor.submit(stage_packages, squashed_layer, temp_dir, download_jobs, manifest, inventory, completed.put,
+                                  pip_target)
+        staging.add_done_callback(lambda future: completed.put(None))
+
+        with archive.open_archive(output_file, compression, compression_level, reproducible, digest) as tar:
+            # Add configs to the tarball, they are compressed along with the rest of the tarball
+            archive.add_path(tar, squashed_layer['configs'], "configs.tar", reproducible)
 
             # Add requirements to the tarball
-            for requirements in ['rpm_requirements', 'deb_requirements', 'pip_requirements']:
-                with tempfile.NamedTemporaryFile(suffix=".txt") as temp_requirements:
-                    with open(temp_requirements.name, 'w') as file:
-                        file.write("\n".join(squashed_layer[requirements]))
-                    tar.add(temp_requirements.name, arcname=f"{requirements}.txt")
+            for key in ['rpm_requirements', 'deb_requirements', 'pip_requirements']:
+                data = "\n".join(squashed_layer[key]).encode()
+                archive.add_bytes(tar, f"{key}.txt", data, reproducible=reproducible)
 
             # Add the squashed script to the tarball
-            with tempfile.NamedTemporaryFile(suffix=".sh") as temp_script:
-                with open(temp_script.name, 'w') as file:
-                    file.write(squashed_layer['squash_script'])
-                tar.add(temp_script.name, arcname="squash_script.sh")
-            
-            # Add RPM directory to the tarball
-            tar.add(temp_dir, arcname="rpms")
-
-
-def generate_tarball_filename(name, version):
+            archive.add_bytes(tar, "squash_script.sh", squashed_layer['squash_script'].encode(), mode=0o755, reproducible=reproducible)
+
+            # Add the RPM, DEB and wheel directories to the tarball
+            for directory in directories:
+                archive.add_directory(tar, directory, reproducible)
+
+            # Append packages while the rest is still downloading, only this thread writes to the tarball
+            added = set()
+            for path in iter(completed.get, None):
+                if not reproducible:
+                    archive.add_path(tar, path, os.path.relpath(path, temp_dir))
+                    added.add(path)
+            package_manifest = staging.result()
+
+            # Add the repository metadata, and all packages of a reproducible export in sorted order
+            for directory in directories:
+                for name in sorted(os.listdir(os.path.join(temp_dir, directory))):
+                    path = os.path.join(temp_dir, directory, name)
+                    if path not in added:
+                        archive.add_path(tar, path, f"{directory}/{name}", reproducible)
+
+            # Add the resolved packages so a later export can skip dependency resolution
+            data = json.dumps(package_manifest, indent=1, sort_keys=True).encode()
+            archive.add_bytes(tar, "package-manifest.json", data, reproducible=reproducible)
+    return digest.hexdigest()
+
+
+def generate_tarball_filename(name, version, compression='gz', content_hash=None):
     # Use "dev" if version string is empty
     if not version:
         version = "dev"
 
+    # Reproducible exports are named after their content so identical builds share a name
+    if content_hash:
+        return f"{name}-{version}-{content_hash[:16]}{archive.archive_extension(compression)}"
+
     # Get current date and time
     now = datetime.datetime.now()
     date_time = now.strftime("%Y%m%d-%H%M%S")
 
     # Return the filename
-    return f"{name}-{version}-{date_time}.tar.gz"
+    return f"{name}-{version}-{date_time}{archive.archive_extension(compression)}"
+
 
+def export_to_dir(squashed_layer, data, output_dir, tmp_dir, compression='gz', compression_level=None, reproducible=False,
+                  download_jobs=4, manifest=None, inventory=None, pip_target=None):
+    """
+    Export a squashed layer into a tarball named after the recipe.
+
+    Args:
+        squashed_layer (dict): Squashed layer of configurations
+        data (dict): The parsed recipe
+        output_dir (str): Directory the tarball is written to
+        tmp_dir (str): Path to the temporary directory
+        compression (str): Compression of the tarball, one of archive.COMPRESSIONS
+        compression_level (int): Compression level, the backend default is used if None
+        reproducible (bool): Write a reproducible tarball named after the hash of its content
+        download_jobs (int): Number of packages downloaded in parallel
+        manifest (dict): Package manifest of an earlier export
+        inventory (dict): Packages of the image being upgraded, only missing or outdated packages are bundled
+        pip_target (dict): Python version and platforms the wheels are resolved for, see stage_packages()
 
-def toml_export(toml_file_path, output_dir):
+    Returns:
+        str: Path to the tarball
+    """
+    if not reproducible:
+        filename = generate_tarball_filename(data['name'], data['version'], compression)
+        output_file = os.path.join(output_dir, filename)
+        try:
+            export_squashed_layer(squashed_layer, output_file, tmp_dir, compression, compression_level,
+                                  download_jobs=download_jobs, manifest=manifest, inventory=inventory, pip_target=pip_target)
+        except BaseException:
+            # Do not leave a tarball behind that lacks packages
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+        return output_file
+
+    # The name depends on the content, so write to a hidden file and rename it afterwards.
+    # The file name is unique, exports of the same recipe may run at the same time.
+    fd, partial_file = tempfile.mkstemp(dir=output_dir, prefix=f".{data['name']}.", suffix='.partial')
+    os.close(fd)
+    try:
+        content_hash = export_squashed_layer(squashed_layer, partial_file, tmp_dir, compression, compression_level, reproducible,
+                                             download_jobs, manifest, inventory, pip_target)
+    except BaseException:
+        os.remove(partial_file)
+        raise
+    # mkstemp() only lets the owner read the file, exports are readable like any other tarball
+    os.chmod(partial_file, 0o644)
+    output_file = os.path.join(output_dir, generate_tarball_filename(data['name'], data['version'], compression, content_hash))
+    os.replace(partial_file, output_file)
+    print(f"Reproducible export {output_file} (sha256 {content_hash})")
+    return output_file
+
+
+def toml_export(toml_file_path, output_dir, import_jobs=None, clone_mode=None, reference=None, refresh=False, use_cache=True,
+                compression='gz', compression_level=None, reproducible=False, download_jobs=4, manifest_path=None,
+                pip_target=None):
     """
     Exports layers specified in a TOML file.
 
     Args:
         toml_file_path (str): Path to the TOML file.
         output_dir (str): Path to the output file where the squashed layer will be exported.
+        import_jobs (int): Maximum number of layers to import at the same time.
+        clone_mode (str): How much of each layer repository to fetch, one of CLONE_MODES.
+        reference (bool): Share git objects between branches of the same repository.
+        refresh (bool): Update git layers that are already in the cache before squashing.
+        use_cache (bool): Reuse squash results of unchanged layers. Default is True.
+        compression (str): Compression of the exported tarball, one of archive.COMPRESSIONS. Default is 'gz'.
+        compression_level (int): Compression level, the backend default is used if None
+        reproducible (bool): Write a reproducible tarball named after the hash of its content.
+        download_jobs (int): Number of packages downloaded in parallel. Default is 4.
+        manifest_path (str): Package manifest, or an earlier export containing one, used to skip dependency resolution.
+        pip_target (dict): Python version and platforms of the image the wheels are resolved for, see
+            package_handler.image_pip_target(). Exports with pip requirements fail without it.
+
+    Returns:
+        bool: True if the layers were exported, False otherwise
     """
 
     # Convert input paths to absolute paths
@@ -486,11 +1267,11 @@ def toml_export(toml_file_path, output_dir):
 
     if not os.path.isfile(toml_file_path):
         print(f"File not found: {toml_file_path}")
-        return
+        return False
 
     if not toml_check(toml_file_path):
         print(f"Invalid TOML file: {toml_file_path}")
-        return
+        return False
 
     # Load and parse the TOML file
     with open(toml_file_path, 'r') as file:
@@ -500,31 +1281,60 @@ def toml_export(toml_file_path, output_dir):
 
         data = toml.loads(content)  # Use loads() instead of load()
 
-    if not import_layers(data):
+    if not import_layers(data, max_workers=import_jobs, clone_mode=clone_mode, reference=reference, refresh=refresh):
         print(f"Failed to import layers from {toml}")
-        return
+        return False
 
     with tempfile.TemporaryDirectory() as tmp_dir:
         # Iterate over the layers in the TOML file and squash them
-        squashed_layers = squash_layers(data['layer'], tmp_dir)
-
-        filename = generate_tarball_filename(data['name'], data['version'])
-
-        output_file = os.path.join(output_dir, filename)
+        try:
+            squashed_layers = squash_layers(data['layer'], tmp_dir, use_cache=use_cache, reproducible=reproducible,
+                                            strict_requirements=data.get('strict_requirements', False),
+                                            script_jobs=data.get('script_jobs', 1))
+        except ValueError as e:
+            print(f"Failed to squash layers: {e}")
+            return False
 
         # Export the squashed layer
-        export_squashed_layer(squashed_layers, output_file, tmp_dir)
+        manifest = package_handler.load_manifest(manifest_path) if manifest_path else None
+        try:
+            export_to_dir(squashed_layers, data, output_dir, tmp_dir, compression, compression_level, reproducible,
+                          download_jobs, manifest, pip_target=pip_target)
+        except package_handler.PackageError as e:
+            print(f"Failed to export layers: {e}")
+            return False
     print("Layers exported successfully.")
+    return True
 
 
 
-def toml_upgrade(toml_file_path, output_dir, image_path):
+def toml_upgrade(toml_file_path, output_dir, image_path, import_jobs=None, clone_mode=None, reference=None, refresh=False,
+                 use_cache=True, compression='gz', compression_level=None, reproducible=False, download_jobs=4, manifest_path=None,
+                 delta=False, pip_target=None):
     """
     Exports layers specified in a TOML file.
 
     Args:
         toml_file_path (str): Path to the TOML file.
         output_dir (str): Path to the output file where the squashed layer will be exported.
+        image_path (str): Path to the qcow2 image whose packages are included in the upgrade.
+        delta (bool): Only bundle the packages of the layers that are missing or outdated in the image instead of
+            every package installed in the image. The comparison is recorded in package-manifest.json.
+        import_jobs (int): Maximum number of layers to import at the same time.
+        clone_mode (str): How much of each layer repository to fetch, one of CLONE_MODES.
+        reference (bool): Share git objects between branches of the same repository.
+        refresh (bool): Update git layers that are already in the cache before squashing.
+        use_cache (bool): Reuse squash results of unchanged layers. Default is True.
+        compression (str): Compression of the exported tarball, one of archive.COMPRESSIONS. Default is 'gz'.
+        compression_level (int): Compression level, the backend default is used if None
+        reproducible (bool): Write a reproducible tarball named after the hash of its content.
+        download_jobs (int): Number of packages downloaded in parallel. Default is 4.
+        manifest_path (str): Package manifest, or an earlier export containing one, used to skip dependency resolution.
+        pip_target (dict): Python version and platforms the wheels are resolved for, taken from the python3
+            and glibc packages of the image if None. See package_handler.image_pip_target().
+
+    Returns:
+        bool: True if the layers were exported, False otherwise
     """
 
     # Convert input paths to absolute paths
@@ -533,11 +1343,11 @@ def toml_upgrade(toml_file_path, output_dir, image_path):
 
     if not os.path.isfile(toml_file_path):
         print(f"File not found: {toml_file_path}")
-        return
+        return False
 
     if not toml_check(toml_file_path):
         print(f"Invalid TOML file: {toml_file_path}")
-        return
+        return False
 
     # Load and parse the TOML file
     with open(toml_file_path, 'r') as file:
@@ -547,18 +1357,32 @@ def toml_upgrade(toml_file_path, output_dir, image_path):
 
         data = toml.loads(content)  # Use loads() instead of load()
 
-    if not import_layers(data):
+    if not import_layers(data, max_workers=import_jobs, clone_mode=clone_mode, reference=reference, refresh=refresh):
         print(f"Failed to import layers from {toml}")
-        return
+        return False
 
     with tempfile.TemporaryDirectory() as tmp_dir:
         # Iterate over the layers in the TOML file and squash them
-        squashed_layers = squash_layers(data['layer'], tmp_dir, image_path)
-
-        filename = generate_tarball_filename(data['name'], data['version'])
+        inventory = package_handler.get_image_inventory(image_path) if delta else None
+        try:
+            squashed_layers = squash_layers(data['layer'], tmp_dir, None if delta else image_path, use_cache=use_cache,
+                                            reproducible=reproducible, strict_requirements=data.get('strict_requirements', False),
+                                            script_jobs=data.get('script_jobs', 1))
+        except ValueError as e:
+            print(f"Failed to squash layers: {e}")
+            return False
 
-        output_file = os.path.join(output_dir, filename)
+        # The wheels are resolved for the Python of the image, not the one of the host
+        if pip_target is None and squashed_layers['pip_requirements']:
+            pip_target = package_handler.image_pip_target(inventory or package_handler.get_image_inventory(image_path))
 
         # Export the squashed layer
-        export_squashed_layer(squashed_layers, output_file, tmp_dir)
+        manifest = package_handler.load_manifest(manifest_path) if manifest_path else None
+        try:
+            export_to_dir(squashed_layers, data, output_dir, tmp_dir, compression, compression_level, reproducible,
+                          download_jobs, manifest, inventory, pip_target)
+        except package_handler.PackageError as e:
+            print(f"Failed to export layers: {e}")
+            return False
     print("Layers exported successfully.")
+    return True
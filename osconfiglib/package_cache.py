@@ -0,0 +1,297 @@
+# File: osconfiglib/package_cache.py
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from osconfiglib import utils
+
+# Default size budget of the cache of each package type in bytes
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+# Serializes index updates between threads of the same process, other processes are kept out by a lock file
+index_lock = threading.Lock()
+
+
+def cache_dir(package_type='rpm'):
+    """
+    Get the directory of the persistent package cache.
+
+    Args:
+        package_type (str): Type of the packages ('rpm', 'deb' or 'whl')
+
+    Returns:
+        str: Path to the package cache directory
+    """
+    return os.path.expanduser(f'~/.cache/osconfiglib/.packages/{package_type}')
+
+
+def locked_index(package_type='rpm'):
+    """
+    Lock the index of the package cache for a read, modify and save cycle.
+
+    Args:
+        package_type (str): Type of the packages ('rpm', 'deb' or 'whl')
+
+    Returns:
+        contextlib.AbstractContextManager: Holds the lock while the with block runs
+    """
+    return utils.file_lock(os.path.join(cache_dir(package_type), 'index.json.lock'), index_lock)
+
+
+def load_index(package_type='rpm'):
+    """
+    Load the index of the package cache.
+
+    The index maps package file names to the SHA-256 checksums of the files cached
+    under that name, and those to their NEVRA, size, source URL and last use. A file
+    name may be cached with several checksums, e.g. for a rebuilt package or one from
+    another repository. Package files are stored under objects/ named after their checksum.
+
+    Args:
+        package_type (str): Type of the packages ('rpm', 'deb' or 'whl')
+
+    Returns:
+        dict: The index
+    """
+    index_file = os.path.join(cache_dir(package_type), 'index.json')
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, 'r') as file:
+        index = json.load(file)
+    # Indexes of older versions map file names straight to a single entry
+    return {filename: {entries['sha256']: entries} if 'sha256' in entries else entries
+            for filename, entries in index.items()}
+
+
+def save_index(index, package_type='rpm'):
+    """
+    Save the index of the package cache.
+
+    Args:
+        index (dict): The index returned by load_index()
+        package_type (str): Type of the packages ('rpm', 'deb' or 'whl')
+    """
+    utils.write_json_atomic(os.path.join(cache_dir(package_type), 'index.json'), index, indent=1, sort_keys=True)
+
+
+def object_path(sha256, package_type='rpm'):
+    """
+    Get the path of a cached package file.
+
+    Args:
+        sha256 (str): Checksum of the package file
+        package_type (str): Type of the packages ('rpm', 'deb' or 'whl')
+
+    Returns:
+        str: Path to the package file in the cache
+    """
+    return os.path.join(cache_dir(package_type), 'objects', f"{sha256}.{package_type}")
+
+
+def object_sha256(path):
+    """
+    Get the checksum of a cached package file from its path.
+
+    Args:
+        path (str): Path returned by object_path()
+
+    Returns:
+        str: Checksum of the package file, cached files are named after it
+    """
+    return os.path.basename(path).split('.', 1)[0]
+
+
+def file_sha256(path):
+    """
+    Compute the SHA-256 checksum of a file.
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        str: Hex digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def package_nevra(path, package_type='rpm'):
+    """
+    Read the name, epoch, version, release and architecture of a package file.
+
+    Args:
+        path (str): Path to the package file
+        package_type (str): Type of the package ('rpm', 'deb' or 'whl')
+
+    Returns:
+        str: NEVRA of an rpm, name=version:architecture of a deb, or the file name for other packages
+            and packages that can not be read
+    """
+    if package_type == 'rpm':
+        command = ['rpm', '-qp', '--nosignature', '--queryformat', '%{NAME}-%{EPOCHNUM}:%{VERSION}-%{RELEASE}.%{ARCH}', path]
+    elif package_type == 'deb':
+        command = ['dpkg-deb', '--showformat', '${Package}=${Version}:${Architecture}', '--show', path]
+    else:
+        return os.path.basename(path)
+    try:
+        return subprocess.check_output(command, universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return os.path.basename(path)
+
+
+def link_file(source, destination):
+    """
+    Make a package file from the cache available at destination without copying it if possible.
+
+    A hard link is tried first, then a reflink copy, then a regular copy.
+
+    Args:
+        source (str): Path to the cached file
+        destination (str): Path to create
+    """
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    if shutil.which('cp') and subprocess.run(['cp', '--reflink=auto', source, destination], check=False).returncode == 0:
+        return
+    shutil.copy2(source, destination)
+
+
+def find_entry(index, filename, sha256=None, url=None):
+    """
+    Find the index entry of a package.
+
+    Args:
+        index (dict): The index returned by load_index()
+        filename (str): File name of the package
+        sha256 (str): Checksum of the package
+        url (str): URL the package was downloaded from, used if the checksum is not known
+
+    Returns:
+        dict: The entry, or None if the package is not cached. A file name alone never
+            matches, the same name may stand for a different build.
+    """
+    entries = index.get(filename, {})
+    if sha256 is not None:
+        return entries.get(sha256)
+    matches = [entry for entry in entries.values() if url is not None and entry.get('url') == url]
+    return max(matches, key=lambda entry: entry['last_used']) if matches else None
+
+
+def lookup_package(filename, sha256=None, package_type='rpm', url=None):
+    """
+    Find a package file in the cache and record its use.
+
+    Args:
+        filename (str): File name of the package
+        sha256 (str): Expected checksum of the package
+        package_type (str): Type of the package ('rpm', 'deb' or 'whl')
+        url (str): URL the package is downloaded from, matched if sha256 is None
+
+    Returns:
+        str: Path to the package in the cache, or None if it is not cached
+    """
+    with locked_index(package_type):
+        index = load_index(package_type)
+        entry = find_entry(index, filename, sha256, url)
+        if entry is None or not os.path.exists(object_path(entry['sha256'], package_type)):
+            return None
+        # Packages are evicted least recently used first, so a cache hit counts as a use
+        entry['last_used'] = time.time()
+        save_index(index, package_type)
+    return object_path(entry['sha256'], package_type)
+
+
+def ingest_packages(paths, package_type='rpm', max_bytes=DEFAULT_MAX_BYTES, checksums=None, urls=None):
+    """
+    Move downloaded package files into the cache.
+
+    Args:
+        paths (list): Paths to the downloaded package files. They should be on the same
+            file system as the cache so that they can be moved without copying.
+        package_type (str): Type of the packages ('rpm', 'deb' or 'whl')
+        max_bytes (int): Size budget of the cache, enforced after the packages are added
+        checksums (dict): Already known SHA-256 checksums of some of the paths
+        urls (dict): URLs some of the paths were downloaded from
+
+    Returns:
+        dict: Mapping of file name to the path of the package in the cache
+    """
+    os.makedirs(os.path.join(cache_dir(package_type), 'objects'), exist_ok=True)
+    ingested = {}
+    entries = []
+    for path in paths:
+        sha256 = (checksums or {}).get(path) or file_sha256(path)
+        destination = object_path(sha256, package_type)
+        entries.append((os.path.basename(path), {
+            'sha256': sha256,
+            'nevra': package_nevra(path, package_type),
+            'size': os.path.getsize(path),
+            'url': (urls or {}).get(path),
+            'last_used': time.time(),
+        }))
+        try:
+            os.replace(path, destination)
+        except OSError:
+            shutil.copy2(path, destination)
+        ingested[os.path.basename(path)] = destination
+
+    with locked_index(package_type):
+        index = load_index(package_type)
+        for filename, entry in entries:
+            index.setdefault(filename, {})[entry['sha256']] = entry
+        save_index(index, package_type)
+
+    evict(package_type, max_bytes=max_bytes)
+    return ingested
+
+
+def evict(package_type='rpm', max_bytes=None, max_age_days=None):
+    """
+    Remove packages from the cache.
+
+    Packages that were not used for max_age_days are removed first, then the least
+    recently used packages until the cache fits in max_bytes. Files that were linked
+    out of the cache stay intact.
+
+    Args:
+        package_type (str): Type of the packages ('rpm', 'deb' or 'whl')
+        max_bytes (int): Size budget of the cache, not enforced if None
+        max_age_days (float): Maximum number of days since a package was last used, not enforced if None
+
+    Returns:
+        int: Number of bytes reclaimed
+    """
+    reclaimed = 0
+    with locked_index(package_type):
+        index = load_index(package_type)
+        by_last_use = sorted(((filename, entry) for filename, entries in index.items() for entry in entries.values()),
+                             key=lambda item: item[1]['last_used'])
+        total = sum(entry['size'] for filename, entry in by_last_use)
+        cutoff = None if max_age_days is None else time.time() - max_age_days * 86400
+
+        for filename, entry in by_last_use:
+            too_old = cutoff is not None and entry['last_used'] < cutoff
+            too_big = max_bytes is not None and total > max_bytes
+            if not too_old and not too_big:
+                continue
+            # Several file names may share an object, only remove it when it is no longer referenced
+            del index[filename][entry['sha256']]
+            if not index[filename]:
+                del index[filename]
+            total -= entry['size']
+            if not any(entry['sha256'] in entries for entries in index.values()):
+                path = object_path(entry['sha256'], package_type)
+                if os.path.exists(path):
+                    os.remove(path)
+                    reclaimed += entry['size']
+        save_index(index, package_type)
+    return reclaimed
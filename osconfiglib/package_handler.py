@@ -1,45 +1,208 @@
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import re
+import shutil
 import subprocess
+import tarfile
 import tempfile
-import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+from osconfiglib import package_cache, utils, versions
+
+# Serializes updates of the repository metadata kept in the package cache between threads,
+# other processes are kept out by a lock file
+metadata_lock = threading.Lock()
+
 
-def download_deb_packages(package_list, download_dir):
+class PackageError(Exception):
     """
-    Downloads DEB packages and their dependencies.
-    
-    :param package_list: A list of package names to download.
-    :param download_dir: The directory where packages will be downloaded.
+    Raised when packages can not be resolved, downloaded or built.
     """
-    # Ensure the download directory exists
-    os.makedirs(download_dir, exist_ok=True)
 
-    for package in package_list:
-        try:
-            # Simulate installing the package to capture dependency information
-            simulate_cmd = ['apt-get', 'install', '--simulate', package]
-            simulate_output = subprocess.check_output(simulate_cmd, universal_newlines=True)
 
-            # Extract package names from the simulation output
-            # This step needs refinement to accurately parse package names and versions
-            # depending on your specific requirements and the output format
-            
-            # TODO: add support for apt-get packages. 
-            extracted_packages = [] # need to actually implement this.. 
-            print(f"We currently do not support apt-get package downloads")
+def parse_rpm_filename(filename):
+    """
+    Splits an RPM file name into its name, version, release and architecture.
+
+    :param filename: File name of the form name-version-release.arch.rpm
+    :return: A tuple of (name, version, release, arch).
+    """
+    nvr, arch = filename[:-len('.rpm')].rsplit('.', 1)
+    name, version, release = nvr.rsplit('-', 2)
+    return name, version, release, arch
+
+
+def temporary_dnf_config():
+    """
+    Writes a temporary DNF config to avoid system changes.
+
+    :return: Path to the config file, the caller removes it.
+    """
+    fd, dnf_config = tempfile.mkstemp(suffix=".conf")
+    with os.fdopen(fd, "w") as config_file:
+        config_file.write("[main]\ngpgcheck=0\n")
+    return dnf_config
+
+
+def resolve_rpm_manifest(package_list):
+    """
+    Resolves RPM packages and all of their dependencies into a manifest.
+
+    The manifest lists the exact packages to download, so it can be reused to skip
+    dependency resolution on a later build.
+
+    :param package_list: A list of package names to resolve.
+    :return: A list of manifest entries with the name, epoch, version, release, arch,
+             filename and url of each package.
+    """
+    dnf_config = temporary_dnf_config()
+    try:
+        dnf_command = [
+            "dnf", "download", "--quiet", "--url", "--alldeps", "--resolve",
+            "--config", dnf_config
+        ] + package_list
+        output = subprocess.check_output(dnf_command, universal_newlines=True)
+        urls = [line.strip() for line in output.splitlines() if '://' in line and line.strip().endswith('.rpm')]
 
-            # For each package/dependency, download it using `apt-get download`
-            for pkg in extracted_packages:
-                download_cmd = ['apt-get', 'download', pkg, '-o=dir::cache=' + download_dir]
-                subprocess.run(download_cmd, check=True, cwd=download_dir)
-        except subprocess.CalledProcessError as e:
-            print(f"Error downloading package {package}: {e}")
+        packages = []
+        for url in urls:
+            filename = url.rsplit('/', 1)[-1]
+            name, version, release, arch = parse_rpm_filename(filename)
+            packages.append({'name': name, 'epoch': '0', 'version': version, 'release': release,
+                             'arch': arch, 'filename': filename, 'url': url})
+
+        # File names do not carry the epoch, query it for the whole closure at once
+        if packages:
+            repoquery_command = [
+                "dnf", "repoquery", "--quiet", "--config", dnf_config,
+                "--queryformat", "%{name}-%{version}-%{release}.%{arch} %{epoch}\n"
+            ] + [package['filename'][:-len('.rpm')] for package in packages]
+            epochs = dict(line.split() for line in subprocess.check_output(repoquery_command, universal_newlines=True).splitlines() if line.strip())
+            for package in packages:
+                package['epoch'] = epochs.get(package['filename'][:-len('.rpm')], '0')
+    finally:
+        os.remove(dnf_config)
 
+    return packages
+
+
+def verify_package(path, package, package_type):
+    """
+    Verifies a downloaded package.
+
+    The SHA-256 checksum is compared with the manifest when it is known, otherwise
+    the digests embedded in an RPM are checked with rpm -K.
+
+    :param path: Path to the downloaded file.
+    :param package: The manifest entry of the package.
+    :param package_type: The type of the package ('rpm' or 'deb').
+    :return: The SHA-256 checksum of the file.
+    :raises ValueError: If the package is corrupt.
+    """
+    sha256 = package_cache.file_sha256(path)
+    if package.get('sha256'):
+        if sha256 != package['sha256']:
+            raise ValueError(f"checksum mismatch, expected {package['sha256']} but got {sha256}")
+    elif package_type == 'rpm' and shutil.which('rpm'):
+        result = subprocess.run(['rpm', '-K', '--nosignature', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        if result.returncode != 0:
+            raise ValueError("digest check failed")
+    return sha256
+
+
+def fetch_package(package, package_type, retries=3):
+    """
+    Downloads a single package into the package cache.
 
-def download_rpm_packages(package_list, download_dir):
+    :param package: The manifest entry of the package, its sha256 is set once verified.
+    :param package_type: The type of the package ('rpm' or 'deb').
+    :param retries: How many times a failed download is attempted again.
+    :return: Path to the package in the cache.
+    """
+    os.makedirs(package_cache.cache_dir(package_type), exist_ok=True)
+    for attempt in range(retries + 1):
+        # Download next to the cache so that the package is moved into it without copying
+        with tempfile.TemporaryDirectory(dir=package_cache.cache_dir(package_type)) as staging_dir:
+            path = os.path.join(staging_dir, package['filename'])
+            try:
+                with urllib.request.urlopen(package['url'], timeout=60) as response, open(path, 'wb') as file:
+                    shutil.copyfileobj(response, file, 1024 * 1024)
+                sha256 = verify_package(path, package, package_type)
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                if attempt == retries:
+                    raise
+                print(f"Retrying download of {package['filename']}: {e}")
+                time.sleep(2 ** attempt)
+                continue
+
+            package['sha256'] = sha256
+            return package_cache.ingest_packages([path], package_type, checksums={path: sha256}, urls={path: package['url']})[package['filename']]
+
+
+def fetch_packages(packages, package_type='rpm', jobs=4, retries=3, on_complete=None):
+    """
+    Makes all packages of a manifest available in the package cache.
+
+    Cached packages are used as they are, missing ones are downloaded by a pool of
+    parallel workers. The sha256 of every entry is set, so a manifest written after
+    a fetch can be verified on a rebuild.
+
+    :param packages: A list of manifest entries.
+    :param package_type: The type of the packages ('rpm' or 'deb').
+    :param jobs: The number of parallel downloads.
+    :param retries: How many times a failed download is attempted again.
+    :param on_complete: Called with the manifest entry and the cached path of each package as soon as it is available.
+    :return: A list of the manifest entries that could not be downloaded.
+    """
+    missing = []
+    for package in packages:
+        path = package_cache.lookup_package(package['filename'], package.get('sha256'), package_type, package.get('url'))
+        if path is None:
+            missing.append(package)
+            continue
+        package['sha256'] = package_cache.object_sha256(path)
+        if on_complete:
+            on_complete(package, path)
+    print(f"{len(packages) - len(missing)} of {len(packages)} packages found in the package cache")
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(fetch_package, package, package_type, retries): package for package in missing}
+        for future in concurrent.futures.as_completed(futures):
+            package = futures[future]
+            try:
+                path = future.result()
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                print(f"Error downloading package {package['filename']}: {e}")
+                failed.append(package)
+                continue
+            if on_complete:
+                on_complete(package, path)
+    return failed
+
+
+def download_rpm_packages(package_list, download_dir, jobs=4, manifest=None, inventory=None, on_package=None):
     """
     Downloads the specified RPM packages and their dependencies to a given directory.
-    
+
+    The dependency closure is resolved into a manifest first, then the packages are
+    downloaded by parallel workers into a persistent cache (see package_cache) and
+    linked into download_dir. Packages that are already cached are not downloaded.
+
     :param package_list: A list of package names to download.
     :param download_dir: The directory where packages will be downloaded.
+    :param jobs: The number of parallel downloads.
+    :param manifest: A list of manifest entries from an earlier build, dependency resolution is skipped if given.
+    :param inventory: An image inventory from get_image_inventory(), only packages that are missing or
+                      outdated in the image are downloaded if given.
+    :param on_package: Called with the path of each package in download_dir as soon as it is linked there.
+    :return: The manifest entries of the resolved packages.
+    :raises PackageError: If the packages can not be resolved or downloaded.
 
 
     example:
@@ -51,86 +214,558 @@ def download_rpm_packages(package_list, download_dir):
     """
     # Ensure the download directory exists
     os.makedirs(download_dir, exist_ok=True)
-    
-    # Temporary DNF config to avoid system changes
-    temp_dnf_config = "/tmp/temp_dnf.conf"
-    with open(temp_dnf_config, "w") as config_file:
-        config_file.write("[main]\ngpgcheck=0\n")
+    if not package_list:
+        return []
+
+    try:
+        if manifest is None:
+            manifest = resolve_rpm_manifest(package_list)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise PackageError(f"Error resolving packages: {e}") from e
+
+    download_manifest(compare_with_inventory(manifest, inventory, 'rpm'), download_dir, 'rpm', jobs, on_package)
+    return manifest
+
+
+def compare_with_inventory(packages, inventory, package_type):
+    """
+    Compares resolved packages with the packages installed in an image.
+
+    Each manifest entry gets a 'delta' status: 'new' if the image does not have the
+    package, 'newer' if the image has an older version, 'installed' if it has the same
+    version and 'older' if it has a newer one. Packages are matched by name and arch,
+    or by name alone if the image has the package for another arch.
+
+    :param packages: A list of manifest entries, they are updated in place.
+    :param inventory: An image inventory from get_image_inventory(), or None.
+    :param package_type: The type of the packages ('rpm' or 'deb').
+    :return: The manifest entries that are new or newer than in the image, all entries if there is no inventory.
+    """
+    if inventory is None or inventory['package_type'] != package_type:
+        # Drop the results of a comparison recorded in a reused manifest
+        for package in packages:
+            package.pop('delta', None)
+            package.pop('installed', None)
+        return packages
+
+    installed = {}
+    for package in inventory['packages']:
+        installed[(package['name'], package['arch'])] = package
+        installed.setdefault(package['name'], package)
+
+    delta = []
+    for package in packages:
+        image_package = installed.get((package['name'], package['arch'])) or installed.get(package['name'])
+        if image_package is None:
+            package['delta'] = 'new'
+        else:
+            if package_type == 'rpm':
+                comparison = versions.compare_rpm_evr(package, image_package)
+                package['installed'] = f"{image_package['epoch']}:{image_package['version']}-{image_package['release']}"
+            else:
+                comparison = versions.debvercmp(package['version'], image_package['version'])
+                package['installed'] = image_package['version']
+            package['delta'] = {1: 'newer', 0: 'installed', -1: 'older'}[comparison]
+        if package['delta'] in ('new', 'newer'):
+            delta.append(package)
+
+    print(f"{len(delta)} of {len(packages)} {package_type} packages are missing or outdated in the image")
+    return delta
+
+
+def download_manifest(packages, download_dir, package_type, jobs=4, on_package=None):
+    """
+    Downloads the packages of a manifest and links them into a directory.
+
+    :param packages: A list of manifest entries.
+    :param download_dir: The directory where packages will be linked.
+    :param package_type: The type of the packages ('rpm' or 'deb').
+    :param jobs: The number of parallel downloads.
+    :param on_package: Called with the path of each package in download_dir as soon as it is linked there.
+    :raises PackageError: If a package could not be downloaded.
+    """
+    def link(package, path):
+        destination = os.path.join(download_dir, package['filename'])
+        if not os.path.exists(destination):
+            package_cache.link_file(path, destination)
+            if on_package:
+                on_package(destination)
+
+    failed = fetch_packages(packages, package_type, jobs, on_complete=link)
+    if failed:
+        raise PackageError(f"Error downloading packages: {', '.join(package['filename'] for package in failed)}")
+    print(f"Downloaded packages and dependencies to {download_dir}")
+
+
+def resolve_deb_manifest(package_list):
+    """
+    Resolves DEB packages and all of their dependencies into a manifest.
 
-    # Prepare the DNF download command
-    dnf_command = [
-        "dnf", "download", "--alldeps", "--resolve",
-        "--destdir", download_dir,
-        "--config", temp_dnf_config
+    The closure of all packages is resolved by a single simulated apt-get install
+    against an empty dpkg status, so the solver picks one package of every
+    alternative (A | B) and one provider of every virtual package, exactly like an
+    install on a fresh system. The download URLs and checksums of the whole closure
+    come out of the same pass.
+
+    :param package_list: A list of package names, optionally pinned as name=version.
+    :return: A list of manifest entries with the name, version, arch, filename, url, size
+             and sha256 of each package.
+    """
+    download_command = [
+        'apt-get', 'install', '--print-uris', '--quiet', '--quiet', '--yes', '--no-install-recommends',
+        '-o', 'Dir::State::status=/dev/null', '-o', 'Debug::NoLocking=1'
     ] + package_list
-    
+    download_output = subprocess.check_output(download_command, universal_newlines=True)
+
+    packages = []
+    for line in download_output.splitlines():
+        # 'url' filename size checksum
+        parts = line.split()
+        if len(parts) < 3 or not parts[0].startswith("'"):
+            continue
+        filename = parts[1]
+        name, version, arch = urllib.parse.unquote(filename[:-len('.deb')]).split('_')
+        package = {'name': name, 'version': version, 'arch': arch, 'filename': filename,
+                   'url': parts[0].strip("'"), 'size': int(parts[2])}
+        if len(parts) > 3 and parts[3].startswith('SHA256:'):
+            package['sha256'] = parts[3][len('SHA256:'):]
+        packages.append(package)
+    return packages
+
+
+def download_deb_packages(package_list, download_dir, jobs=4, manifest=None, inventory=None, on_package=None):
+    """
+    Downloads DEB packages and their dependencies.
+
+    The dependency closure is resolved into a manifest in a single pass, then the
+    packages are downloaded by parallel workers into a persistent cache (see
+    package_cache) and linked into download_dir.
+
+    :param package_list: A list of package names to download, optionally pinned as name=version.
+    :param download_dir: The directory where packages will be downloaded.
+    :param jobs: The number of parallel downloads.
+    :param manifest: A list of manifest entries from an earlier build, dependency resolution is skipped if given.
+    :param inventory: An image inventory from get_image_inventory(), only packages that are missing or
+                      outdated in the image are downloaded if given.
+    :param on_package: Called with the path of each package in download_dir as soon as it is linked there.
+    :return: The manifest entries of the resolved packages.
+    :raises PackageError: If the packages can not be resolved or downloaded.
+    """
+    # Ensure the download directory exists
+    os.makedirs(download_dir, exist_ok=True)
+    if not package_list:
+        return []
+
     try:
-        # Execute the DNF command to download packages and dependencies
-        subprocess.run(dnf_command, check=True)
-        print(f"Downloaded packages and dependencies to {download_dir}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error downloading packages: {e}")
-    finally:
-        # Cleanup: remove temporary DNF config
-        os.remove(temp_dnf_config)
+        if manifest is None:
+            manifest = resolve_deb_manifest(package_list)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise PackageError(f"Error resolving packages: {e}") from e
+
+    download_manifest(compare_with_inventory(manifest, inventory, 'deb'), download_dir, 'deb', jobs, on_package)
+    return manifest
+
+
+def parse_pip_report(report):
+    """
+    Parses the installation report of pip into a manifest.
 
-def download_packages(package_list, download_dir, package_type='rpm'):
+    :param report: The report written by pip install --dry-run --report.
+    :return: A list of manifest entries with the name, version, filename, url and, if pip knows it,
+             the sha256 of each distribution.
+    """
+    packages = []
+    for item in report['install']:
+        name, version = item['metadata']['name'], item['metadata']['version']
+        download_info = item['download_info']
+        archive_info = download_info.get('archive_info')
+        if archive_info is None:
+            # Version control and local directory requirements can not be put in a wheelhouse
+            print(f"Skipping {name} {version}: only archives can be bundled, not {download_info['url']}")
+            continue
+
+        url = download_info['url']
+        package = {'name': name, 'version': version,
+                   'filename': urllib.parse.unquote(urllib.parse.urlparse(url).path.rsplit('/', 1)[-1]), 'url': url}
+        sha256 = archive_info.get('hashes', {}).get('sha256')
+        if sha256 is None and archive_info.get('hash', '').startswith('sha256='):
+            sha256 = archive_info['hash'][len('sha256='):]
+        if sha256:
+            package['sha256'] = sha256
+        packages.append(package)
+    return packages
+
+
+# Wheel architecture tags of the rpm and deb architectures that differ from them
+WHEEL_ARCHES = {'amd64': 'x86_64', 'arm64': 'aarch64', 'i386': 'i686', 'ppc64el': 'ppc64le', 'armhf': 'armv7l'}
+
+
+def pip_platforms(arch, glibc_version):
+    """
+    Lists the platform tags of the wheels that run on a glibc based system.
+
+    :param arch: The rpm or deb architecture of the system, e.g. x86_64 or amd64.
+    :param glibc_version: The version of the glibc of the system, e.g. 2.37.
+    :return: The manylinux tags from the glibc version down to manylinux2014, newest first.
+    """
+    arch = WHEEL_ARCHES.get(arch, arch)
+    minor = int(re.match(r'(?:\d+:)?2\.(\d+)', glibc_version).group(1))
+    # manylinux2014 is manylinux_2_17, pip adds the older manylinux2010 and manylinux1 tags itself
+    return [f'manylinux_2_{glibc_minor}_{arch}' for glibc_minor in range(minor, 16, -1)] + [f'manylinux2014_{arch}']
+
+
+def image_pip_target(inventory, python='python3'):
+    """
+    Gets the Python version and platform of an image from its inventory.
+
+    :param inventory: An image inventory from get_image_inventory().
+    :param python: The Python interpreter of the image, its version is used if the name has one (e.g. python3.11).
+    :return: A dict with the python_version and the platforms of the image, or None if the image has no
+             python3 or glibc package.
+    """
+    packages = {package['name']: package for package in inventory['packages']}
+    glibc = packages.get('glibc' if inventory['package_type'] == 'rpm' else 'libc6')
+    if glibc is None:
+        return None
+    match = re.fullmatch(r'python(\d+\.\d+)', os.path.basename(python))
+    if match:
+        python_version = match.group(1)
+    elif 'python3' in packages:
+        python_version = re.match(r'(?:\d+:)?(\d+\.\d+)', packages['python3']['version']).group(1)
+    else:
+        return None
+    return {'python_version': python_version, 'platforms': pip_platforms(glibc['arch'], glibc['version'])}
+
+
+def pip_target_options(pip_target):
+    """
+    Builds the pip options that resolve requirements for the Python of the target instead of the host.
+
+    Only binary wheels are accepted, source distributions would be built for the host.
+
+    :param pip_target: A dict with the python_version (e.g. 3.11) and the platforms (e.g. manylinux_2_34_x86_64)
+                       of the target, see image_pip_target().
+    :return: A list of pip options.
+    """
+    options = ['--python-version', pip_target['python_version'], '--implementation', 'cp', '--only-binary=:all:']
+    for platform in pip_target['platforms']:
+        options += ['--platform', platform]
+    return options
+
+
+def resolve_pip_manifest(package_list, pip_target):
+    """
+    Resolves pip requirements and all of their dependencies into a manifest.
+
+    The resolution runs on the host with pip install --dry-run, for the Python version
+    and platform of the target, see pip_target_options().
+
+    :param package_list: A list of pip requirements.
+    :param pip_target: A dict with the python_version and the platforms of the target.
+    :return: A list of manifest entries, see parse_pip_report().
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        requirements_file = os.path.join(temp_dir, 'requirements.txt')
+        with open(requirements_file, 'w') as file:
+            file.write("\n".join(package_list) + "\n")
+        report_file = os.path.join(temp_dir, 'report.json')
+        # pip only takes platform options for a --target install, nothing is installed with --dry-run
+        subprocess.run(['python3', '-m', 'pip', 'install', '--dry-run', '--quiet', '--ignore-installed',
+                        '--target', os.path.join(temp_dir, 'target'), *pip_target_options(pip_target),
+                        '--report', report_file, '-r', requirements_file], check=True)
+        with open(report_file, 'r') as file:
+            return parse_pip_report(json.load(file))
+
+
+def download_pip_packages(package_list, download_dir, jobs=4, manifest=None, pip_target=None, on_package=None):
+    """
+    Builds a wheelhouse for pip requirements and their dependencies.
+
+    The dependency closure is resolved into a manifest of wheels for the Python version
+    and platform of the target first, then the wheels are downloaded by parallel workers
+    into the package cache and linked into download_dir, so the image installs them with
+    pip install --no-index --find-links.
+
+    :param package_list: A list of pip requirements.
+    :param download_dir: The directory of the wheelhouse.
+    :param jobs: The number of parallel downloads.
+    :param manifest: A list of manifest entries from an earlier build, dependency resolution is skipped if given.
+    :param pip_target: A dict with the python_version and the platforms of the target, see image_pip_target().
+    :param on_package: Called with the path of each wheel in download_dir as soon as it is linked there.
+    :return: The manifest entries of the resolved distributions.
+    :raises PackageError: If the target is not known or the requirements can not be resolved or downloaded.
+    """
+    os.makedirs(download_dir, exist_ok=True)
+    if not package_list:
+        return []
+    if pip_target is None:
+        # Wheels resolved for the host may not match the Python version or the platform of the target
+        raise PackageError("The Python version and platform of the target are not known, not building a wheelhouse "
+                           "for the host")
+
+    try:
+        if manifest is None:
+            manifest = resolve_pip_manifest(package_list, pip_target)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise PackageError(f"Error resolving pip requirements: {e}") from e
+
+    sdists = [package for package in manifest if not package['filename'].endswith('.whl')]
+    if sdists:
+        raise PackageError(f"Only wheels can be bundled: {', '.join(package['filename'] for package in sdists)}")
+
+    def link(package, path):
+        destination = os.path.join(download_dir, package['filename'])
+        if not os.path.exists(destination):
+            package_cache.link_file(path, destination)
+            if on_package:
+                on_package(destination)
+
+    failed = fetch_packages(manifest, 'whl', jobs, on_complete=link)
+    if failed:
+        raise PackageError(f"Error bundling pip requirements: {', '.join(package['filename'] for package in failed)}")
+    print(f"Built the wheelhouse in {download_dir}")
+    return manifest
+
+
+def download_packages(package_list, download_dir, package_type='rpm', jobs=4, manifest=None, inventory=None, on_package=None):
     """
     Downloads packages and their dependencies based on the system's package management type.
     
     :param package_list: A list of package names to download.
     :param download_dir: The directory where packages will be downloaded.
     :param package_type: The type of package management system ('rpm' or 'deb').
+    :param jobs: The number of parallel downloads.
+    :param manifest: A list of manifest entries from an earlier build, dependency resolution is skipped if given.
+    :param inventory: An image inventory from get_image_inventory(), only packages that are missing or
+                      outdated in the image are downloaded if given.
+    :param on_package: Called with the path of each package in download_dir as soon as it is linked there.
+    :return: The manifest entries of the resolved packages.
+    :raises PackageError: If the packages can not be resolved or downloaded.
     """
     if package_type == 'rpm':
         # Call the function for downloading RPM packages (as previously defined)
-        download_rpm_packages(package_list, download_dir)
+        return download_rpm_packages(package_list, download_dir, jobs, manifest, inventory, on_package)
     elif package_type == 'deb':
         # Call the function for downloading DEB packages
-        download_deb_packages(package_list, download_dir)
+        return download_deb_packages(package_list, download_dir, jobs, manifest, inventory, on_package)
     else:
         print("Unsupported package type.")
+        return []
 
 
-def extract_packages_qcow2(image_path):
+def load_manifest(path):
     """
-    Extracts a list of packages from a given qcow2 image, automatically determining
-    if the system uses RPM or DEB packages.
-    
+    Loads a package manifest.
+
+    :param path: Path to a manifest JSON file, or to an exported tarball that contains package-manifest.json.
+    :return: The manifest, a dict with one section per package type.
+    """
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path) as tar:
+            return json.load(tar.extractfile('package-manifest.json'))
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def manifest_packages(manifest, requirements, package_type, target=None):
+    """
+    Gets the packages of a manifest section if it was resolved for the same requirements.
+
+    :param manifest: A manifest returned by load_manifest(), or None.
+    :param requirements: The current list of requirements.
+    :param package_type: The type of the packages ('rpm', 'deb' or 'pip').
+    :param target: The target the packages are resolved for, the pip_target of pip requirements.
+    :return: The list of manifest entries, or None if the requirements need to be resolved again.
+    """
+    section = (manifest or {}).get(package_type)
+    if section is None:
+        return None
+    if section['requirements'] != list(requirements):
+        print(f"The {package_type} requirements changed since the manifest was created, resolving them again")
+        return None
+    if section.get('target') != target:
+        print(f"The {package_type} requirements were resolved for another target, resolving them again")
+        return None
+    if section['requirements'] and not section['packages']:
+        # Written by an export whose dependency resolution failed
+        print(f"The {package_type} requirements were not resolved when the manifest was created, resolving them again")
+        return None
+    return section['packages']
+
+
+def parse_dpkg_status(status):
+    """
+    Parses the installed packages out of a dpkg status file.
+
+    :param status: Content of /var/lib/dpkg/status
+    :return: A list of dicts with the name, version and arch of each installed package.
+    """
+    packages = []
+    for stanza in status.split('\n\n'):
+        fields = {}
+        for line in stanza.splitlines():
+            if line and not line[0].isspace() and ':' in line:
+                key, value = line.split(':', 1)
+                fields[key] = value.strip()
+        if fields.get('Status', '').endswith(' installed') and 'Package' in fields:
+            packages.append({'name': fields['Package'], 'version': fields.get('Version', ''), 'arch': fields.get('Architecture', '')})
+    return packages
+
+
+def parse_rpm_query(output):
+    """
+    Parses the output of an rpm query using RPM_QUERY_FORMAT.
+
+    :param output: Output of rpm -qa
+    :return: A list of dicts with the name, epoch, version, release and arch of each package.
+    """
+    packages = []
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        name, epoch, version, release, arch = line.split('\t')
+        if name != 'gpg-pubkey':
+            packages.append({'name': name, 'epoch': epoch, 'version': version, 'release': release, 'arch': arch})
+    return packages
+
+
+RPM_QUERY_FORMAT = '%{NAME}\t%{EPOCHNUM}\t%{VERSION}\t%{RELEASE}\t%{ARCH}\n'
+
+
+def read_image_inventory(image_path):
+    """
+    Reads the package database files out of an image without mounting it.
+
+    The RPM database is queried on the host with rpm --dbpath and the dpkg status
+    file is parsed directly, so no FUSE mount or chroot is needed.
+
+    :param image_path: Path to the qcow2 image
+    :return: An inventory dict, or None if the databases could not be read on the host.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # A leading dash tells guestfish to ignore the error of a missing path
+        script = (
+            f"-copy-out /usr/lib/sysimage/rpm {temp_dir}/sysimage\n"
+            f"-copy-out /var/lib/rpm {temp_dir}\n"
+            f"-download /var/lib/dpkg/status {temp_dir}/status\n"
+        )
+        os.makedirs(os.path.join(temp_dir, 'sysimage'))
+        try:
+            subprocess.run(['guestfish', '--ro', '-a', image_path, '-i'], input=script, universal_newlines=True, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Could not read the package databases of {image_path}: {e}")
+            return None
+
+        if os.path.exists(os.path.join(temp_dir, 'status')):
+            with open(os.path.join(temp_dir, 'status'), 'r') as file:
+                return {'package_type': 'deb', 'packages': parse_dpkg_status(file.read())}
+
+        for dbpath in [os.path.join(temp_dir, 'sysimage', 'rpm'), os.path.join(temp_dir, 'rpm')]:
+            if not os.path.isdir(dbpath) or not os.listdir(dbpath):
+                continue
+            try:
+                output = subprocess.check_output(['rpm', '-qa', '--dbpath', dbpath, '--queryformat', RPM_QUERY_FORMAT],
+                                                 universal_newlines=True, stderr=subprocess.DEVNULL)
+            except (OSError, subprocess.CalledProcessError):
+                # e.g. the host rpm does not support the database backend of the image
+                continue
+            return {'package_type': 'rpm', 'packages': parse_rpm_query(output)}
+    return None
+
+
+def mount_image_inventory(image_path):
+    """
+    Lists the packages of an image by mounting it and querying the package manager in a chroot.
+
     :param image_path: Path to the qcow2 image
-    :return: A tuple of (package_list, package_type) where package_list is a list of packages installed
-             in the image, and package_type is either 'rpm' or 'deb'
+    :return: An inventory dict.
     """
     mount_point = tempfile.mkdtemp()
-    package_list = []
-    package_type = None
-    
     try:
         subprocess.run(['guestmount', '-a', image_path, '-i', '--ro', mount_point], check=True)
         
         # Check for RPM or DEB system by attempting to list installed packages
         try:
-            rpm_output = subprocess.check_output(['chroot', mount_point, 'rpm', '-qa', '--queryformat', '%{NAME}\n'], universal_newlines=True)
-            package_list = [line for line in rpm_output.strip().split('\n') if not line.startswith('gpg-pubkey')]
-            package_type = 'rpm'
+            rpm_output = subprocess.check_output(['chroot', mount_point, 'rpm', '-qa', '--queryformat', RPM_QUERY_FORMAT], universal_newlines=True)
+            return {'package_type': 'rpm', 'packages': parse_rpm_query(rpm_output)}
         except subprocess.CalledProcessError:
-            dpkg_output = subprocess.check_output(['chroot', mount_point, 'dpkg', '-l'], universal_newlines=True)
-            for line in dpkg_output.split('\n'):
-                if line.startswith("ii"):
-                    parts = line.split()
-                    package_list.append(parts[1] + "=" + parts[2])  # package_name=version
-            package_type = 'deb'
+            with open(os.path.join(mount_point, 'var', 'lib', 'dpkg', 'status'), 'r') as file:
+                return {'package_type': 'deb', 'packages': parse_dpkg_status(file.read())}
     finally:
-        subprocess.run(['guestunmount', mount_point], check=True)
+        # Raising here would hide the error that got us here, e.g. a failed guestmount
+        result = subprocess.run(['guestunmount', mount_point], check=False)
+        if result.returncode != 0:
+            print(f"Failed to unmount {image_path} from {mount_point} (exit code {result.returncode})")
+        else:
+            os.rmdir(mount_point)
 
-    # TODO: is it important to have package type returns? 
-    # return package_list, package_type
-    return package_list
+
+def image_cache_key(image_path, content_hash=False):
+    """
+    Builds the key of an image in the inventory cache.
+
+    :param image_path: Path to the qcow2 image
+    :param content_hash: Hash the content of the image instead of using its size, modification time and inode.
+    :return: A hex digest identifying the image.
+    """
+    if content_hash:
+        return package_cache.file_sha256(image_path)
+    stat = os.stat(image_path)
+    identity = f"{os.path.realpath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}"
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def get_image_inventory(image_path, use_cache=True, content_hash=False):
+    """
+    Gets the packages installed in an image.
+
+    Inventories are cached in ~/.cache/osconfiglib/.inventory, keyed by the size,
+    modification time and inode of the image (or its content hash), so an
+    unchanged image is only inspected once.
+
+    :param image_path: Path to the qcow2 image
+    :param use_cache: Read and store the inventory in the cache.
+    :param content_hash: Key the cache on the content of the image.
+    :return: A dict with the package_type ('rpm' or 'deb') and the list of installed packages.
+    """
+    cache_file = None
+    if use_cache:
+        cache_file = os.path.expanduser(f"~/.cache/osconfiglib/.inventory/{image_cache_key(image_path, content_hash)}.json")
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as file:
+                return json.load(file)
+
+    inventory = read_image_inventory(image_path) or mount_image_inventory(image_path)
+
+    if cache_file:
+        utils.write_json_atomic(cache_file, inventory)
+    return inventory
+
+
+def extract_packages_qcow2(image_path):
+    """
+    Extracts a list of packages from a given qcow2 image, automatically determining
+    if the system uses RPM or DEB packages.
+    
+    :param image_path: Path to the qcow2 image
+    :return: A list of the packages installed in the image, package names for RPM
+             systems and package_name=version for DEB systems. See get_image_inventory()
+             for versions and the package type.
+    """
+    inventory = get_image_inventory(image_path)
+    if inventory['package_type'] == 'rpm':
+        return [package['name'] for package in inventory['packages']]
+    return [f"{package['name']}={package['version']}" for package in inventory['packages']]
 
 
 def create_repo(package_dir, package_type):
     """
     Creates an offline repository from a directory of packages.
+
+    Metadata is generated incrementally. RPM metadata of the previous repository is
+    kept in the package cache and reused by createrepo --update, and DEB control data
+    is kept in an apt-ftparchive database, so only packages that were not indexed
+    before are read.
     
     :param package_dir: Directory containing the packages
     :param package_type: Type of packages ('rpm' or 'deb')
@@ -139,11 +774,31 @@ def create_repo(package_dir, package_type):
         print("The specified directory does not exist or is not a directory.")
         return
     
+    metadata_cache = os.path.join(package_cache.cache_dir(package_type), 'metadata')
     if package_type == 'rpm':
-        subprocess.run(['createrepo', package_dir], check=True)
+        command = [shutil.which('createrepo_c') or 'createrepo', '--quiet']
+        # Concurrent exports share the metadata, it must not be replaced while createrepo reads it
+        with utils.file_lock(metadata_cache + '.lock', metadata_lock):
+            if os.path.isdir(os.path.join(metadata_cache, 'repodata')):
+                command += ['--update', '--update-md-path', metadata_cache]
+            subprocess.run(command + [package_dir], check=True)
+
+            # Keep the metadata for the next repository
+            staging = tempfile.mkdtemp(dir=package_cache.cache_dir(package_type))
+            shutil.copytree(os.path.join(package_dir, 'repodata'), os.path.join(staging, 'repodata'))
+            shutil.rmtree(metadata_cache, ignore_errors=True)
+            os.replace(staging, metadata_cache)
         print(f"RPM repository created successfully in {package_dir}")
     elif package_type == 'deb':
-        subprocess.run(['dpkg-scanpackages', '.', '/dev/null'], cwd=package_dir, stdout=open(os.path.join(package_dir, 'Packages'), 'w'), check=True)
+        if shutil.which('apt-ftparchive'):
+            os.makedirs(metadata_cache, exist_ok=True)
+            command = ['apt-ftparchive', '--db', os.path.join(metadata_cache, 'packages.db'), 'packages', '.']
+        else:
+            command = ['dpkg-scanpackages', '--multiversion', '.', '/dev/null']
+        # The apt-ftparchive database is not safe for concurrent writers
+        with utils.file_lock(metadata_cache + '.lock', metadata_lock):
+            with open(os.path.join(package_dir, 'Packages'), 'w') as packages_file:
+                subprocess.run(command, cwd=package_dir, stdout=packages_file, check=True)
         subprocess.run(['gzip', '-k', '-f', os.path.join(package_dir, 'Packages')], check=True)
         print(f"APT repository created successfully in {package_dir}")
     else:
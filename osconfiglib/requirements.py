@@ -0,0 +1,119 @@
+# File: osconfiglib/requirements.py
+import re
+
+# Requirement kinds, named after the requirement files of a layer
+KINDS = ['rpm', 'deb', 'pip']
+
+RPM_REQUIREMENT = re.compile(r'^(?P<name>[^\s<>=]+)\s*(?P<spec>(?:[<>]=?|=)\s*\S+)?$')
+PIP_NAME = re.compile(r'^(?P<name>[A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)\s*(?P<extras>\[[^\]]*\])?\s*(?P<spec>.*)$')
+
+
+def normalize_pip_name(name):
+    """
+    Normalize a Python distribution name as described in PEP 503.
+
+    Args:
+        name (str): The distribution name
+
+    Returns:
+        str: Lower case name with runs of '-', '_' and '.' replaced by a single '-'
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def parse_requirement(entry, kind):
+    """
+    Split a requirement into the name it applies to and its version constraint.
+
+    rpm requirements are a name optionally followed by a comparison ('tmux >= 3.0'),
+    deb requirements a name optionally pinned with '=' ('tmux=3.3a-3') and pip
+    requirements are PEP 508 strings whose names are normalized. The environment
+    marker of a pip requirement is kept as written and is part of the key, so
+    requirements for different environments do not replace each other. pip options
+    such as '--index-url' are kept as they are.
+
+    Args:
+        entry (str): The requirement
+        kind (str): One of KINDS
+
+    Returns:
+        tuple: (key, spec) where key identifies the package and spec is the normalized
+            constraint, an empty string if the requirement is not constrained
+    """
+    entry = entry.strip()
+    if kind == 'deb':
+        name, _, version = entry.partition('=')
+        return name.strip(), f"={version.strip()}" if version else ''
+    if kind == 'pip':
+        match = PIP_NAME.match(entry)
+        if entry.startswith('-') or match is None:
+            return entry, ''
+        key = normalize_pip_name(match.group('name'))
+        extras = (match.group('extras') or '').replace(' ', '')
+        if match.group('spec').startswith('@'):
+            # A marker after a URL has to be separated by whitespace
+            url, _, marker = re.sub(r'\s+;', ' ;', match.group('spec')[1:], 1).partition(' ;')
+            spec = f"{extras} @ {url.strip()}"
+        else:
+            version, _, marker = match.group('spec').partition(';')
+            spec = f"{extras}{version.replace(' ', '')}"
+        return (f"{key}; {marker.strip()}" if marker.strip() else key), spec
+    match = RPM_REQUIREMENT.match(entry)
+    if match is None:
+        return entry, ''
+    return match.group('name'), (match.group('spec') or '').replace(' ', '')
+
+
+def format_requirement(key, spec, kind):
+    """
+    Build the canonical form of a parsed requirement.
+
+    Args:
+        key (str): Name returned by parse_requirement()
+        spec (str): Constraint returned by parse_requirement()
+        kind (str): One of KINDS
+
+    Returns:
+        str: The requirement as written to the requirement lists
+    """
+    if kind == 'rpm' and spec:
+        operator = re.match(r'[<>=]+', spec).group(0)
+        return f"{key} {operator} {spec[len(operator):]}"
+    if kind == 'pip' and '; ' in key:
+        name, marker = key.split('; ', 1)
+        return f"{name}{spec}{' ; ' if ' @ ' in spec else '; '}{marker}"
+    return f"{key}{spec}"
+
+
+def merge_requirements(requirement_lists, kind):
+    """
+    Merge the requirements of several layers into one list.
+
+    Duplicates are removed. When layers constrain the same package differently, the
+    layer that comes last wins and the disagreement is reported as a conflict. A
+    requirement without a constraint never overrides a constrained one.
+
+    Args:
+        requirement_lists (list): Ordered list of (layer name, requirements) pairs
+        kind (str): One of KINDS
+
+    Returns:
+        tuple: The merged requirements sorted by name, and a list of conflicts as
+            (name, (layer, requirement), (layer, requirement)) tuples with the losing
+            requirement first
+    """
+    merged = {}
+    conflicts = []
+    for layer_name, requirements in requirement_lists:
+        for entry in requirements:
+            key, spec = parse_requirement(entry, kind)
+            if key not in merged or not merged[key][1]:
+                merged[key] = (layer_name, spec)
+                continue
+            previous_layer, previous_spec = merged[key]
+            if spec and spec != previous_spec:
+                conflicts.append((key, (previous_layer, format_requirement(key, previous_spec, kind)),
+                                  (layer_name, format_requirement(key, spec, kind))))
+                merged[key] = (layer_name, spec)
+
+    return [format_requirement(key, merged[key][1], kind) for key in sorted(merged)], conflicts
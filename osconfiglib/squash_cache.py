@@ -0,0 +1,162 @@
+# File: osconfiglib/squash_cache.py
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# Bump when the output of squash_layers changes so that old entries are not reused
+SQUASH_CACHE_VERSION = 9
+
+# Default size budget of the squash cache in bytes
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+REQUIREMENT_LISTS = ['rpm_requirements', 'deb_requirements', 'pip_requirements']
+
+
+def cache_dir():
+    """
+    Get the directory holding the squash cache entries.
+
+    Returns:
+        str: Path to the squash cache directory
+    """
+    return os.path.expanduser('~/.cache/osconfiglib/.squash')
+
+
+def cache_key(layer_identities, options=None):
+    """
+    Build the cache key of a squash.
+
+    Args:
+        layer_identities (list): Ordered list of (layer name, layer identity) pairs. The identity is
+            a git commit SHA or a content hash that changes whenever the layer changes.
+        options (dict): Options that change the output of the squash.
+
+    Returns:
+        str: Hex digest identifying the squash result
+    """
+    key = {
+        'version': SQUASH_CACHE_VERSION,
+        'layers': [list(identity) for identity in layer_identities],
+        'options': options or {},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def load(key, tmp_dir):
+    """
+    Load a squashed layer from the cache.
+
+    Args:
+        key (str): Cache key returned by cache_key()
+        tmp_dir (str): Directory the configs tarball is linked or copied into
+
+    Returns:
+        dict: The squashed layer, or None if the key is not cached
+    """
+    entry = os.path.join(cache_dir(), key)
+    if not os.path.isdir(entry):
+        return None
+
+    squashed_layer = {}
+    for requirements in REQUIREMENT_LISTS:
+        with open(os.path.join(entry, f"{requirements}.txt"), 'r') as file:
+            squashed_layer[requirements] = [line for line in file.read().split('\n') if line]
+
+    with open(os.path.join(entry, 'squash_script.sh'), 'r') as file:
+        squashed_layer['squash_script'] = file.read()
+
+    configs = os.path.join(tmp_dir, 'configs.tar')
+    try:
+        os.link(os.path.join(entry, 'configs.tar'), configs)
+    except OSError:
+        shutil.copy2(os.path.join(entry, 'configs.tar'), configs)
+    squashed_layer['configs'] = configs
+
+    # The modification time of an entry records when it was last used
+    os.utime(entry)
+    print(f"Using cached squash {key}")
+    return squashed_layer
+
+
+def store(key, squashed_layer, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Store a squashed layer in the cache and evict old entries.
+
+    Args:
+        key (str): Cache key returned by cache_key()
+        squashed_layer (dict): Squashed layer returned by squash_layers()
+        max_bytes (int): Size budget of the cache
+    """
+    os.makedirs(cache_dir(), exist_ok=True)
+    entry = os.path.join(cache_dir(), key)
+    if os.path.isdir(entry):
+        return
+
+    # Write into a staging directory first so a partial entry is never used
+    staging = tempfile.mkdtemp(prefix=f".{key}-", dir=cache_dir())
+    try:
+        for requirements in REQUIREMENT_LISTS:
+            with open(os.path.join(staging, f"{requirements}.txt"), 'w') as file:
+                file.write("\n".join(squashed_layer[requirements]))
+
+        with open(os.path.join(staging, 'squash_script.sh'), 'w') as file:
+            file.write(squashed_layer['squash_script'])
+
+        shutil.copy2(squashed_layer['configs'], os.path.join(staging, 'configs.tar'))
+        os.rename(staging, entry)
+    except OSError as e:
+        shutil.rmtree(staging, ignore_errors=True)
+        # Another export may have stored the same squash in the meantime
+        if not os.path.isdir(entry):
+            print(f"Failed to store squash {key} in the cache: {e}")
+        return
+
+    evict(max_bytes)
+
+
+def entry_size(path):
+    """
+    Get the size of a cache entry in bytes.
+
+    Args:
+        path (str): Path to the cache entry
+
+    Returns:
+        int: Total size of the files in the entry
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def evict(max_bytes=DEFAULT_MAX_BYTES, max_age_days=None):
+    """
+    Remove the least recently used entries until the cache fits in max_bytes.
+
+    Args:
+        max_bytes (int): Size budget of the cache
+        max_age_days (float): Also remove entries that were not used for this many days, not enforced if None
+
+    Returns:
+        int: Number of bytes reclaimed
+    """
+    if not os.path.isdir(cache_dir()):
+        return 0
+
+    entries = [entry for entry in os.scandir(cache_dir()) if entry.is_dir() and not entry.name.startswith('.')]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    sizes = {entry.path: entry_size(entry.path) for entry in entries}
+    total = sum(sizes.values())
+
+    cutoff = None if max_age_days is None else time.time() - max_age_days * 86400
+    reclaimed = 0
+    for entry in entries:
+        too_old = cutoff is not None and entry.stat().st_mtime < cutoff
+        if total <= max_bytes and not too_old:
+            continue
+        print(f"Evicting cached squash {entry.name}")
+        shutil.rmtree(entry.path)
+        total -= sizes[entry.path]
+        reclaimed += sizes[entry.path]
+    return reclaimed
@@ -1,9 +1,13 @@
 # File: osconfiglib/utils.py
 
+import contextlib
+import fcntl
+import json
 import os
 import shutil
 import platform
 import subprocess
+import tempfile
 
 def check_package_availability(package_name):
     """
@@ -95,3 +99,43 @@ def check_qcow2_file(value):
     
     # If no errors are raised, the value is valid
     return value
+
+
+@contextlib.contextmanager
+def file_lock(lock_path, thread_lock):
+    """
+    Hold a lock against other threads and other processes.
+
+    Args:
+        lock_path (str): Path to the lock file, created if it does not exist
+        thread_lock (threading.Lock): Lock of the threads of this process
+
+    Yields:
+        None, while both thread_lock and an exclusive flock() on lock_path are held
+    """
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with thread_lock, open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def write_json_atomic(path, data, **kwargs):
+    """
+    Write a JSON file so readers see either the old or the new content.
+
+    The data is written to a unique temporary file next to path, which then replaces it.
+
+    Args:
+        path (str): Path to the JSON file
+        data: The data to write
+        **kwargs: Passed to json.dump(), e.g. indent
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, **kwargs)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
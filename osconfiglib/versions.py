@@ -0,0 +1,160 @@
+# File: osconfiglib/versions.py
+import string
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+def rpmvercmp(a, b):
+    """
+    Compare two RPM version or release strings like rpm does.
+
+    Strings are split into alternating numeric and alphabetic segments. Numeric
+    segments are compared as numbers and are newer than alphabetic ones, a '~'
+    sorts before anything (even the end of the string) and a '^' sorts after the
+    end of the string but before anything else.
+
+    Args:
+        a (str): First version
+        b (str): Second version
+
+    Returns:
+        int: -1 if a is older than b, 0 if they are equal and 1 if a is newer
+    """
+    if a == b:
+        return 0
+
+    def is_separator(c):
+        return c not in string.ascii_letters and c not in string.digits and c not in '~^'
+
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while i < len(a) and is_separator(a[i]):
+            i += 1
+        while j < len(b) and is_separator(b[j]):
+            j += 1
+
+        # A tilde sorts before everything else
+        if (i < len(a) and a[i] == '~') or (j < len(b) and b[j] == '~'):
+            if i >= len(a) or a[i] != '~':
+                return 1
+            if j >= len(b) or b[j] != '~':
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        # A caret sorts after the end of the string but before anything else
+        if (i < len(a) and a[i] == '^') or (j < len(b) and b[j] == '^'):
+            if i >= len(a):
+                return -1
+            if j >= len(b):
+                return 1
+            if a[i] != '^':
+                return 1
+            if b[j] != '^':
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        if i >= len(a) or j >= len(b):
+            break
+
+        characters = string.digits if a[i] in string.digits else string.ascii_letters
+        start_a, start_b = i, j
+        while i < len(a) and a[i] in characters:
+            i += 1
+        while j < len(b) and b[j] in characters:
+            j += 1
+        segment_a, segment_b = a[start_a:i], b[start_b:j]
+
+        # Segments of different types, numeric ones are newer
+        if not segment_b:
+            return 1 if characters == string.digits else -1
+
+        if characters == string.digits:
+            segment_a, segment_b = segment_a.lstrip('0'), segment_b.lstrip('0')
+            if len(segment_a) != len(segment_b):
+                return sign(len(segment_a) - len(segment_b))
+        if segment_a != segment_b:
+            return -1 if segment_a < segment_b else 1
+
+    if i >= len(a) and j >= len(b):
+        return 0
+    return -1 if i >= len(a) else 1
+
+
+def compare_rpm_evr(a, b):
+    """
+    Compare the epoch, version and release of two RPM packages.
+
+    Args:
+        a (dict): First package with 'epoch', 'version' and 'release' keys
+        b (dict): Second package with 'epoch', 'version' and 'release' keys
+
+    Returns:
+        int: -1 if a is older than b, 0 if they are equal and 1 if a is newer
+    """
+    epochs = sign(int(a.get('epoch') or 0) - int(b.get('epoch') or 0))
+    if epochs:
+        return epochs
+    return rpmvercmp(a['version'], b['version']) or rpmvercmp(a.get('release', ''), b.get('release', ''))
+
+
+def debian_order(c):
+    # Letters sort earliest, then other characters, '~' sorts before the end of the part
+    if c in string.ascii_letters:
+        return ord(c)
+    if c == '~':
+        return -1
+    return ord(c) + 256
+
+
+def debian_part_cmp(a, b):
+    """
+    Compare the upstream versions or revisions of two Debian versions like dpkg does.
+    """
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and a[i] not in string.digits) or (j < len(b) and b[j] not in string.digits):
+            order_a = debian_order(a[i]) if i < len(a) and a[i] not in string.digits else 0
+            order_b = debian_order(b[j]) if j < len(b) and b[j] not in string.digits else 0
+            if order_a != order_b:
+                return sign(order_a - order_b)
+            i += 1
+            j += 1
+
+        start_a, start_b = i, j
+        while i < len(a) and a[i] in string.digits:
+            i += 1
+        while j < len(b) and b[j] in string.digits:
+            j += 1
+        number_a, number_b = int(a[start_a:i] or 0), int(b[start_b:j] or 0)
+        if number_a != number_b:
+            return sign(number_a - number_b)
+    return 0
+
+
+def debvercmp(a, b):
+    """
+    Compare two Debian package versions ([epoch:]upstream[-revision]) like dpkg does.
+
+    Args:
+        a (str): First version
+        b (str): Second version
+
+    Returns:
+        int: -1 if a is older than b, 0 if they are equal and 1 if a is newer
+    """
+    def split(version):
+        epoch, _, version = version.partition(':') if ':' in version else ('0', '', version)
+        upstream, _, revision = version.rpartition('-') if '-' in version else (version, '', '0')
+        return int(epoch or 0), upstream, revision
+
+    epoch_a, upstream_a, revision_a = split(a)
+    epoch_b, upstream_b, revision_b = split(b)
+    if epoch_a != epoch_b:
+        return sign(epoch_a - epoch_b)
+    return debian_part_cmp(upstream_a, upstream_b) or debian_part_cmp(revision_a, revision_b)
@@ -1,70 +1,449 @@
 # virt_customize.py
 
+import concurrent.futures
+import json
 import os
 import subprocess
 import tempfile
-import tarfile
 import platform
 import shutil
-from osconfiglib import layers
+import time
+from osconfiglib import layers, package_handler
 import toml
 
-def apply_squashed_layer(base_image, squashed_layer, output_image, python_version="python3"):
+# overlay: qcow2 overlay backed by the base image, reflink: copy-on-write copy, copy: full copy
+OUTPUT_MODES = ['overlay', 'reflink', 'copy']
+
+
+def create_output_image(base_image, output_image, mode='overlay'):
+    """
+    Create the output image from the base image without copying its content if possible.
+
+    An overlay only stores the blocks changed by the customization and references the
+    base image, which must stay in place unless the overlay is flattened. A reflink copy
+    shares the blocks of the base image on file systems that support it (btrfs, XFS) and
+    falls back to a full copy elsewhere.
+
+    Args:
+        base_image (str): Path to the base image file
+        output_image (str): Path to the output image file
+        mode (str): One of OUTPUT_MODES. An overlay falls back to a reflink copy if qemu-img is not installed.
+
+    Returns:
+        str: The mode that was used
+    """
+    if mode == 'overlay' and shutil.which('qemu-img') is None:
+        print("qemu-img is not installed, copying the base image instead of creating an overlay")
+        mode = 'reflink'
+
+    if mode == 'overlay':
+        subprocess.run(['qemu-img', 'create', '-q', '-f', 'qcow2', '-F', 'qcow2',
+                        '-b', os.path.abspath(base_image), output_image], check=True)
+    elif mode == 'reflink' and shutil.which('cp'):
+        subprocess.run(['cp', '--reflink=auto', base_image, output_image], check=True)
+    else:
+        shutil.copyfile(base_image, output_image)
+    return mode
+
+
+def flatten_image(image):
+    """
+    Merge an overlay with its backing chain into a standalone qcow2 image.
+
+    Args:
+        image (str): Path to the overlay, it is replaced by the flattened image
+    """
+    flat_image = f"{image}.flat"
+    subprocess.run(['qemu-img', 'convert', '-O', 'qcow2', image, flat_image], check=True)
+    os.replace(flat_image, image)
+
+
+def write_commands_file(path, commands):
+    """
+    Write virt-customize operations into a file for --commands-from-file.
+
+    Args:
+        path (str): Path to the commands file
+        commands (list): List of (operation, argument) pairs, e.g. ('run-command', 'dnf -y update')
+    """
+    with open(path, 'w') as file:
+        for operation, argument in commands:
+            if '\n' in argument:
+                raise ValueError(f"Arguments of {operation} must fit on one line: {argument}")
+            file.write(f"{operation} {argument}\n")
+
+
+# Directory the bundle is copied to inside the guest, removed once the layers are applied
+GUEST_BUNDLE_DIR = '/var/tmp/osconfiglib'
+
+# Log in the guest the squash script writes the timings of its steps to. It is truncated
+# before the steps run and removed from the image once copy_out_timings() copied it.
+GUEST_TIMING_LOG = '/var/log/osconfiglib-timing.jsonl'
+
+# Script in the bundle defining osconfiglib_step for the commands run outside the squash script
+STEP_SCRIPT = 'osconfiglib_step.sh'
+
+
+def images_pip_target(squashed_layer, base_images, python_version="python3", offline=True):
+    """
+    Get the Python version and platform the wheelhouse of base images is resolved for.
+
+    Args:
+        squashed_layer (dict): Dictionary containing squashed layers
+        base_images (list): Paths to the base images that share the wheelhouse
+        python_version (str): Python used for the virtual environment, its version is used if the name has one
+        offline (bool): Whether the packages are bundled
+
+    Returns:
+        dict: See package_handler.image_pip_target(), None if no wheelhouse is bundled or the images
+            have no python3 or glibc package
+
+    Raises:
+        package_handler.PackageError: If the images do not have the same Python version and platform.
+    """
+    if not offline or not squashed_layer.get('pip_requirements'):
+        return None
+    targets = [package_handler.image_pip_target(package_handler.get_image_inventory(base_image), python_version)
+               for base_image in base_images]
+    if any(target != targets[0] for target in targets):
+        raise package_handler.PackageError("The base images have different Python versions or platforms, "
+                                           "they can not share a wheelhouse")
+    return targets[0]
+
+
+def stage_bundle(squashed_layer, bundle_dir, offline=True, download_jobs=4, pip_target=None):
+    """
+    Lay out a squashed layer in a directory that is copied into the guest.
+
+    The layout is the same as an exported tarball: configs.tar, the requirement
+    lists, squash_script.sh and, for offline installs, the rpms/ and debs/
+    repositories with their metadata and the wheels/ wheelhouse.
+
+    Args:
+        squashed_layer (dict): Dictionary containing squashed layers
+        bundle_dir (str): Directory to create
+        offline (bool): Bundle the packages so the guest installs them without network access
+        download_jobs (int): Number of packages downloaded in parallel
+        pip_target (dict): Python version and platforms of the guest the wheelhouse is resolved for,
+            see images_pip_target()
+
+    Raises:
+        package_handler.PackageError: If the packages can not be resolved or downloaded.
+    """
+    os.makedirs(bundle_dir)
+    if offline:
+        layers.stage_packages(squashed_layer, bundle_dir, download_jobs, pip_target=pip_target)
+
+    for requirements in ['rpm_requirements', 'deb_requirements', 'pip_requirements']:
+        with open(os.path.join(bundle_dir, f"{requirements}.txt"), 'w') as file:
+            file.write("\n".join(squashed_layer[requirements]))
+
+    with open(os.path.join(bundle_dir, STEP_SCRIPT), 'w') as step_file:
+        step_file.write(layers.STEP_FUNCTION)
+
+    script_path = os.path.join(bundle_dir, "squash_script.sh")
+    with open(script_path, 'w') as script_file:
+        script_file.write(squashed_layer['squash_script'])
+    os.chmod(script_path, 0o755)
+
+    # The configs tarball is copied as is, compressing it for a local copy only costs time
+    try:
+        os.link(squashed_layer['configs'], os.path.join(bundle_dir, 'configs.tar'))
+    except OSError:
+        shutil.copyfile(squashed_layer['configs'], os.path.join(bundle_dir, 'configs.tar'))
+
+
+def squashed_layer_commands(squashed_layer, bundle_dir, python_version="python3", timings=False):
+    """
+    Build the virt-customize operations that apply a squashed layer.
+
+    The bundle is copied into GUEST_BUNDLE_DIR. The squash script installs the rpm and
+    deb requirements from the bundled repositories in one transaction before the layer
+    scripts run, then the pip requirements are installed as a step of their own and the
+    bundle is removed again.
+
+    Args:
+        squashed_layer (dict): Dictionary containing squashed layers
+        bundle_dir (str): Directory created by stage_bundle(), its name must match GUEST_BUNDLE_DIR
+        python_version (str): Python version used for virtual environment
+        timings (bool): Record the start and end of every step of the squash script in GUEST_TIMING_LOG
+
+    Returns:
+        list: List of (operation, argument) pairs
+    """
+    script = f'{GUEST_BUNDLE_DIR}/squash_script.sh'
+    timing_env = f'OSCONFIGLIB_TIMING_LOG={GUEST_TIMING_LOG} ' if timings else ''
+    # Start from an empty log, an image customized before may already have one
+    commands = [('write', f'{GUEST_TIMING_LOG}:')] if timings else []
+    commands += [
+        ('mkdir', os.path.dirname(GUEST_BUNDLE_DIR)),
+        ('copy-in', f'{bundle_dir}:{os.path.dirname(GUEST_BUNDLE_DIR)}'),
+        ('run-command', f'tar xf {GUEST_BUNDLE_DIR}/configs.tar -C /'),
+        ('run-command', f'{timing_env}{script}'),
+    ]
+
+    # Install pip requirements in the copied image, from the bundled wheelhouse if there is one
+    if squashed_layer['pip_requirements']:
+        pip_install = f'pip install -r {GUEST_BUNDLE_DIR}/pip_requirements.txt'
+        wheel_dir = os.path.join(bundle_dir, layers.WHEEL_DIR)
+        if os.path.isdir(wheel_dir) and os.listdir(wheel_dir):
+            pip_install = f'pip install --no-index --find-links {GUEST_BUNDLE_DIR}/{layers.WHEEL_DIR} -r {GUEST_BUNDLE_DIR}/pip_requirements.txt'
+        install = f'{python_version} -m venv /opt/os-python-venv && source /opt/os-python-venv/bin/activate && {pip_install}'
+        commands.append(('run-command', f"{timing_env}bash -c 'source {GUEST_BUNDLE_DIR}/{STEP_SCRIPT} && "
+                                        f"function osconfiglib_install_pip() {{ {install}; }} && osconfiglib_step osconfiglib_install_pip'"))
+        commands.append(('run-command', 'chmod -R 777 /opt/os-python-venv'))
+
+    commands.append(('delete', GUEST_BUNDLE_DIR))
+    return commands
+
+
+def read_timings(path):
+    """
+    Read the step timings written by the squash script.
+
+    Args:
+        path (str): Path to a copy of GUEST_TIMING_LOG
+
+    Returns:
+        list: One dict per step with the step name, start, end, status and seconds, slowest first
+    """
+    records = []
+    with open(path, 'r') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                record['seconds'] = record['end'] - record['start']
+                records.append(record)
+    records.sort(key=lambda record: record['seconds'], reverse=True)
+    return records
+
+
+def summarize_timings(records, limit=10):
+    """
+    Print the slowest steps of a squash script run.
+
+    Args:
+        records (list): Timings returned by read_timings()
+        limit (int): Number of steps to print
+    """
+    if not records:
+        print("No step timings were recorded.")
+        return
+    total = max(record['end'] for record in records) - min(record['start'] for record in records)
+    print(f"Squash script ran for {total:.1f}s, slowest steps:")
+    for record in records[:limit]:
+        status = '' if record['status'] == 0 else f" (exit code {record['status']})"
+        print(f"  {record['seconds']:8.1f}s  {record['step']}{status}")
+
+
+def copy_out_timings(image, timings_file):
+    """
+    Copy the step timings out of an image, remove them from the image and summarize them.
+
+    Args:
+        image (str): Path to the customized image
+        timings_file (str): Path on the host the timings are written to
+
+    Returns:
+        list: Timings returned by read_timings(), or None if the log could not be copied
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Copying and removing the log in one guestfish session only boots the appliance once
+        result = subprocess.run(['guestfish', '--rw', '-a', image, '-i',
+                                 'copy-out', GUEST_TIMING_LOG, temp_dir, ':', 'rm-f', GUEST_TIMING_LOG])
+        log = os.path.join(temp_dir, os.path.basename(GUEST_TIMING_LOG))
+        if result.returncode != 0 or not os.path.exists(log):
+            print(f"Could not copy the step timings out of {image}")
+            return None
+        shutil.move(log, timings_file)
+
+    records = read_timings(timings_file)
+    summarize_timings(records)
+    return records
+
+
+def apply_squashed_layer(base_image, squashed_layer, output_image, python_version="python3", output_mode='overlay', flatten=False,
+                         offline=True, download_jobs=4, bundle_dir=None, timings=False, pip_target=None):
     """
     Apply squashed layers of configurations to a base image using virt-customize.
 
+    The output image is created as an overlay of the base image (see create_output_image())
+    and all uploads and commands run in a single virt-customize appliance boot.
+
     Args:
         base_image (str): Path to the base image file
         squashed_layer (dict): Dictionary containing squashed layers
         output_image (str): Path to the output image file
         python_version (str): Python version used for virtual environment. If none then python3 is used
+        output_mode (str): How the output image is created, one of OUTPUT_MODES. Default is 'overlay'.
+        flatten (bool): Turn an overlay into a standalone image once the layers are applied.
+        offline (bool): Install packages from a bundled repository instead of the network repositories of the guest.
+        download_jobs (int): Number of packages downloaded in parallel
+        bundle_dir (str): Bundle created by stage_bundle() beforehand, staged in a temporary directory if None
+        timings (bool): Record how long every layer function and package install takes. The timings are
+            copied to <output_image>.timings.jsonl and the slowest steps are printed.
+        pip_target (dict): Python version and platforms the wheelhouse is resolved for, taken from the base
+            image if None. See images_pip_target().
+
+    Returns:
+        bool: True if the layers were applied, False otherwise
     """
     # Use a temporary directory for storing temporary files
     with tempfile.TemporaryDirectory() as temp_dir:
-        # Create a tarball containing the configs
-        tarball_path = os.path.join(temp_dir, "squashed_layer.tar.gz")
-        with tarfile.open(tarball_path, "w:gz") as tar:
-            for config in squashed_layer['configs']:
-                tar.add(config, arcname=os.path.basename(config))
-
-        # Write the squashed script into a temporary file
-        script_path = os.path.join(temp_dir, "squashed_script.sh")
-        with open(script_path, 'w') as script_file:
-            script_file.write(squashed_layer['squash_script'])
+        if bundle_dir is None:
+            bundle_dir = os.path.join(temp_dir, os.path.basename(GUEST_BUNDLE_DIR))
+            try:
+                if pip_target is None:
+                    pip_target = images_pip_target(squashed_layer, [base_image], python_version, offline)
+                stage_bundle(squashed_layer, bundle_dir, offline, download_jobs, pip_target)
+            except package_handler.PackageError as e:
+                print(f"Failed to stage packages: {e}")
+                return False
 
-        shutil.copyfile(base_image, output_image)
+        output_mode = create_output_image(base_image, output_image, output_mode)
 
-        # Construct the virt-customize command
-        command = [
-            'virt-customize', '-a', output_image,
-            '--upload', f'{tarball_path}:/squashed_layer.tar.gz',
-            '--run-command', f'tar xzf /squashed_layer.tar.gz -C /',
-            '--upload', f'{script_path}:/opt/squashed_script.sh',
-            '--run-command', 'chmod +x /opt/squashed_script.sh',
-            '--run-command', '/opt/squashed_script.sh'
-        ]
-
-        if squashed_layer['rpm_requirements']:
-            command.append('--run-command')
-            command.append('bash -c "if [ -f /etc/redhat-release ]; then dnf install -y --nogpgcheck --allowerasing ' + ' '.join(squashed_layer["rpm_requirements"]) + '; fi"')
-        elif squashed_layer['deb_requirements']:
-            command.append('--run-command')
-            command.append('bash -c "if [ -f /etc/debian_version ]; then apt-get install -y ' + ' '.join(squashed_layer["deb_requirements"]) + '; fi"')
-
-        # Install pip requirements in the copied image
-        if squashed_layer['pip_requirements']:
-            command.append('--run-command')
-            command.append(f'{python_version} -m venv /opt/os-python-venv && source /opt/os-python-venv/bin/activate && pip install {" ".join(squashed_layer["pip_requirements"])}')
-            command.append('--run-command')
-            command.append('chmod -R 777 /opt/os-python-venv')
+        commands_path = os.path.join(temp_dir, "commands")
+        write_commands_file(commands_path, squashed_layer_commands(squashed_layer, bundle_dir, python_version, timings))
 
         # Run the virt-customize command
-        subprocess.run(command)
+        result = subprocess.run(['virt-customize', '-a', output_image, '--commands-from-file', commands_path])
+
+        # Timings are most useful when a step failed, so they are copied out in any case
+        if timings:
+            copy_out_timings(output_image, f"{output_image}.timings.jsonl")
+
+        if result.returncode != 0:
+            print(f"virt-customize failed with exit code {result.returncode}")
+            return False
+
+    if flatten and output_mode == 'overlay':
+        flatten_image(output_image)
 
     print("Layers applied successfully.")
+    return True
+
+
+# Memory of a libguestfs appliance in MiB, unless LIBGUESTFS_MEMSIZE overrides it
+DEFAULT_APPLIANCE_MEMSIZE = 1280
+
+# Memory used by qemu and virt-customize on top of the appliance memory in MiB
+APPLIANCE_OVERHEAD = 256
+
+
+def available_memory():
+    """
+    Get the memory available for new processes.
+
+    Returns:
+        int: MemAvailable from /proc/meminfo in MiB, or None if it can not be read
+    """
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def appliance_slots(max_workers=None):
+    """
+    Get the number of libguestfs appliances that can run at the same time.
 
+    Every virt-customize run boots an appliance with LIBGUESTFS_MEMSIZE of memory, so
+    the number of concurrent runs is limited by the available memory of the host.
 
-def toml_apply(toml_file_path, base_image, output_image, python_version="python3"):
+    Args:
+        max_workers (int): Upper limit requested by the caller, defaults to the number of CPUs
+
+    Returns:
+        int: Number of concurrent appliances, at least 1
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    memsize = int(os.environ.get('LIBGUESTFS_MEMSIZE', DEFAULT_APPLIANCE_MEMSIZE))
+    memory = available_memory()
+    if memory is not None:
+        max_workers = min(max_workers, memory // (memsize + APPLIANCE_OVERHEAD))
+    return max(1, max_workers)
+
+
+def apply_batch(squashed_layer, images, python_version="python3", max_workers=None, output_mode='overlay', flatten=False,
+                offline=True, download_jobs=4, timings=False, pip_target=None):
+    """
+    Apply one squashed layer to several base images concurrently.
+
+    The bundle with the packages is staged once and copied into every image. Failures
+    are reported per image and do not stop the other images.
+
+    Args:
+        squashed_layer (dict): Dictionary containing squashed layers
+        images (list): List of (base image, output image) pairs
+        python_version (str): Python version used for virtual environment
+        max_workers (int): Maximum number of images customized at the same time, further
+            limited by the memory available for libguestfs appliances (see appliance_slots())
+        output_mode (str): How the output images are created, one of OUTPUT_MODES
+        flatten (bool): Turn overlays into standalone images once the layers are applied
+        offline (bool): Install packages from a bundled repository instead of the network repositories of the guests
+        download_jobs (int): Number of packages downloaded in parallel
+        timings (bool): Record the step timings of every image, see apply_squashed_layer()
+        pip_target (dict): Python version and platforms the wheelhouse is resolved for, taken from the base
+            images if None. See images_pip_target().
+
+    Returns:
+        list: One dict per image with the base_image, output_image, success and seconds, in the
+            order of images, or None if several images would be written to the same output image
+            or the packages could not be staged
+    """
+    outputs = [os.path.abspath(output_image) for _, output_image in images]
+    duplicates = sorted({output for output in outputs if outputs.count(output) > 1})
+    if duplicates:
+        print(f"Several images would be written to {', '.join(duplicates)}, aborting apply_batch.")
+        return None
+
+    max_workers = appliance_slots(max_workers)
+    print(f"Applying layers to {len(images)} images, {max_workers} at a time")
+
+    def apply(base_image, output_image):
+        start = time.monotonic()
+        try:
+            success = apply_squashed_layer(base_image, squashed_layer, output_image, python_version, output_mode, flatten,
+                                           bundle_dir=bundle_dir, timings=timings)
+        except Exception as e:
+            print(f"Error applying layers to {base_image}: {e}")
+            success = False
+        return success, time.monotonic() - start
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir, concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        bundle_dir = os.path.join(temp_dir, os.path.basename(GUEST_BUNDLE_DIR))
+        try:
+            if pip_target is None:
+                pip_target = images_pip_target(squashed_layer, [base_image for base_image, _ in images], python_version, offline)
+            stage_bundle(squashed_layer, bundle_dir, offline, download_jobs, pip_target)
+        except package_handler.PackageError as e:
+            print(f"Failed to stage packages: {e}")
+            return None
+
+        futures = {executor.submit(apply, base_image, output_image): position
+                   for position, (base_image, output_image) in enumerate(images)}
+        for future in concurrent.futures.as_completed(futures):
+            base_image, output_image = images[futures[future]]
+            success, seconds = future.result()
+            print(f"Image {base_image} -> {output_image}: {'applied' if success else 'failed'} in {seconds:.1f}s")
+            results.append((futures[future], {'base_image': base_image, 'output_image': output_image,
+                                              'success': success, 'seconds': seconds}))
+
+    # Report in the order the images were given
+    results = [result for _, result in sorted(results, key=lambda item: item[0])]
+    failed = [result for result in results if not result['success']]
+    print(f"{len(results) - len(failed)} of {len(results)} images applied successfully.")
+    return results
+
+
+def toml_apply(toml_file_path, base_image, output_image, python_version="python3", output_mode='overlay', flatten=False,
+               offline=True, download_jobs=4, timings=False, pip_target=None):
     """
     Applies layers specified in a TOML file to a base image.
 
@@ -73,15 +452,74 @@ def toml_apply(toml_file_path, base_image, output_image, python_version="python3
         base_image (str): Path to the base image file.
         output_image (str): Path to the output image file.
         python_version (str): Python version used for virtual environment. If none then python3 is used.
+        output_mode (str): How the output image is created, one of OUTPUT_MODES.
+        flatten (bool): Turn an overlay into a standalone image once the layers are applied.
+        offline (bool): Install packages from a bundled repository instead of the network repositories of the guest.
+        download_jobs (int): Number of packages downloaded in parallel.
+        timings (bool): Record and summarize how long every step of the squash script takes.
+        pip_target (dict): Python version and platforms the wheelhouse is resolved for, taken from the base image if None.
+
+    Returns:
+        bool: True if the layers were applied, False otherwise
     """
 
     # Load and parse the TOML file
     with open(toml_file_path, 'r') as file:
         data = toml.load(file)
 
-    # Iterate over the layers in the TOML file and squash them
-    squashed_layers = layers.squash_layers(data['layers'])
+    if not layers.import_layers(data):
+        print(f"Failed to import layers from {toml_file_path}")
+        return False
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Iterate over the layers in the TOML file and squash them
+        try:
+            squashed_layers = layers.squash_layers(data['layer'], tmp_dir, strict_requirements=data.get('strict_requirements', False),
+                                                   script_jobs=data.get('script_jobs', 1))
+        except ValueError as e:
+            print(f"Failed to squash layers: {e}")
+            return False
+
+        # Apply the squashed layer
+        return apply_squashed_layer(base_image, squashed_layers, output_image, python_version, output_mode, flatten,
+                                    offline, download_jobs, timings=timings, pip_target=pip_target)
+
+
+def toml_apply_batch(toml_file_path, images, python_version="python3", max_workers=None, output_mode='overlay', flatten=False,
+                     offline=True, download_jobs=4, timings=False, pip_target=None):
+    """
+    Applies layers specified in a TOML file to several base images.
+
+    The layers are imported and squashed once and the result is applied to every image.
+
+    Args:
+        toml_file_path (str): Path to the TOML file.
+        images (list): List of (base image, output image) pairs.
+        python_version (str): Python version used for virtual environment.
+        max_workers (int): Maximum number of images customized at the same time.
+        output_mode (str): How the output images are created, one of OUTPUT_MODES.
+        flatten (bool): Turn overlays into standalone images once the layers are applied.
+        offline (bool): Install packages from a bundled repository instead of the network repositories of the guests.
+        download_jobs (int): Number of packages downloaded in parallel.
+        timings (bool): Record and summarize how long every step of the squash script takes.
+        pip_target (dict): Python version and platforms the wheelhouse is resolved for, taken from the base images if None.
+
+    Returns:
+        list: The results of apply_batch(), or None if the layers could not be imported
+    """
+    with open(toml_file_path, 'r') as file:
+        data = toml.load(file)
+
+    if not layers.import_layers(data):
+        print(f"Failed to import layers from {toml_file_path}")
+        return None
 
-    # Apply the squashed layer
-    apply_squashed_layer(base_image, squashed_layers, output_image, python_version)
-    print("Layers applied successfully.")
\ No newline at end of file
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            squashed_layers = layers.squash_layers(data['layer'], tmp_dir, strict_requirements=data.get('strict_requirements', False),
+                                                   script_jobs=data.get('script_jobs', 1))
+        except ValueError as e:
+            print(f"Failed to squash layers: {e}")
+            return None
+        return apply_batch(squashed_layers, images, python_version, max_workers, output_mode, flatten, offline, download_jobs, timings,
+                           pip_target)
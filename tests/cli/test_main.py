@@ -15,3 +15,21 @@ def test_list_layers(mocker):
     assert result.exit_code == 0
 
 # You can write similar tests for the other CLI commands
+
+def test_apply_batch_rejects_clashing_output_images(mocker):
+    apply_batch = mocker.patch('osconfiglib.virt_customize.toml_apply_batch')
+    runner = CliRunner()
+    result = runner.invoke(main.cli, ['apply-batch', 'recipe.toml', 'out', 'a/rhel.qcow2', 'b/rhel.qcow2'])
+    assert result.exit_code == 2
+    assert 'a/rhel.qcow2, b/rhel.qcow2' in result.output
+    assert apply_batch.call_count == 0
+
+def test_export_validates_compression_level_per_codec(mocker):
+    export = mocker.patch('osconfiglib.layers.toml_export')
+    runner = CliRunner()
+    result = runner.invoke(main.cli, ['export-squashed-configs', 'recipe.toml', 'out', '--compression-level', '19', '--compression', 'gz'])
+    assert result.exit_code == 2
+    assert 'expected 0 to 9' in result.output
+    result = runner.invoke(main.cli, ['export-squashed-configs', 'recipe.toml', 'out', '--compression-level', '19', '--compression', 'zst'])
+    assert result.exit_code == 0
+    assert export.call_args.kwargs['compression_level'] == 19
@@ -0,0 +1,54 @@
+# tests/test_archive.py
+import io
+import tarfile
+
+import pytest
+from osconfiglib import archive
+
+
+@pytest.mark.parametrize('compression', ['none', 'gz', 'xz'])
+def test_open_archive_round_trip(tmp_path, compression):
+    output_file = tmp_path / f"out{archive.archive_extension(compression)}"
+    with archive.open_archive(str(output_file), compression, level=1) as tar:
+        info = tarfile.TarInfo('hello.txt')
+        info.size = 5
+        tar.addfile(info, io.BytesIO(b'hello'))
+
+    with tarfile.open(output_file) as tar:
+        assert tar.extractfile('hello.txt').read() == b'hello'
+
+
+def test_open_archive_rejects_unknown_compression(tmp_path):
+    with pytest.raises(ValueError):
+        with archive.open_archive(str(tmp_path / 'out.tar.bz2'), 'bz2'):
+            pass
+
+
+@pytest.mark.parametrize('compression', ['gz', 'xz'])
+def test_reproducible_archive(tmp_path, compression):
+    source = tmp_path / 'source'
+    (source / 'b').mkdir(parents=True)
+    (source / 'b' / 'file').write_text('content')
+    (source / 'a').write_text('content')
+
+    outputs = []
+    for index in range(2):
+        (source / 'a').touch()
+        output_file = tmp_path / f"out{index}{archive.archive_extension(compression)}"
+        with archive.open_archive(str(output_file), compression, reproducible=True) as tar:
+            archive.add_path(tar, str(source), 'source', reproducible=True)
+            archive.add_bytes(tar, 'script.sh', b'#!/bin/bash\n', mode=0o755, reproducible=True)
+        outputs.append(output_file.read_bytes())
+
+    assert outputs[0] == outputs[1]
+    with tarfile.open(tmp_path / f"out0{archive.archive_extension(compression)}") as tar:
+        assert tar.getnames() == ['source', 'source/a', 'source/b', 'source/b/file', 'script.sh']
+        assert all(member.mtime == 0 and member.uid == 0 for member in tar.getmembers())
+
+
+@pytest.mark.parametrize('compression, level', [('gz', 10), ('xz', -1), ('zst', 0), ('zst', 23)])
+def test_open_archive_rejects_invalid_level(tmp_path, compression, level):
+    with pytest.raises(ValueError):
+        with archive.open_archive(str(tmp_path / 'out.tar'), compression, level=level):
+            pass
+    assert not (tmp_path / 'out.tar').exists()
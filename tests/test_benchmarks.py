@@ -0,0 +1,64 @@
+# tests/test_benchmarks.py
+import copy
+import os
+import tempfile
+import time
+
+from benchmarks import bench, fixtures
+
+TINY = {'layers': 2, 'config_files': 5, 'config_size': 256, 'scripts': 1, 'requirements': 4, 'packages': 2, 'package_size': 1024}
+
+
+def test_stages_run_against_generated_fixture(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    (tmp_path / 'tmp').mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'tmp'))
+    fixture_dir = str(tmp_path / 'fixture')
+    data = fixtures.generate(fixture_dir, TINY)
+    assert [layer['url'].split('/')[-1] for layer in data['layer']] == ['layer-000.git', 'layer-001.git']
+
+    for stage in bench.STAGES:
+        result = bench.run_stage(stage, fixture_dir, str(tmp_path))
+        assert result['wall_seconds'] > 0
+        assert result['output_bytes'] > 0
+    assert (tmp_path / 'export.tar.gz').exists()
+
+
+def test_disk_sampler_counts_what_the_stage_wrote(tmp_path):
+    (tmp_path / 'cache').mkdir()
+    (tmp_path / 'tmp').mkdir()
+    (tmp_path / 'tmp' / 'setup').write_bytes(b'x' * 8192)
+    (tmp_path / 'cache' / 'cached').write_bytes(b'x' * 8192)
+    os.utime(tmp_path / 'cache' / 'cached', (time.time() - 60, time.time() - 60))
+
+    with bench.DiskSampler(str(tmp_path / 'tmp')) as sampler:
+        # A package downloaded into the cache and linked into the bundle twice, and one from a warm cache
+        (tmp_path / 'cache' / 'downloaded').write_bytes(b'x' * 8192)
+        for name in ['first', 'second']:
+            os.link(tmp_path / 'cache' / 'downloaded', tmp_path / 'tmp' / name)
+        os.link(tmp_path / 'cache' / 'cached', tmp_path / 'tmp' / 'cached')
+        assert sampler.disk_use() == os.stat(tmp_path / 'cache' / 'downloaded').st_blocks * 512
+
+
+def test_compare_reports_regressions():
+    baseline = {'params': TINY, 'host': bench.host_info(), 'stages': {
+        'squash': {'wall_seconds': 1.0, 'peak_rss_mib': 30, 'peak_temp_bytes': 10 * 1024 ** 2}}}
+    results = copy.deepcopy(dict(baseline, scenario='tiny'))
+    assert bench.compare(results, baseline, 0.25) == []
+
+    results['stages']['squash']['wall_seconds'] = 1.5
+    results['stages']['squash']['peak_rss_mib'] = 31
+    regressions = bench.compare(results, baseline, 0.25)
+    assert len(regressions) == 1 and regressions[0].startswith('squash wall_seconds')
+
+
+def test_compare_skips_host_metrics_on_another_host():
+    baseline = {'params': TINY, 'host': dict(bench.host_info(), cpus=-1), 'stages': {
+        'squash': {'wall_seconds': 1.0, 'peak_rss_mib': 30, 'peak_temp_bytes': 10 * 1024 ** 2}}}
+    results = copy.deepcopy(dict(baseline, scenario='tiny', host=bench.host_info()))
+    results['stages']['squash'].update(wall_seconds=5.0, peak_rss_mib=300)
+    assert bench.compare(results, baseline, 0.25) == []
+    assert len(bench.compare(results, baseline, 0.25, across_hosts=True)) == 2
+
+    results['stages']['squash']['peak_temp_bytes'] = 100 * 1024 ** 2
+    assert [regression.split(':')[0] for regression in bench.compare(results, baseline, 0.25)] == ['squash peak_temp_bytes']
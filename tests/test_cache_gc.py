@@ -0,0 +1,83 @@
+# tests/test_cache_gc.py
+import os
+import time
+
+import pytest
+
+from osconfiglib import cache_gc, layer_index, layers, package_cache
+
+
+def test_parse_size():
+    assert cache_gc.parse_size('512') == 512
+    assert cache_gc.parse_size('1.5K') == 1536
+    assert cache_gc.parse_size('20G') == 20 * 1024 ** 3
+    assert cache_gc.parse_size('2MiB') == 2 * 1024 ** 2
+    with pytest.raises(ValueError):
+        cache_gc.parse_size('lots')
+
+
+def make_git_layer(root, name, age):
+    url = f"https://example.com/org/{name}.git"
+    dir_name = layers.git_to_dir_name(url, 'main')
+    (root / dir_name / 'configs').mkdir(parents=True)
+    (root / dir_name / 'configs' / 'data').write_bytes(b'x' * 1000)
+    layer_index.update_layer(dir_name, url=url, branch='main', commit=None, type='git', last_used=time.time() - age * 86400)
+    return dir_name
+
+
+def test_collect_keeps_recipe_and_local_layers(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    root = tmp_path / '.cache' / 'osconfiglib'
+    # Local layers exist nowhere else, the least recently used one must survive
+    assert layers.create_layer('mine')
+    (root / 'mine' / 'configs' / 'data').write_bytes(b'x' * 1000)
+    layer_index.update_layer('mine', last_used=time.time() - 10 * 86400)
+    oldest, older, recent = [make_git_layer(root, name, age) for name, age in [('oldest', 3), ('older', 2), ('recent', 1)]]
+
+    # Left behind by an interrupted squash cache store
+    staging = root / '.squash' / '.abc-123'
+    staging.mkdir(parents=True)
+    (staging / 'configs.tar').write_bytes(b'x' * 100)
+    os.utime(staging, (0, 0))
+    # Object store of a reference clone whose layers are gone
+    (root / '.objects' / 'example.git' / 'objects').mkdir(parents=True)
+    (root / '.objects' / 'example.git' / 'HEAD').write_text('ref: refs/heads/main\n')
+
+    recipe = tmp_path / 'recipe.toml'
+    recipe.write_text('[[layer]]\nname = "oldest"\ntype = "git"\nurl = "https://example.com/org/oldest.git"\n')
+
+    reclaimed = cache_gc.collect(max_bytes=2500, recipe_path=str(recipe))
+
+    # The recipe layer is kept although it is the least recently used git layer
+    assert sorted(entry['name'] for entry in layer_index.list_indexed_layers()) == sorted(['mine', oldest, recent])
+    assert not (root / older).exists()
+    assert (root / 'mine' / 'configs' / 'data').exists()
+    assert reclaimed['layers'] >= 1000
+    assert reclaimed['temporary files'] == 100
+    assert reclaimed['object stores'] > 0
+    assert not staging.exists()
+
+
+def test_collect_by_age(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    root = tmp_path / '.cache' / 'osconfiglib'
+    stale, fresh = make_git_layer(root, 'stale', 40), make_git_layer(root, 'fresh', 1)
+    assert layers.create_layer('mine')
+    layer_index.update_layer('mine', last_used=time.time() - 40 * 86400)
+
+    cache_gc.collect(max_age_days=30)
+    assert sorted(entry['name'] for entry in layer_index.list_indexed_layers()) == sorted([fresh, 'mine'])
+    assert not (root / stale).exists()
+
+    cache_gc.collect(max_age_days=30, include_local=True)
+    assert [entry['name'] for entry in layer_index.list_indexed_layers()] == [fresh]
+
+
+def test_collect_applies_a_budget_per_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / 'six.whl').write_bytes(b'x' * 100)
+    package_cache.ingest_packages([str(tmp_path / 'six.whl')], 'whl')
+
+    # --max-size only covers the layers
+    assert cache_gc.collect(max_bytes=0)['package cache'] == 0
+    assert cache_gc.collect(max_package_bytes=0)['package cache'] == 100
@@ -0,0 +1,68 @@
+# tests/test_fingerprint.py
+import os
+import subprocess
+import sys
+
+from osconfiglib import fingerprint, layers
+
+
+def write_old(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    os.utime(path, ns=(10 ** 18, 10 ** 18))
+
+
+def test_fingerprint_reuses_digests_of_unchanged_files(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    layer = tmp_path / 'layer'
+    write_old(layer / 'configs' / 'etc' / 'motd', 'hello')
+    write_old(layer / 'scripts' / '01.sh', 'echo hi')
+    write_old(layer / 'docs' / 'README', 'ignored')
+    first = fingerprint.fingerprint(str(layer), layers.LAYER_DIRS)
+
+    # Same size, modification time and inode, the cached digest is used without reading the file
+    write_old(layer / 'configs' / 'etc' / 'motd', 'HELLO')
+    assert fingerprint.fingerprint(str(layer), layers.LAYER_DIRS) == first
+
+    # Files outside LAYER_DIRS do not matter
+    write_old(layer / 'docs' / 'README', 'changed')
+    assert fingerprint.fingerprint(str(layer), layers.LAYER_DIRS) == first
+
+    os.utime(layer / 'configs' / 'etc' / 'motd', ns=(10 ** 18 + 1, 10 ** 18 + 1))
+    second = fingerprint.fingerprint(str(layer), layers.LAYER_DIRS)
+    assert second != first
+
+    (layer / 'scripts' / '01.sh').chmod(0o755)
+    assert fingerprint.fingerprint(str(layer), layers.LAYER_DIRS) != second
+
+    (layer / 'scripts' / '01.sh').unlink()
+    fingerprint.fingerprint(str(layer), layers.LAYER_DIRS)
+    assert str(layer / 'scripts' / '01.sh') not in fingerprint.load_stat_cache()
+
+
+def test_changed_layers(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    for name in ['a', 'b']:
+        assert layers.create_layer(name)
+    assert layers.changed_layers() == ['a', 'b']
+    assert layers.changed_layers() == []
+
+    write_old(tmp_path / '.cache' / 'osconfiglib' / 'b' / 'configs' / 'etc' / 'motd', 'hello')
+    assert layers.changed_layers() == ['b']
+
+
+def test_import_layers_rejects_missing_local_layer(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    assert not layers.import_layers({'layer': [{'name': 'missing', 'type': 'local'}]})
+
+
+def test_stat_cache_updates_from_several_processes(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    for name in ['a', 'b', 'c']:
+        for number in range(20):
+            write_old(tmp_path / name / 'configs' / f'{number}.conf', f'{name} {number}')
+    script = "import sys\nfrom osconfiglib import fingerprint\nfingerprint.fingerprint(sys.argv[1], ['configs'])\n"
+    processes = [subprocess.Popen([sys.executable, '-c', script, str(tmp_path / name)]) for name in ['a', 'b', 'c']]
+    assert [process.wait() for process in processes] == [0, 0, 0]
+
+    assert len(fingerprint.load_stat_cache()) == 60
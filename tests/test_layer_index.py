@@ -0,0 +1,43 @@
+# tests/test_layer_index.py
+import os
+import subprocess
+import sys
+
+from osconfiglib import layer_index, layers
+
+
+def test_list_indexed_layers_without_processes(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    assert layers.create_layer('base')
+
+    # A layer cloned by an older version is picked up from its .git metadata
+    repo = tmp_path / '.cache' / 'osconfiglib' / 'example-main'
+    repo.mkdir()
+    subprocess.run(['git', 'init', '-q', '-b', 'main', str(repo)], check=True)
+    subprocess.run(['git', '-C', str(repo), 'remote', 'add', 'origin', 'https://example.com/example.git'], check=True)
+    (repo / 'README.md').write_text('example')
+    subprocess.run(['git', '-C', str(repo), 'add', '.'], check=True)
+    subprocess.run(['git', '-C', str(repo), '-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'init'], check=True)
+    commit = subprocess.check_output(['git', '-C', str(repo), 'rev-parse', 'HEAD'], text=True).strip()
+
+    mocker.patch('subprocess.run', side_effect=AssertionError('listing must not spawn processes'))
+    mocker.patch('subprocess.getoutput', side_effect=AssertionError('listing must not spawn processes'))
+    entries = {entry['name']: entry for entry in layer_index.list_indexed_layers()}
+
+    assert entries['base']['type'] == 'local'
+    assert entries['example-main']['url'] == 'https://example.com/example.git'
+    assert entries['example-main']['branch'] == 'main'
+    assert entries['example-main']['commit'] == commit
+    assert entries['example-main']['size'] > 0
+    layers.list_layers()
+
+
+def test_index_updates_from_several_processes(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    # Separate processes only share the lock file, not index_lock
+    update = "from osconfiglib import layer_index\nfor i in range(20):\n    layer_index.update_layer(f'{NAME}-{i}', type='git')\n"
+    processes = [subprocess.Popen([sys.executable, '-c', update.replace('{NAME}', name)]) for name in ['a', 'b', 'c']]
+    assert [process.wait() for process in processes] == [0, 0, 0]
+
+    assert len(layer_index.load_index()) == 60
+    assert not [name for name in os.listdir(layer_index.cache_root()) if name.endswith('.tmp')]
@@ -1,6 +1,14 @@
 # tests/layers_test.py
+import json
+import os
+import subprocess
+import tarfile
+import threading
+import time
+from pathlib import Path
+
 import pytest
-from osconfiglib import layers
+from osconfiglib import archive, layers, package_handler
 
 # You'll need to mock many of the filesystem and external calls in layers.py
 # This is just an example of how you might set up your tests
@@ -10,3 +18,261 @@ def test_get_requirements_files(mocker):
 
     requirements = layers.get_requirements_files('/path/to/layer', 'file.txt')
     assert requirements == ['requirement1', 'requirement2']
+
+
+def test_import_layers_parallel(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    assert layers.create_layer('c')
+    import_layer = mocker.patch('osconfiglib.layers.import_layer', return_value=True)
+    data = {'layer': [
+        {'name': 'a', 'type': 'git', 'url': 'https://example.com/org/a.git'},
+        {'name': 'b', 'type': 'git', 'url': 'https://example.com/org/b.git', 'branch_or_tag': 'dev'},
+        {'name': 'c', 'type': 'local'},
+    ]}
+
+    assert layers.import_layers(data, max_workers=2)
+    assert import_layer.call_count == 2
+    assert data['layer'][0]['path'].endswith('/example.com-org-a-main')
+    assert data['layer'][1]['path'].endswith('/example.com-org-b-main')
+    assert data['layer'][2]['path'].endswith('/osconfiglib/c')
+
+
+def test_import_layers_clones_every_directory_once(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    source = tmp_path / 'source'
+    subprocess.run(['git', 'init', '--quiet', '-b', 'master', str(source)], check=True)
+    make_layer_repo(source, ['configs/etc/motd', 'scripts/01.sh', 'package-lists/rpm-requirements.txt'])
+    real_clone_layer = layers.clone_layer
+
+    def slow_clone_layer(repo_url, branch, *args):
+        # Give the other import time to reach the master directory while this one clones
+        if branch == 'master':
+            time.sleep(0.2)
+        return real_clone_layer(repo_url, branch, *args)
+    clone_layer = mocker.patch('osconfiglib.layers.clone_layer', side_effect=slow_clone_layer)
+    data = {'layer': [
+        # Neither branch exists, both imports fall back to the same master directory
+        {'name': 'dev', 'type': 'git', 'url': f'file://{source}', 'branch_or_tag': 'dev'},
+        {'name': 'feature', 'type': 'git', 'url': f'file://{source}', 'branch_or_tag': 'feature'},
+        {'name': 'again', 'type': 'git', 'url': f'file://{source}.git', 'branch_or_tag': 'dev'},
+    ]}
+
+    assert layers.import_layers(data, max_workers=3)
+    master_clones = [call for call in clone_layer.call_args_list if call.args[1] == 'master']
+    assert len(master_clones) == 1
+    assert len(clone_layer.call_args_list) == 3
+    assert (tmp_path / '.cache' / 'osconfiglib' / layers.git_to_dir_name(f'file://{source}', 'master') / 'scripts' / '01.sh').exists()
+
+
+def test_import_layers_stops_on_failure(mocker):
+    mocker.patch('osconfiglib.layers.import_layer', side_effect=lambda repo_url, **kwargs: 'bad' not in repo_url)
+    data = {'layer': [
+        {'name': 'bad', 'type': 'git', 'url': 'https://example.com/org/bad.git'},
+        {'name': 'good', 'type': 'git', 'url': 'https://example.com/org/good.git'},
+    ]}
+
+    assert not layers.import_layers(data, max_workers=1)
+
+
+def make_layer_repo(path, files):
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', '-C', str(path)]
+    if not path.exists():
+        subprocess.run(['git', 'init', '--quiet', '-b', 'main', str(path)], check=True)
+    for name in files:
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(name)
+    subprocess.run(git + ['add', '.'], check=True)
+    subprocess.run(git + ['commit', '--quiet', '-m', 'layer'], check=True)
+
+
+def test_clone_layer_sparse(tmp_path):
+    source = tmp_path / 'source'
+    make_layer_repo(source, ['configs/etc/motd', 'scripts/01.sh', 'package-lists/rpm-requirements.txt', 'docs/big.iso'])
+
+    clone_dir = tmp_path / 'clone'
+    assert layers.clone_layer(f'file://{source}', 'main', str(clone_dir), clone_mode='sparse')
+    assert (clone_dir / 'configs' / 'etc' / 'motd').exists()
+    assert not (clone_dir / 'docs').exists()
+
+
+def test_reference_clones_fetch_one_at_a_time(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    source = tmp_path / 'source'
+    make_layer_repo(source, ['configs/etc/motd', 'scripts/01.sh', 'package-lists/rpm-requirements.txt'])
+    for branch in ['dev', 'stable']:
+        subprocess.run(['git', '-C', str(source), 'branch', branch], check=True)
+
+    active, overlaps = [], []
+    run = subprocess.run
+
+    def fetch(command, **kwargs):
+        writes_store = '--git-dir' in command
+        if writes_store:
+            active.append(command)
+            overlaps.append(len(active))
+        try:
+            return run(command, **kwargs)
+        finally:
+            if writes_store:
+                active.remove(command)
+    mocker.patch('subprocess.run', side_effect=fetch)
+
+    threads = [threading.Thread(target=layers.clone_layer, args=(f'file://{source}', branch, str(tmp_path / branch)),
+                                kwargs={'reference': True}) for branch in ['main', 'dev', 'stable']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(overlaps) == 1
+    assert all((tmp_path / branch / 'configs' / 'etc' / 'motd').exists() for branch in ['main', 'dev', 'stable'])
+
+
+def test_refresh_layer_fast_forwards(tmp_path):
+    source = tmp_path / 'source'
+    make_layer_repo(source, ['configs/etc/motd', 'scripts/01.sh', 'package-lists/rpm-requirements.txt'])
+    clone_dir = tmp_path / 'clone'
+    assert layers.clone_layer(f'file://{source}', 'main', str(clone_dir))
+
+    make_layer_repo(source, ['configs/etc/issue'])
+    assert layers.refresh_layer(f'file://{source}', 'main', str(clone_dir))
+    assert (clone_dir / 'configs' / 'etc' / 'issue').exists()
+    assert layers.git_output(str(clone_dir), 'rev-parse', 'HEAD') == layers.git_output(str(source), 'rev-parse', 'HEAD')
+
+
+def test_merge_configs_last_layer_wins(tmp_path):
+    for name, content in [('base', 'base'), ('top', 'top')]:
+        (tmp_path / name / 'configs' / 'etc').mkdir(parents=True)
+        (tmp_path / name / 'configs' / 'etc' / 'motd').write_text(content)
+    (tmp_path / 'base' / 'configs' / 'etc' / 'issue').symlink_to('motd')
+    base = {'name': 'base', 'path': str(tmp_path / 'base')}
+    top = {'name': 'top', 'path': str(tmp_path / 'top')}
+
+    merged = layers.merge_configs([base, top])
+    assert merged == {
+        'etc/motd': str(tmp_path / 'top' / 'configs' / 'etc' / 'motd'),
+        'etc/issue': str(tmp_path / 'base' / 'configs' / 'etc' / 'issue'),
+    }
+
+    tarball = layers.tar_configs(merged, str(tmp_path / 'configs.tar'))
+    with tarfile.open(tarball) as tar:
+        assert tar.getmember('etc/issue').issym()
+        assert tar.extractfile('etc/motd').read() == b'top'
+
+
+def test_merge_layers_runs_independent_layers_in_parallel(tmp_path):
+    recipe = []
+    for name, script in [('base', 'sleep 0.5; echo base >> "$LOG"'), ('tools', 'echo tools >> "$LOG"'),
+                         ('app', 'echo app >> "$LOG"')]:
+        (tmp_path / name / 'scripts').mkdir(parents=True)
+        (tmp_path / name / 'scripts' / 'setup.sh').write_text(script + '\n')
+        recipe.append({'name': name, 'path': str(tmp_path / name)})
+    (tmp_path / 'app' / 'layer.toml').write_text('depends_on = ["base"]\n')
+
+    squashed_layer = layers.merge_layers(recipe, str(tmp_path), script_jobs=2)
+    (tmp_path / 'squash_script.sh').write_text(squashed_layer['squash_script'])
+    subprocess.run(['bash', str(tmp_path / 'squash_script.sh')], check=True, env={'LOG': str(tmp_path / 'log')})
+
+    # tools does not wait for base, app does
+    assert (tmp_path / 'log').read_text().split() == ['tools', 'base', 'app']
+
+
+def test_script_levels_rejects_cycles():
+    recipe = [{'name': 'a'}, {'name': 'b'}]
+    assert layers.script_levels(recipe, {'a': [], 'b': ['a']}) == [['a'], ['b']]
+    assert layers.script_order(recipe[::-1], {'a': [], 'b': ['a']}) == ['a', 'b']
+    with pytest.raises(ValueError):
+        layers.script_levels(recipe, {'a': ['b'], 'b': ['a']})
+
+
+@pytest.mark.parametrize('reproducible', [False, True])
+def test_export_appends_packages_while_downloading(tmp_path, mocker, reproducible):
+    configs = tmp_path / 'configs.tar'
+    with tarfile.open(configs, 'w'):
+        pass
+    squashed_layer = {'configs': str(configs), 'rpm_requirements': ['tmux'], 'deb_requirements': [],
+                      'pip_requirements': [], 'squash_script': '#!/bin/bash\n'}
+
+    appended = threading.Event()
+    add_path = archive.add_path
+
+    def record(tar, path, arcname, reproducible=False):
+        add_path(tar, path, arcname, reproducible)
+        if arcname == 'rpms/tmux.rpm':
+            appended.set()
+
+    def stage_packages(squashed_layer, bundle_dir, download_jobs, manifest, inventory, on_package, pip_target):
+        for directory in ['rpms', 'debs', 'wheels']:
+            os.makedirs(os.path.join(bundle_dir, directory))
+        for name in ['tmux.rpm', 'bash.rpm']:
+            (Path(bundle_dir) / 'rpms' / name).write_bytes(name.encode())
+            on_package(os.path.join(bundle_dir, 'rpms', name))
+        # The package is in the tarball before the downloads are done, unless the export is reproducible
+        assert appended.wait(timeout=0.5 if reproducible else 5) != reproducible
+        (Path(bundle_dir) / 'rpms' / 'repodata').mkdir()
+        (Path(bundle_dir) / 'rpms' / 'repodata' / 'repomd.xml').write_text('<repomd/>')
+        return {'rpm': {'requirements': ['tmux'], 'packages': []}}
+
+    mocker.patch('osconfiglib.archive.add_path', side_effect=record)
+    mocker.patch('osconfiglib.layers.stage_packages', side_effect=stage_packages)
+    output_file = tmp_path / 'export.tar.gz'
+    layers.export_squashed_layer(squashed_layer, str(output_file), str(tmp_path), reproducible=reproducible)
+
+    with tarfile.open(output_file) as tar:
+        names = tar.getnames()
+        assert tar.extractfile('rpms/tmux.rpm').read() == b'tmux.rpm'
+        assert json.load(tar.extractfile('package-manifest.json'))['rpm']['requirements'] == ['tmux']
+    assert names.count('rpms/tmux.rpm') == 1
+    assert {'rpms', 'debs', 'wheels', 'rpms/repodata/repomd.xml', 'squash_script.sh'} <= set(names)
+    if reproducible:
+        assert names.index('rpms/bash.rpm') < names.index('rpms/tmux.rpm')
+
+
+def test_reproducible_exports_write_separate_partial_files(tmp_path, mocker):
+    partial_files = []
+
+    def export_squashed_layer(squashed_layer, output_file, *args):
+        partial_files.append(output_file)
+        Path(output_file).write_bytes(b'tarball')
+        return 'abc'
+    mocker.patch('osconfiglib.layers.export_squashed_layer', side_effect=export_squashed_layer)
+    data = {'name': 'rhel', 'version': '1.0.0'}
+
+    first = layers.export_to_dir({}, data, str(tmp_path), str(tmp_path), reproducible=True)
+    layers.export_to_dir({}, data, str(tmp_path), str(tmp_path), reproducible=True)
+    assert partial_files[0] != partial_files[1]
+    assert all(os.path.basename(path).startswith('.rhel.') and path.endswith('.partial') for path in partial_files)
+    assert os.stat(first).st_mode & 0o777 == 0o644
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.partial')]
+
+
+def test_export_fails_when_packages_are_missing(tmp_path, mocker):
+    configs = tmp_path / 'configs.tar'
+    with tarfile.open(configs, 'w'):
+        pass
+    squashed_layer = {'configs': str(configs), 'rpm_requirements': ['tmux'], 'deb_requirements': [],
+                      'pip_requirements': [], 'squash_script': '#!/bin/bash\n'}
+    mocker.patch('osconfiglib.package_handler.download_packages',
+                 side_effect=package_handler.PackageError('Error resolving packages'))
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+
+    # No tarball and no manifest without the packages of the layers
+    with pytest.raises(package_handler.PackageError):
+        layers.export_to_dir(squashed_layer, {'name': 'rhel', 'version': '1.0.0'}, str(output_dir), str(tmp_path))
+    assert os.listdir(output_dir) == []
+
+
+def test_squash_script_keeps_versioned_requirements_together(tmp_path):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'dnf').write_text('#!/bin/bash\nprintf "%s\\n" "$@" > "$(dirname "$0")/arguments"\n')
+    (bin_dir / 'dnf').chmod(0o755)
+    (tmp_path / 'rpm_requirements.txt').write_text('bash\ntmux >= 3.0')
+    (tmp_path / 'rpms' / 'repodata').mkdir(parents=True)
+    script = tmp_path / 'squash_script.sh'
+    script.write_text(layers.SQUASH_SCRIPT_HEADER)
+    subprocess.run(['bash', str(script)], check=True, env={'PATH': f'{bin_dir}:/usr/bin:/bin'})
+
+    arguments = (bin_dir / 'arguments').read_text().splitlines()
+    assert arguments[0] == 'install' and f'--repofrompath=osconfiglib,{tmp_path}/rpms' in arguments
+    assert arguments[-2:] == ['bash', 'tmux >= 3.0']
@@ -0,0 +1,77 @@
+# tests/test_package_cache.py
+import hashlib
+import os
+import subprocess
+import sys
+
+from osconfiglib import package_cache
+
+
+def test_ingest_and_lookup_packages(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    download = tmp_path / 'download'
+    download.mkdir()
+    (download / 'tmux-3.2-1.x86_64.rpm').write_bytes(b'tmux')
+    (download / 'vim-9.0-1.x86_64.rpm').write_bytes(b'vim')
+
+    package_cache.ingest_packages([str(download / 'tmux-3.2-1.x86_64.rpm'), str(download / 'vim-9.0-1.x86_64.rpm')])
+    assert not (download / 'tmux-3.2-1.x86_64.rpm').exists()
+    assert package_cache.lookup_package('bash-5.2-1.x86_64.rpm', hashlib.sha256(b'bash').hexdigest()) is None
+
+    # Both packages were ingested at the same time, using tmux makes vim the least recently used
+    index = package_cache.load_index()
+    for entries in index.values():
+        for entry in entries.values():
+            entry['last_used'] -= 10 * 86400
+    package_cache.save_index(index)
+    tmux = package_cache.lookup_package('tmux-3.2-1.x86_64.rpm', hashlib.sha256(b'tmux').hexdigest())
+    assert open(tmux, 'rb').read() == b'tmux'
+
+    package_cache.evict(max_age_days=5)
+    assert list(package_cache.load_index()) == ['tmux-3.2-1.x86_64.rpm']
+
+
+def test_lookup_package_needs_checksum_or_url(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    for content, url in [(b'build 1', 'https://a.example/tmux.rpm'), (b'build 2', 'https://b.example/tmux.rpm')]:
+        path = tmp_path / 'tmux-3.2-1.x86_64.rpm'
+        path.write_bytes(content)
+        package_cache.ingest_packages([str(path)], urls={str(path): url})
+
+    assert package_cache.lookup_package('tmux-3.2-1.x86_64.rpm') is None
+    rebuilt = package_cache.lookup_package('tmux-3.2-1.x86_64.rpm', hashlib.sha256(b'build 2').hexdigest())
+    assert open(rebuilt, 'rb').read() == b'build 2'
+    assert open(package_cache.lookup_package('tmux-3.2-1.x86_64.rpm', url='https://a.example/tmux.rpm'), 'rb').read() == b'build 1'
+    assert package_cache.lookup_package('tmux-3.2-1.x86_64.rpm', url='https://c.example/tmux.rpm') is None
+    assert package_cache.lookup_package('tmux-3.2-1.x86_64.rpm', hashlib.sha256(b'build 3').hexdigest()) is None
+
+
+def test_evict_by_size_and_age(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    for name in ['old.rpm', 'new.rpm']:
+        (tmp_path / name).write_bytes(name.encode())
+    package_cache.ingest_packages([str(tmp_path / 'old.rpm'), str(tmp_path / 'new.rpm')])
+
+    index = package_cache.load_index()
+    index['old.rpm'][hashlib.sha256(b'old.rpm').hexdigest()]['last_used'] -= 10 * 86400
+    package_cache.save_index(index)
+
+    assert package_cache.evict(max_age_days=5) == len(b'old.rpm')
+    assert list(package_cache.load_index()) == ['new.rpm']
+    assert package_cache.evict(max_bytes=0) == len(b'new.rpm')
+    assert os.listdir(os.path.join(package_cache.cache_dir(), 'objects')) == []
+
+
+def test_index_updates_from_several_processes(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    # Separate processes only share the lock file, not index_lock
+    ingest = ("import sys\nfrom pathlib import Path\nfrom osconfiglib import package_cache\n"
+              "for i in range(20):\n"
+              "    path = Path(sys.argv[1]) / f'{sys.argv[2]}-{i}.whl'\n"
+              "    path.write_text(path.name)\n"
+              "    package_cache.ingest_packages([str(path)], 'whl')\n")
+    processes = [subprocess.Popen([sys.executable, '-c', ingest, str(tmp_path), name]) for name in ['a', 'b', 'c']]
+    assert [process.wait() for process in processes] == [0, 0, 0]
+
+    assert len(package_cache.load_index('whl')) == 60
+    assert not [name for name in os.listdir(package_cache.cache_dir('whl')) if name.endswith('.tmp')]
@@ -0,0 +1,229 @@
+# tests/test_package_handler.py
+import hashlib
+import http.client
+import json
+import os
+import subprocess
+import urllib.request
+from pathlib import Path
+
+import pytest
+from osconfiglib import package_cache, package_handler
+
+
+def test_parse_rpm_filename():
+    assert package_handler.parse_rpm_filename('python3-libs-3.11.4-1.fc38.x86_64.rpm') == ('python3-libs', '3.11.4', '1.fc38', 'x86_64')
+
+
+def test_fetch_packages_verifies_checksums(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    packages = []
+    for name in ['good', 'bad']:
+        (mirror / f'{name}.deb').write_bytes(name.encode())
+        packages.append({'filename': f'{name}.deb', 'url': (mirror / f'{name}.deb').as_uri(),
+                         'sha256': hashlib.sha256(b'good').hexdigest()})
+
+    completed = []
+    failed = package_handler.fetch_packages(packages, 'deb', jobs=2, retries=0,
+                                            on_complete=lambda package, path: completed.append(package['filename']))
+    assert completed == ['good.deb']
+    assert [package['filename'] for package in failed] == ['bad.deb']
+
+    # The second run is served from the package cache
+    (mirror / 'good.deb').unlink()
+    assert package_handler.fetch_packages(packages[:1], 'deb') == []
+
+
+def test_fetch_packages_records_checksums_and_retries(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / 'tmux-3.2-1.x86_64.rpm').write_bytes(b'tmux')
+    url = (tmp_path / 'tmux-3.2-1.x86_64.rpm').as_uri()
+    mocker.patch('time.sleep')
+    urlopen = mocker.patch('urllib.request.urlopen', side_effect=[http.client.IncompleteRead(b'tm'), urllib.request.urlopen(url)])
+
+    # A truncated response is retried instead of failing the export
+    assert package_handler.fetch_packages([{'filename': 'tmux-3.2-1.x86_64.rpm', 'url': url}], 'rpm', retries=1) == []
+    assert urlopen.call_count == 2
+
+    # Resolved rpm manifests carry no checksum, a cache hit records the one of the cached file
+    package = {'filename': 'tmux-3.2-1.x86_64.rpm', 'url': url}
+    assert package_handler.fetch_packages([package], 'rpm') == []
+    assert urlopen.call_count == 2
+    assert package['sha256'] == hashlib.sha256(b'tmux').hexdigest()
+
+
+def test_resolve_deb_manifest(mocker):
+    # tmux depends on libc6 and on "libgcc-s1 | libgcc1", the solver only prints the alternative it picked
+    uris = ("'http://deb.debian.org/debian/pool/main/t/tmux/tmux_3.3a-3_amd64.deb' tmux_3.3a-3_amd64.deb 455484 SHA256:aa\n"
+            "'http://deb.debian.org/debian/pool/main/g/glibc/libc6_2.36-9_amd64.deb' libc6_2.36-9_amd64.deb 2757236 SHA256:bb\n"
+            "'http://deb.debian.org/debian/pool/main/g/gcc-12/libgcc-s1_12.2.0-14_amd64.deb' libgcc-s1_12.2.0-14_amd64.deb 49452 SHA256:cc\n")
+    check_output = mocker.patch('subprocess.check_output', return_value=uris)
+
+    packages = package_handler.resolve_deb_manifest(['tmux=3.3a-3'])
+    command = check_output.call_args.args[0]
+    assert command[:2] == ['apt-get', 'install'] and command[-1] == 'tmux=3.3a-3'
+    assert 'Dir::State::status=/dev/null' in command
+    assert check_output.call_count == 1
+    assert [(package['name'], package['version'], package['sha256']) for package in packages] == [
+        ('tmux', '3.3a-3', 'aa'), ('libc6', '2.36-9', 'bb'), ('libgcc-s1', '12.2.0-14', 'cc')]
+    assert 'libgcc1' not in [package['name'] for package in packages]
+
+
+def test_download_packages_fails_on_missing_packages(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    mocker.patch('time.sleep')
+    resolve = mocker.patch('osconfiglib.package_handler.resolve_deb_manifest',
+                           side_effect=subprocess.CalledProcessError(100, 'apt-get'))
+    with pytest.raises(package_handler.PackageError):
+        package_handler.download_packages(['tmux'], str(tmp_path / 'debs'), 'deb')
+
+    # Packages that can not be downloaded fail the download instead of being left out
+    resolve.side_effect = None
+    resolve.return_value = [{'filename': 'tmux.deb', 'url': (tmp_path / 'missing.deb').as_uri()}]
+    with pytest.raises(package_handler.PackageError, match='tmux.deb'):
+        package_handler.download_packages(['tmux'], str(tmp_path / 'debs'), 'deb')
+
+    # Manifests written by an export whose resolution failed are resolved again
+    manifest = {'deb': {'requirements': ['tmux'], 'packages': []}}
+    assert package_handler.manifest_packages(manifest, ['tmux'], 'deb') is None
+
+
+def test_parse_dpkg_status():
+    status = (
+        "Package: bash\nStatus: install ok installed\nArchitecture: amd64\nVersion: 5.2.15-2+b2\n"
+        "Description: GNU Bourne Again SHell\n Bash is an sh-compatible command language interpreter.\n\n"
+        "Package: removed\nStatus: deinstall ok config-files\nVersion: 1.0\n"
+    )
+    assert package_handler.parse_dpkg_status(status) == [{'name': 'bash', 'version': '5.2.15-2+b2', 'arch': 'amd64'}]
+
+
+def test_get_image_inventory_is_cached(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    image = tmp_path / 'image.qcow2'
+    image.write_bytes(b'qcow2')
+    inventory = {'package_type': 'rpm', 'packages': [{'name': 'bash', 'epoch': '0', 'version': '5.2.15', 'release': '1', 'arch': 'x86_64'}]}
+    read = mocker.patch('osconfiglib.package_handler.read_image_inventory', return_value=inventory)
+
+    assert package_handler.extract_packages_qcow2(str(image)) == ['bash']
+    assert package_handler.get_image_inventory(str(image)) == inventory
+    assert read.call_count == 1
+
+    # Modifying the image invalidates its inventory
+    image.write_bytes(b'qcow2 upgraded')
+    package_handler.get_image_inventory(str(image))
+    assert read.call_count == 2
+
+
+def test_compare_with_inventory():
+    packages = [
+        {'name': 'bash', 'epoch': '0', 'version': '5.2.15', 'release': '2.fc38', 'arch': 'x86_64'},
+        {'name': 'glibc', 'epoch': '0', 'version': '2.37', 'release': '1.fc38', 'arch': 'x86_64'},
+        {'name': 'tmux', 'epoch': '0', 'version': '3.3a', 'release': '3.fc38', 'arch': 'x86_64'},
+    ]
+    inventory = {'package_type': 'rpm', 'packages': [
+        {'name': 'bash', 'epoch': '0', 'version': '5.2.15', 'release': '1.fc38', 'arch': 'x86_64'},
+        {'name': 'glibc', 'epoch': '0', 'version': '2.37', 'release': '1.fc38', 'arch': 'x86_64'},
+    ]}
+
+    delta = package_handler.compare_with_inventory(packages, inventory, 'rpm')
+    assert [package['name'] for package in delta] == ['bash', 'tmux']
+    assert [package['delta'] for package in packages] == ['newer', 'installed', 'new']
+    assert packages[0]['installed'] == '0:5.2.15-1.fc38'
+
+
+def test_parse_pip_report():
+    report = {'install': [
+        {'metadata': {'name': 'six', 'version': '1.16.0'},
+         'download_info': {'url': 'https://files.example.org/packages/six-1.16.0-py2.py3-none-any.whl',
+                           'archive_info': {'hashes': {'sha256': 'abc'}}}},
+        {'metadata': {'name': 'local', 'version': '0.1'},
+         'download_info': {'url': 'file:///src/local', 'dir_info': {}}},
+    ]}
+    assert package_handler.parse_pip_report(report) == [
+        {'name': 'six', 'version': '1.16.0', 'filename': 'six-1.16.0-py2.py3-none-any.whl',
+         'url': 'https://files.example.org/packages/six-1.16.0-py2.py3-none-any.whl', 'sha256': 'abc'}]
+
+
+def test_download_pip_packages_links_wheels(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    wheel = tmp_path / 'six-1.16.0-py2.py3-none-any.whl'
+    wheel.write_bytes(b'wheel')
+    manifest = [{'name': 'six', 'version': '1.16.0', 'filename': wheel.name, 'url': wheel.as_uri()}]
+
+    # Without a target the wheelhouse would be built for the host
+    with pytest.raises(package_handler.PackageError):
+        package_handler.download_pip_packages(['six'], str(tmp_path / 'wheels'), manifest=manifest)
+
+    pip_target = {'python_version': '3.11', 'platforms': ['manylinux2014_x86_64']}
+    package_handler.download_pip_packages(['six'], str(tmp_path / 'wheels'), manifest=manifest, pip_target=pip_target)
+    assert (tmp_path / 'wheels' / wheel.name).read_bytes() == b'wheel'
+
+
+def test_resolve_pip_manifest_for_image_python(mocker):
+    def pip(command, check):
+        with open(command[command.index('--report') + 1], 'w') as file:
+            json.dump({'install': []}, file)
+    run = mocker.patch('subprocess.run', side_effect=pip)
+
+    inventory = {'package_type': 'deb', 'packages': [
+        {'name': 'python3', 'version': '3.11.2-1+b1', 'arch': 'amd64'},
+        {'name': 'libc6', 'version': '2.36-9+deb12u4', 'arch': 'amd64'},
+    ]}
+    pip_target = package_handler.image_pip_target(inventory)
+    assert pip_target['python_version'] == '3.11'
+    assert pip_target['platforms'][0] == 'manylinux_2_36_x86_64' and pip_target['platforms'][-1] == 'manylinux2014_x86_64'
+    assert package_handler.image_pip_target(inventory, 'python3.9')['python_version'] == '3.9'
+    assert package_handler.image_pip_target({'package_type': 'deb', 'packages': inventory['packages'][:1]}) is None
+
+    assert package_handler.resolve_pip_manifest(['numpy'], pip_target) == []
+    command = run.call_args.args[0]
+    assert command[command.index('--python-version') + 1] == '3.11'
+    assert command[command.index('--platform') + 1] == 'manylinux_2_36_x86_64'
+    assert '--only-binary=:all:' in command
+
+
+def test_create_repo_reuses_rpm_metadata(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    mocker.patch('shutil.which', return_value='/usr/bin/createrepo_c')
+
+    def createrepo(command, check):
+        (Path(command[-1]) / 'repodata').mkdir(exist_ok=True)
+        (Path(command[-1]) / 'repodata' / 'repomd.xml').write_text(command[-1])
+    run = mocker.patch('subprocess.run', side_effect=createrepo)
+    for name in ['first', 'second']:
+        (tmp_path / name).mkdir()
+        package_handler.create_repo(str(tmp_path / name), 'rpm')
+
+    metadata_cache = os.path.join(package_cache.cache_dir('rpm'), 'metadata')
+    assert '--update' not in run.call_args_list[0].args[0]
+    assert run.call_args_list[1].args[0][2:-1] == ['--update', '--update-md-path', metadata_cache]
+    assert (Path(metadata_cache) / 'repodata' / 'repomd.xml').read_text() == str(tmp_path / 'second')
+
+
+def test_create_repo_keeps_apt_ftparchive_database(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    mocker.patch('shutil.which', return_value='/usr/bin/apt-ftparchive')
+    run = mocker.patch('subprocess.run')
+    package_handler.create_repo(str(tmp_path), 'deb')
+
+    command = run.call_args_list[0].args[0]
+    assert command[0] == 'apt-ftparchive'
+    assert command[command.index('--db') + 1] == os.path.join(package_cache.cache_dir('deb'), 'metadata', 'packages.db')
+    assert run.call_args_list[1].args[0][:3] == ['gzip', '-k', '-f']
+
+
+def test_mount_image_inventory_keeps_mount_error(tmp_path, mocker, capsys):
+    mocker.patch('tempfile.mkdtemp', return_value=str(tmp_path))
+
+    def run(command, check):
+        if check:
+            raise subprocess.CalledProcessError(1, command)
+        return subprocess.CompletedProcess(command, 1)
+    mocker.patch('subprocess.run', side_effect=run)
+
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        package_handler.mount_image_inventory('image.qcow2')
+    assert error.value.cmd[0] == 'guestmount'
+    assert 'Failed to unmount image.qcow2' in capsys.readouterr().out
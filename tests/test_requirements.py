@@ -0,0 +1,49 @@
+# tests/test_requirements.py
+from osconfiglib import requirements
+
+
+def test_parse_requirement():
+    assert requirements.parse_requirement('tmux >= 3.0', 'rpm') == ('tmux', '>=3.0')
+    assert requirements.parse_requirement('tmux=3.3a-3', 'deb') == ('tmux', '=3.3a-3')
+    assert requirements.parse_requirement('Flask_SQLAlchemy[async] >= 3.0', 'pip') == ('flask-sqlalchemy', '[async]>=3.0')
+
+
+def test_merge_requirements_later_layer_wins():
+    merged, conflicts = requirements.merge_requirements([
+        ('base', ['requests==2.30', 'six', 'PyYAML']),
+        ('app', ['Requests==2.31', 'pyyaml', 'six']),
+    ], 'pip')
+
+    assert merged == ['pyyaml', 'requests==2.31', 'six']
+    assert conflicts == [('requests', ('base', 'requests==2.30'), ('app', 'requests==2.31'))]
+
+
+def test_merge_requirements_keeps_pins():
+    merged, conflicts = requirements.merge_requirements([('base', ['vim', 'tmux >= 3.0']), ('app', ['tmux', 'vim'])], 'rpm')
+    assert merged == ['tmux >= 3.0', 'vim']
+    assert conflicts == []
+
+
+def test_pip_markers_are_kept_and_part_of_the_key():
+    entry = 'numpy==1.26; python_version >= "3.9" and os_name == "posix"'
+    assert requirements.parse_requirement(entry, 'pip') == ('numpy; python_version >= "3.9" and os_name == "posix"', '==1.26')
+
+    merged, conflicts = requirements.merge_requirements([
+        ('base', ['numpy == 1.24; python_version < "3.9"']),
+        ('app', ['numpy==1.26; python_version >= "3.9"']),
+    ], 'pip')
+    assert merged == ['numpy==1.24; python_version < "3.9"', 'numpy==1.26; python_version >= "3.9"']
+    assert conflicts == []
+
+
+def test_pip_url_requirements():
+    assert requirements.parse_requirement('My_Pkg @ https://example.com/my_pkg-1.0.tar.gz', 'pip') == (
+        'my-pkg', ' @ https://example.com/my_pkg-1.0.tar.gz')
+
+    merged, conflicts = requirements.merge_requirements([
+        ('base', ['my-pkg==0.9']),
+        ('app', ['my-pkg[extra] @ https://example.com/my_pkg-1.0.tar.gz ; os_name == "posix"', 'my-pkg @ https://example.com/my_pkg-1.0.tar.gz']),
+    ], 'pip')
+    assert merged == ['my-pkg @ https://example.com/my_pkg-1.0.tar.gz',
+                      'my-pkg[extra] @ https://example.com/my_pkg-1.0.tar.gz ; os_name == "posix"']
+    assert conflicts == [('my-pkg', ('base', 'my-pkg==0.9'), ('app', 'my-pkg @ https://example.com/my_pkg-1.0.tar.gz'))]
@@ -0,0 +1,46 @@
+# tests/test_squash_cache.py
+import os
+
+from osconfiglib import layers, squash_cache
+
+
+def make_layer(path):
+    for name in ['configs/etc/motd', 'scripts/01.sh', 'package-lists/rpm-requirements.txt']:
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(name)
+    return {'name': path.name, 'type': 'local', 'path': str(path)}
+
+
+def test_squash_layers_uses_cache(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    layer = make_layer(tmp_path / 'layer')
+
+    (tmp_path / 'first').mkdir()
+    first = layers.squash_layers([layer], str(tmp_path / 'first'))
+
+    merge_layers = mocker.spy(layers, 'merge_layers')
+    (tmp_path / 'second').mkdir()
+    second = layers.squash_layers([layer], str(tmp_path / 'second'))
+    assert merge_layers.call_count == 0
+    assert second['rpm_requirements'] == first['rpm_requirements'] == ['package-lists/rpm-requirements.txt']
+    assert second['squash_script'] == first['squash_script']
+    assert os.path.exists(second['configs'])
+
+    # Changing a layer changes its identity and misses the cache
+    (tmp_path / 'layer' / 'configs' / 'etc' / 'motd').write_text('changed')
+    (tmp_path / 'third').mkdir()
+    layers.squash_layers([layer], str(tmp_path / 'third'))
+    assert merge_layers.call_count == 1
+
+
+def test_evict_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    for index, key in enumerate(['old', 'new']):
+        entry = os.path.join(squash_cache.cache_dir(), key)
+        os.makedirs(entry)
+        with open(os.path.join(entry, 'configs.tar'), 'wb') as file:
+            file.write(b'x' * 100)
+        os.utime(entry, (index, index))
+
+    assert squash_cache.evict(max_bytes=150) == 100
+    assert sorted(os.listdir(squash_cache.cache_dir())) == ['new']
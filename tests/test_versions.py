@@ -0,0 +1,32 @@
+# tests/test_versions.py
+import pytest
+
+from osconfiglib import versions
+
+
+@pytest.mark.parametrize('a, b, expected', [
+    ('1.0', '1.0', 0),
+    ('1.0', '1.1', -1),
+    ('2.0', '10', -1),
+    ('1.05', '1.5', 0),
+    ('1.0a', '1.0', 1),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0^git1', '1.0', 1),
+    ('1.0^git1', '1.0.1', -1),
+    ('fc38', 'fc39', -1),
+])
+def test_rpmvercmp(a, b, expected):
+    assert versions.rpmvercmp(a, b) == expected
+    assert versions.rpmvercmp(b, a) == -expected
+
+
+@pytest.mark.parametrize('a, b, expected', [
+    ('1.0', '1.0-0', 0),
+    ('1:1.0', '2.0', 1),
+    ('1.0~rc1-1', '1.0-1', -1),
+    ('5.2.15-2+b2', '5.2.15-2', 1),
+    ('2.36-9+deb12u4', '2.36-9+deb12u10', -1),
+])
+def test_debvercmp(a, b, expected):
+    assert versions.debvercmp(a, b) == expected
+    assert versions.debvercmp(b, a) == -expected
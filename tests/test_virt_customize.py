@@ -0,0 +1,119 @@
+# tests/test_virt_customize.py
+import subprocess
+import time
+
+from osconfiglib import layers, virt_customize
+
+
+def test_apply_squashed_layer_single_pass(tmp_path, mocker):
+    commands = []
+
+    def run(command, **kwargs):
+        if command[0] == 'virt-customize':
+            commands.append(open(command[command.index('--commands-from-file') + 1]).read())
+        return subprocess.CompletedProcess(command, 0)
+
+    run_mock = mocker.patch('osconfiglib.virt_customize.subprocess.run', side_effect=run)
+    mocker.patch('osconfiglib.virt_customize.shutil.which', return_value='/usr/bin/qemu-img')
+    stage_packages = mocker.patch('osconfiglib.layers.stage_packages')
+    (tmp_path / 'configs.tar').write_bytes(b'')
+    squashed_layer = {
+        'configs': str(tmp_path / 'configs.tar'),
+        'squash_script': '#!/bin/bash\n',
+        'rpm_requirements': ['tmux'],
+        'deb_requirements': [],
+        'pip_requirements': [],
+    }
+
+    assert virt_customize.apply_squashed_layer('base.qcow2', squashed_layer, str(tmp_path / 'out.qcow2'))
+
+    # The output is an overlay of the base image and everything runs in one virt-customize call
+    qemu_img = run_mock.call_args_list[0].args[0]
+    assert qemu_img[:2] == ['qemu-img', 'create'] and '-b' in qemu_img
+    assert [call.args[0][0] for call in run_mock.call_args_list] == ['qemu-img', 'virt-customize']
+    # The packages are bundled and the whole bundle is copied into the guest at once
+    assert stage_packages.call_count == 1
+    operations = [line.split()[0] for line in commands[0].splitlines()]
+    assert operations == ['mkdir', 'copy-in', 'run-command', 'run-command', 'delete']
+    assert 'dnf' not in commands[0]
+
+
+def test_apply_batch_reports_every_image(mocker):
+    mocker.patch('osconfiglib.virt_customize.available_memory', return_value=64 * 1024)
+    stage_bundle = mocker.patch('osconfiglib.virt_customize.stage_bundle')
+    apply = mocker.patch('osconfiglib.virt_customize.apply_squashed_layer', side_effect=lambda base_image, *args, **kwargs: base_image != 'b.qcow2')
+    images = [('a.qcow2', 'a-out.qcow2'), ('b.qcow2', 'b-out.qcow2'), ('c.qcow2', 'c-out.qcow2')]
+
+    results = virt_customize.apply_batch({}, images, max_workers=2)
+
+    assert apply.call_count == 3
+    assert stage_bundle.call_count == 1
+    assert [(result['output_image'], result['success']) for result in results] == [
+        ('a-out.qcow2', True), ('b-out.qcow2', False), ('c-out.qcow2', True)]
+
+
+def test_apply_batch_rejects_duplicate_outputs_and_keeps_order(mocker):
+    mocker.patch('osconfiglib.virt_customize.available_memory', return_value=64 * 1024)
+    mocker.patch('osconfiglib.virt_customize.stage_bundle')
+    apply = mocker.patch('osconfiglib.virt_customize.apply_squashed_layer', return_value=True)
+
+    assert virt_customize.apply_batch({}, [('a/rhel.qcow2', 'out/rhel.qcow2'), ('b/rhel.qcow2', 'out/../out/rhel.qcow2')]) is None
+    assert apply.call_count == 0
+
+    # Later images finish first
+    apply.side_effect = lambda base_image, *args, **kwargs: time.sleep(0.1 if base_image == 'a.qcow2' else 0) or True
+    images = [('a.qcow2', 'a-out.qcow2'), ('b.qcow2', 'b-out.qcow2')]
+    results = virt_customize.apply_batch({}, images, max_workers=2)
+    assert [result['base_image'] for result in results] == ['a.qcow2', 'b.qcow2']
+
+
+def test_appliance_slots_respects_memory(mocker, monkeypatch):
+    monkeypatch.setenv('LIBGUESTFS_MEMSIZE', '768')
+    mocker.patch('osconfiglib.virt_customize.available_memory', return_value=2048)
+    assert virt_customize.appliance_slots(8) == 2
+    mocker.patch('osconfiglib.virt_customize.available_memory', return_value=512)
+    assert virt_customize.appliance_slots(8) == 1
+
+
+def test_timed_commands_start_empty_log_and_time_pip(tmp_path):
+    bundle_dir = tmp_path / 'osconfiglib'
+    bundle_dir.mkdir()
+    commands = virt_customize.squashed_layer_commands({'pip_requirements': ['six']}, str(bundle_dir), timings=True)
+
+    assert commands[0] == ('write', f'{virt_customize.GUEST_TIMING_LOG}:')
+    pip_install = [argument for operation, argument in commands if 'pip install' in argument][0]
+    assert pip_install.startswith(f'OSCONFIGLIB_TIMING_LOG={virt_customize.GUEST_TIMING_LOG} ')
+    assert pip_install.endswith("osconfiglib_step osconfiglib_install_pip'")
+
+
+def test_squash_script_records_timings(tmp_path):
+    script = tmp_path / 'squash_script.sh'
+    script.write_text(layers.SQUASH_SCRIPT_HEADER + 'function base_setup_sh() {\nsleep 0.2\n}\nosconfiglib_step base_setup_sh\n')
+    log = tmp_path / 'timing.jsonl'
+    subprocess.run(['bash', str(script)], check=True, env={'OSCONFIGLIB_TIMING_LOG': str(log), 'PATH': '/usr/bin:/bin'})
+
+    records = virt_customize.read_timings(str(log))
+    assert [record['step'] for record in records][0] == 'base_setup_sh'
+    assert records[0]['seconds'] >= 0.2 and records[0]['status'] == 0
+    assert {record['step'] for record in records} == {'base_setup_sh', 'osconfiglib_install_rpms', 'osconfiglib_install_debs'}
+
+
+def test_apply_batch_needs_one_python_target(mocker):
+    inventories = {
+        'a.qcow2': {'package_type': 'rpm', 'packages': [{'name': 'python3', 'version': '3.11.4', 'arch': 'x86_64'},
+                                                        {'name': 'glibc', 'version': '2.37', 'arch': 'x86_64'}]},
+        'b.qcow2': {'package_type': 'rpm', 'packages': [{'name': 'python3', 'version': '3.9.18', 'arch': 'x86_64'},
+                                                        {'name': 'glibc', 'version': '2.34', 'arch': 'x86_64'}]},
+    }
+    mocker.patch('osconfiglib.package_handler.get_image_inventory', side_effect=inventories.get)
+    mocker.patch('osconfiglib.virt_customize.available_memory', return_value=64 * 1024)
+    stage_bundle = mocker.patch('osconfiglib.virt_customize.stage_bundle')
+    apply = mocker.patch('osconfiglib.virt_customize.apply_squashed_layer', return_value=True)
+
+    # One wheelhouse can not serve images with different Pythons
+    squashed_layer = {'pip_requirements': ['six']}
+    assert virt_customize.apply_batch(squashed_layer, [('a.qcow2', 'a-out.qcow2'), ('b.qcow2', 'b-out.qcow2')]) is None
+    assert apply.call_count == 0
+
+    virt_customize.apply_batch(squashed_layer, [('a.qcow2', 'a-out.qcow2')])
+    assert stage_bundle.call_args.args[4]['python_version'] == '3.11'